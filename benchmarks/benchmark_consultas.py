@@ -0,0 +1,254 @@
+"""Latência das consultas do rastreamento de chamadas em bancos grandes.
+
+Para cada banco (gerado com gerar_dados.py ou informado com --banco) mede o
+tempo de abertura do CallTracker e de cada caminho de leitura, separando
+usuários pesados (os mais ativos), medianos e leves:
+
+- obter_estatisticas_usuario (!statscall, !analisar, !consultar);
+- obter_ranking e obter_ranking_periodo, com o cache frio e quente;
+- get_user_rank;
+- as páginas do histórico do !consultar: primeira, do meio, última e uma
+  navegação de 5 páginas seguidas;
+- reset_user_calls (por último, pois apaga os dados dos usuários amostrados).
+
+Um banco informado com --banco é copiado para um diretório temporário antes
+dos resets. O resultado é gravado em JSON para servir de linha de base. Com
+--perfil-sql, o JSON inclui também o perfil por statement (chamadas, tempos,
+linhas, passos da VM e EXPLAIN QUERY PLAN) de cada banco.
+
+Uso:
+    python benchmarks/benchmark_consultas.py --sessoes 100k,1M
+    python benchmarks/benchmark_consultas.py --banco call_tracker_10m.db
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from comum import (ambiente, caminho_padrao, importar_bot, percentis,
+                   salvar_resultado)
+from gerar_dados import gerar_banco, ler_quantidade
+
+ITENS_POR_PAGINA = 5  # Mesmo tamanho de página do !consultar
+PERIODOS = ('dia', 'semana', 'mes')
+
+
+def amostrar_usuarios(tracker, guild_id, amostras):
+    """Usuários pesados, medianos e leves do servidor, por total de sessões."""
+    with tracker.conexoes.leitura() as conn:
+        linhas = conn.execute('''
+            SELECT user_id, total_sessoes FROM call_stats
+            WHERE guild_id = ?
+            ORDER BY total_sessoes DESC, user_id
+        ''', (guild_id, )).fetchall()
+    meio = max(0, len(linhas) // 2 - amostras // 2)
+    return {
+        'pesados': linhas[:amostras],
+        'medianos': linhas[meio:meio + amostras],
+        'leves': linhas[-amostras:]
+    }
+
+
+def chave_do_meio(tracker, guild_id, user_id, total_sessoes):
+    """Chave (entrada, id) da sessão no meio do histórico do usuário."""
+    with tracker.conexoes.leitura() as conn:
+        return conn.execute('''
+            SELECT entrada, id FROM call_sessions
+            WHERE guild_id = ? AND user_id = ? AND saida IS NOT NULL
+            ORDER BY entrada DESC, id DESC
+            LIMIT 1 OFFSET ?
+        ''', (guild_id, user_id, total_sessoes // 2)).fetchone()
+
+
+def cronometrar(funcao, *args):
+    inicio = time.perf_counter()
+    funcao(*args)
+    return time.perf_counter() - inicio
+
+
+def medir_banco(main, db_path, args):
+    inicio = time.perf_counter()
+    tracker = main.CallTracker(db_path, perfil_sql=args.perfil_sql)
+    abertura = time.perf_counter() - inicio
+    # Mede o servidor com mais usuários
+    with tracker.conexoes.leitura() as conn:
+        guild_id = conn.execute(
+            'SELECT guild_id FROM call_stats GROUP BY guild_id '
+            'ORDER BY COUNT(*) DESC LIMIT 1').fetchone()[0]
+        total_sessoes = conn.execute(
+            'SELECT COUNT(*) FROM call_sessions').fetchone()[0]
+        total_usuarios = conn.execute(
+            'SELECT COUNT(*) FROM call_stats').fetchone()[0]
+    classes = amostrar_usuarios(tracker, guild_id, args.amostras)
+    cache = tracker.particao(guild_id).cache_ranking
+    consultas = {}
+
+    def medir(nome, classe, amostras):
+        consultas.setdefault(nome, {})[classe] = percentis(amostras)
+
+    # Estatísticas, posição no ranking e histórico, por classe de usuário
+    for classe, usuarios in classes.items():
+        tempos = {'estatisticas_usuario': [], 'get_user_rank': [],
+                  'historico_primeira_pagina': [], 'historico_pagina_do_meio': [],
+                  'historico_ultima_pagina': [], 'historico_navegacao_5_paginas': []}
+        for user_id, sessoes_usuario in usuarios:
+            meio = chave_do_meio(tracker, guild_id, user_id, sessoes_usuario)
+            restantes = sessoes_usuario % ITENS_POR_PAGINA or ITENS_POR_PAGINA
+            for _ in range(args.repeticoes):
+                tempos['estatisticas_usuario'].append(cronometrar(
+                    tracker.obter_estatisticas_usuario, guild_id, user_id))
+                tempos['get_user_rank'].append(cronometrar(
+                    tracker.get_user_rank, guild_id, user_id))
+                tempos['historico_primeira_pagina'].append(cronometrar(
+                    tracker.obter_pagina_historico, guild_id, user_id,
+                    ITENS_POR_PAGINA))
+                if meio is not None:
+                    tempos['historico_pagina_do_meio'].append(cronometrar(
+                        tracker.obter_pagina_historico, guild_id, user_id,
+                        ITENS_POR_PAGINA, tuple(meio)))
+                tempos['historico_ultima_pagina'].append(cronometrar(
+                    tracker.obter_ultima_pagina_historico, guild_id, user_id,
+                    restantes))
+
+                # Como o PaginationView: cada página parte da chave da anterior
+                inicio = time.perf_counter()
+                pagina = tracker.obter_pagina_historico(guild_id, user_id,
+                                                        ITENS_POR_PAGINA)
+                for _ in range(4):
+                    if not pagina:
+                        break
+                    ultima = pagina[-1]
+                    pagina = tracker.obter_pagina_historico(
+                        guild_id, user_id, ITENS_POR_PAGINA,
+                        (ultima[4], ultima[0]))
+                tempos['historico_navegacao_5_paginas'].append(
+                    time.perf_counter() - inicio)
+        for nome, amostras in tempos.items():
+            medir(nome, classe, amostras)
+
+    # Rankings: sem cache (invalidado a cada chamada) e com o cache quente
+    for periodo in (None, ) + PERIODOS:
+        nome = 'ranking' if periodo is None else f'ranking_{periodo}'
+        frio, quente = [], []
+        for _ in range(args.repeticoes):
+            cache.invalidar()
+            if periodo is None:
+                frio.append(cronometrar(tracker.obter_ranking, guild_id, 10))
+                quente.append(cronometrar(tracker.obter_ranking, guild_id, 10))
+            else:
+                frio.append(cronometrar(tracker.obter_ranking_periodo, guild_id,
+                                        periodo, 10))
+                quente.append(cronometrar(tracker.obter_ranking_periodo,
+                                          guild_id, periodo, 10))
+        medir(nome, 'cache_frio', frio)
+        medir(nome, 'cache_quente', quente)
+
+    # Resets por último: apagam os usuários amostrados
+    if not args.sem_reset:
+        for classe, usuarios in classes.items():
+            medir('reset_user_calls', classe, [
+                cronometrar(tracker.reset_user_calls, guild_id, user_id)
+                for user_id, _ in usuarios])
+
+    perfil_sql = tracker.relatorio_sql(20)
+    tracker.fechar()
+    return {
+        'banco': {
+            'sessoes': total_sessoes,
+            'usuarios': total_usuarios,
+            'tamanho_mb': os.path.getsize(db_path) / 1024 / 1024,
+            'abertura_s': abertura,
+            'sessoes_amostradas': {classe: [n for _, n in usuarios]
+                                   for classe, usuarios in classes.items()}
+        },
+        'consultas_ms': consultas,
+        'perfil_sql': perfil_sql
+    }
+
+
+def copiar_banco(origem, destino):
+    for sufixo in ('', '-wal', '-shm'):
+        if os.path.exists(origem + sufixo):
+            shutil.copyfile(origem + sufixo, destino + sufixo)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Latência das consultas de chamadas em bancos grandes.")
+    parser.add_argument('--sessoes', default="100k",
+                        help="Tamanhos a gerar, separados por vírgula: 100k,1M,10M (padrão: 100k)")
+    parser.add_argument('--banco', action='append', default=[],
+                        help="Banco já existente a medir (pode repetir); substitui --sessoes")
+    parser.add_argument('--amostras', type=int, default=10,
+                        help="Usuários por classe (padrão: 10)")
+    parser.add_argument('--repeticoes', type=int, default=5,
+                        help="Repetições de cada consulta por usuário (padrão: 5)")
+    parser.add_argument('--sem-reset', action='store_true',
+                        help="Não mede reset_user_calls")
+    parser.add_argument('--perfil-sql', action='store_true',
+                        help="Coleta o perfil SQL por statement (deixa as medições um pouco mais lentas)")
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--saida', default=None,
+                        help="Arquivo JSON de resultado (padrão: benchmarks/resultados/)")
+    parser.add_argument('--manter-banco', action='store_true',
+                        help="Não apaga o diretório temporário com os bancos gerados")
+    parser.add_argument('--verboso', action='store_true',
+                        help="Mostra os logs do bot")
+    args = parser.parse_args()
+
+    saida = os.path.abspath(args.saida or caminho_padrao("consultas"))
+    bancos = [os.path.abspath(banco) for banco in args.banco]
+    for banco in bancos:
+        if not os.path.exists(banco):
+            parser.error(f"Banco não encontrado: {banco}")
+
+    medbot, diretorio = importar_bot(verboso=args.verboso)
+    medbot.call_tracker.fechar()  # A instância global não é usada
+    resultados = []
+    try:
+        if bancos:
+            alvos = []
+            for indice, banco in enumerate(bancos):
+                copia = os.path.join(diretorio, f"copia_{indice}.db")
+                print(f"Copiando {banco}...")
+                copiar_banco(banco, copia)
+                alvos.append((banco, copia, None))
+        else:
+            alvos = []
+            for tamanho in args.sessoes.split(','):
+                sessoes = ler_quantidade(tamanho)
+                db_path = os.path.join(diretorio, f"consultas_{sessoes}.db")
+                print(f"Gerando {sessoes:,} sessões...")
+                geracao = gerar_banco(medbot, db_path, sessoes,
+                                      semente=args.semente, progresso=True)
+                alvos.append((None, db_path, geracao))
+
+        for origem, db_path, geracao in alvos:
+            resultado = medir_banco(medbot, db_path, args)
+            resultado['banco']['origem'] = origem
+            if geracao is not None:
+                resultado['banco']['geracao'] = geracao
+            resultados.append(resultado)
+            print(f"{resultado['banco']['sessoes']:>12,} sessões  "
+                  f"abertura={resultado['banco']['abertura_s']:.2f}s")
+            for nome, classes in resultado['consultas_ms'].items():
+                resumo = "  ".join(f"{classe}: p50={valores['p50']:.3f} p99={valores['p99']:.3f}"
+                                   for classe, valores in classes.items())
+                print(f"  {nome:32} {resumo}")
+            if resultado['perfil_sql']:
+                print("  Statements mais caros:")
+                print(medbot.formatar_relatorio_sql(resultado['perfil_sql'][:5]))
+    finally:
+        if not args.manter_banco:
+            shutil.rmtree(diretorio, ignore_errors=True)
+
+    parametros = {chave: valor for chave, valor in vars(args).items()
+                  if chave not in ('saida', 'manter_banco', 'verboso')}
+    salvar_resultado(saida, {'benchmark': 'consultas', 'ambiente': ambiente(),
+                             'parametros': parametros, 'bancos': resultados})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""Benchmark de vazão do rastreamento de chamadas.
+
+Gera tráfego de voz sintético (entradas, saídas, trocas de canal e idas ao
+canal AFK) e mede, para cada tamanho inicial da tabela de sessões:
+
+- modo "tracker": chamadas diretas a registrar_entrada/registrar_saida do
+  CallTracker, com uma descarga do diário a cada `--descarga-a-cada` eventos;
+- modo "handler": o on_voice_state_update completo (fila, worker, tracker e
+  montagem dos logs de plantão), com objetos falsos de membro e canal.
+
+O resultado (eventos/s e latências p50/p95/p99) é gravado em JSON para
+comparar execuções. Nada é enviado ao Discord e o banco de produção não é
+tocado: tudo roda em um diretório temporário.
+
+Uso:
+    python benchmarks/benchmark_voz.py --usuarios 500 --eventos 20000 \\
+        --taxa-troca 0.3 --fracao-afk 0.1 --sessoes-iniciais 0,100000
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import time
+from collections import namedtuple
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from comum import (ambiente, caminho_padrao, importar_bot, percentis,
+                   salvar_resultado)
+from gerar_dados import GUILD_ID, gerar_banco
+Canal = namedtuple('Canal', 'id name')
+CANAL_AFK = Canal(900000000000000099, "💤・AFK")
+CANAL_PLANTOES_ID = 900000000000000098
+
+
+class TrafegoVoz:
+    """Sequência determinística de eventos (user_id, canal antes, canal depois).
+
+    Um usuário fora de call entra em um canal; um usuário em call troca de
+    canal com probabilidade `taxa_troca` ou sai. Cada destino é o canal AFK
+    com probabilidade `fracao_afk`.
+    """
+
+    def __init__(self, usuarios, canais, taxa_troca, fracao_afk, semente):
+        self.usuarios = usuarios
+        self.canais = canais
+        self.taxa_troca = taxa_troca
+        self.fracao_afk = fracao_afk
+        self.rng = random.Random(semente)
+        self.posicao = {}  # {user_id: Canal}
+
+    def _destino(self, atual=None):
+        if atual != CANAL_AFK and self.rng.random() < self.fracao_afk:
+            return CANAL_AFK
+        return self.rng.choice([canal for canal in self.canais if canal != atual])
+
+    def proximo(self):
+        user_id = self.rng.randrange(1, self.usuarios + 1)
+        antes = self.posicao.get(user_id)
+        if antes is None:
+            depois = self._destino()
+        elif self.rng.random() < self.taxa_troca:
+            depois = self._destino(antes)
+        else:
+            depois = None
+        if depois is None:
+            self.posicao.pop(user_id, None)
+        else:
+            self.posicao[user_id] = depois
+        return user_id, antes, depois
+
+
+class DigestFalso:
+    """Recebe os logs de plantão no lugar do DigestPlantao, sem enviar nada."""
+
+    def __init__(self):
+        self.recebidos = 0
+
+    async def registrar(self, canal_id, embed):
+        self.recebidos += 1
+
+
+def criar_canais(quantidade):
+    return [Canal(900000000000000100 + i, f"Canal {i + 1}")
+            for i in range(quantidade)]
+
+
+def abrir_tracker(main, db_path):
+    """CallTracker do cenário, já com os canais AFK e de plantão configurados."""
+    tracker = main.CallTracker(db_path)
+    tracker.config_servidores.atualizar(GUILD_ID, 'canal_afk_id', CANAL_AFK.id)
+    tracker.config_servidores.atualizar(GUILD_ID, 'canal_plantoes_id',
+                                        CANAL_PLANTOES_ID)
+    # O pipeline e o handler consultam a instância global
+    main.call_tracker = tracker
+    return tracker
+
+
+def executar_tracker(main, tracker, trafego, args):
+    latencias = {'evento': [], 'entrada': [], 'saida': [], 'descarga': []}
+    inicio = time.perf_counter()
+    for i in range(args.eventos):
+        if args.ritmo:
+            espera = inicio + i / args.ritmo - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+        user_id, antes, depois = trafego.proximo()
+        nome = f"usuario{user_id}"
+        t0 = time.perf_counter()
+        if antes is not None and antes != CANAL_AFK:
+            tracker.registrar_saida(GUILD_ID, user_id, nome, antes.name)
+            latencias['saida'].append(time.perf_counter() - t0)
+        if depois is not None and depois != CANAL_AFK:
+            t1 = time.perf_counter()
+            tracker.registrar_entrada(GUILD_ID, user_id, nome, depois.name,
+                                      depois.id)
+            latencias['entrada'].append(time.perf_counter() - t1)
+        latencias['evento'].append(time.perf_counter() - t0)
+        if args.descarga_a_cada and (i + 1) % args.descarga_a_cada == 0:
+            t1 = time.perf_counter()
+            tracker.descarregar()
+            latencias['descarga'].append(time.perf_counter() - t1)
+    t1 = time.perf_counter()
+    tracker.descarregar()
+    latencias['descarga'].append(time.perf_counter() - t1)
+    duracao = time.perf_counter() - inicio
+    return duracao, {'latencias_ms': {op: percentis(amostras)
+                                      for op, amostras in latencias.items()}}
+
+
+async def executar_handler(main, tracker, trafego, args):
+    main.call_tracker_async = main.AsyncCallTracker(tracker)
+    digest = DigestFalso()
+    main.pipeline_voz = main.PipelineVoz(main.call_tracker_async, digest)
+    guild = SimpleNamespace(id=GUILD_ID)
+    membros = {
+        user_id: SimpleNamespace(
+            id=user_id, bot=False, guild=guild,
+            display_name=f"usuario{user_id}", mention=f"<@{user_id}>",
+            display_avatar=SimpleNamespace(url="https://cdn.discordapp.com/embed/avatars/0.png"))
+        for user_id in range(1, args.usuarios + 1)
+    }
+
+    latencias = []
+    inicio = time.perf_counter()
+    for i in range(args.eventos):
+        if args.ritmo:
+            espera = inicio + i / args.ritmo - time.perf_counter()
+            if espera > 0:
+                await asyncio.sleep(espera)
+        user_id, antes, depois = trafego.proximo()
+        t0 = time.perf_counter()
+        await main.on_voice_state_update(membros[user_id],
+                                         SimpleNamespace(channel=antes),
+                                         SimpleNamespace(channel=depois))
+        latencias.append(time.perf_counter() - t0)
+    await main.pipeline_voz.esvaziar()
+    t0 = time.perf_counter()
+    await main.call_tracker_async.descarregar()
+    descarga = time.perf_counter() - t0
+    duracao = time.perf_counter() - inicio
+
+    stats = main.pipeline_voz.estatisticas()
+    await main.pipeline_voz.parar()
+    await main.call_tracker_async.fechar()
+    return duracao, {
+        'latencias_ms': {'handler': percentis(latencias),
+                         'descarga': percentis([descarga])},
+        'pipeline': {
+            'lotes': stats['lotes'],
+            'esperas_fila_cheia': stats['esperas_fila_cheia'],
+            'logs_gerados': digest.recebidos,
+            'etapas_ms': {etapa: {chave: valor * 1000
+                                  for chave, valor in tempos.items()}
+                          for etapa, tempos in stats['etapas'].items()}
+        }
+    }
+
+
+def executar_cenario(main, diretorio, modo, sessoes_iniciais, args):
+    db_path = os.path.join(diretorio, f"bench_{modo}_{sessoes_iniciais}.db")
+    canais = criar_canais(args.canais)
+    gerar_banco(main, db_path, sessoes_iniciais, args.usuarios,
+                semente=args.semente)
+    tracker = abrir_tracker(main, db_path)
+    trafego = TrafegoVoz(args.usuarios, canais, args.taxa_troca,
+                         args.fracao_afk, args.semente)
+    if modo == "tracker":
+        duracao, detalhes = executar_tracker(main, tracker, trafego, args)
+        tracker.fechar()
+    else:
+        duracao, detalhes = asyncio.run(
+            executar_handler(main, tracker, trafego, args))
+    resultado = {
+        'modo': modo,
+        'sessoes_iniciais': sessoes_iniciais,
+        'eventos': args.eventos,
+        'duracao_s': duracao,
+        'eventos_por_s': args.eventos / duracao if duracao else 0.0,
+        'usuarios_em_call_no_fim': len(trafego.posicao),
+    }
+    resultado.update(detalhes)
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark de vazão do rastreamento de chamadas de voz.")
+    parser.add_argument('--usuarios', type=int, default=200,
+                        help="Usuários distintos no tráfego (padrão: 200)")
+    parser.add_argument('--eventos', type=int, default=20000,
+                        help="Eventos de voz por cenário (padrão: 20000)")
+    parser.add_argument('--canais', type=int, default=6,
+                        help="Canais de voz, sem contar o AFK (padrão: 6)")
+    parser.add_argument('--taxa-troca', type=float, default=0.3,
+                        help="Chance de quem está em call trocar de canal em vez de sair (padrão: 0.3)")
+    parser.add_argument('--fracao-afk', type=float, default=0.1,
+                        help="Chance de o destino ser o canal AFK (padrão: 0.1)")
+    parser.add_argument('--ritmo', type=float, default=0,
+                        help="Eventos por segundo; 0 = o mais rápido possível")
+    parser.add_argument('--modos', default="tracker,handler",
+                        help="Modos separados por vírgula: tracker, handler")
+    parser.add_argument('--sessoes-iniciais', default="0",
+                        help="Tamanhos iniciais da tabela de sessões, separados por vírgula")
+    parser.add_argument('--descarga-a-cada', type=int, default=200,
+                        help="Eventos entre descargas do diário no modo tracker (padrão: 200)")
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--saida', default=None,
+                        help="Arquivo JSON de resultado (padrão: benchmarks/resultados/)")
+    parser.add_argument('--manter-banco', action='store_true',
+                        help="Não apaga o diretório temporário com os bancos gerados")
+    parser.add_argument('--verboso', action='store_true',
+                        help="Mostra os logs do bot")
+    args = parser.parse_args()
+
+    saida = os.path.abspath(args.saida or caminho_padrao("voz"))
+    modos = [modo.strip() for modo in args.modos.split(',') if modo.strip()]
+    for modo in modos:
+        if modo not in ("tracker", "handler"):
+            parser.error(f"Modo desconhecido: {modo}")
+    tamanhos = [int(tamanho) for tamanho in args.sessoes_iniciais.split(',')]
+
+    medbot, diretorio = importar_bot(verboso=args.verboso)
+    medbot.call_tracker.fechar()  # A instância global não é usada
+    try:
+        cenarios = []
+        for sessoes_iniciais in tamanhos:
+            for modo in modos:
+                resultado = executar_cenario(medbot, diretorio, modo,
+                                             sessoes_iniciais, args)
+                cenarios.append(resultado)
+                latencia = resultado['latencias_ms'].get(
+                    'evento', resultado['latencias_ms'].get('handler'))
+                print(f"{modo:8} sessões={sessoes_iniciais:<9} "
+                      f"{resultado['eventos_por_s']:10.0f} eventos/s  "
+                      f"p50={latencia['p50']:.3f} ms  p95={latencia['p95']:.3f} ms  "
+                      f"p99={latencia['p99']:.3f} ms")
+    finally:
+        if not args.manter_banco:
+            shutil.rmtree(diretorio, ignore_errors=True)
+
+    parametros = {chave: valor for chave, valor in vars(args).items()
+                  if chave not in ('saida', 'manter_banco', 'verboso')}
+    salvar_resultado(saida, {'benchmark': 'voz', 'ambiente': ambiente(),
+                             'parametros': parametros, 'cenarios': cenarios})
+
+
+if __name__ == "__main__":
+    main()
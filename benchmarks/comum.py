@@ -0,0 +1,85 @@
+"""Utilidades compartilhadas pelos benchmarks do MedBot."""
+import json
+import logging
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+# Raiz do repositório (onde fica o main.py)
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def importar_bot(diretorio=None, verboso=False):
+    """Importa o main.py com o diretório de trabalho em `diretorio`.
+
+    Ao ser importado, o main.py abre call_tracker.db e bot.log no diretório
+    atual; por padrão é usado um diretório temporário para que o benchmark
+    nunca toque no banco de produção. Retorna (módulo, diretório).
+    """
+    diretorio = diretorio or tempfile.mkdtemp(prefix="medbot_bench_")
+    os.makedirs(diretorio, exist_ok=True)
+    os.chdir(diretorio)
+    if RAIZ not in sys.path:
+        sys.path.insert(0, RAIZ)
+    import main
+    if not verboso:
+        logging.getLogger().setLevel(logging.WARNING)
+    return main, diretorio
+
+
+def percentis(amostras):
+    """Resumo de uma lista de durações em segundos, em milissegundos."""
+    if not amostras:
+        return {'n': 0, 'media': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0,
+                'max': 0.0}
+    ordenadas = sorted(amostras)
+    n = len(ordenadas)
+
+    def percentil(p):
+        return ordenadas[min(n - 1, int(p * n))] * 1000
+
+    return {
+        'n': n,
+        'media': sum(ordenadas) / n * 1000,
+        'p50': percentil(0.50),
+        'p95': percentil(0.95),
+        'p99': percentil(0.99),
+        'max': ordenadas[-1] * 1000
+    }
+
+
+def ambiente():
+    """Versões e máquina em que o benchmark rodou, para comparar execuções."""
+    try:
+        commit = subprocess.run(['git', '-C', RAIZ, 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True,
+                                timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+
+def salvar_resultado(caminho, resultado):
+    """Grava o resultado em JSON (cria o diretório se preciso)."""
+    diretorio = os.path.dirname(os.path.abspath(caminho))
+    os.makedirs(diretorio, exist_ok=True)
+    with open(caminho, 'w', encoding='utf-8') as arquivo:
+        json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+    print(f"Resultado gravado em {caminho}")
+
+
+def caminho_padrao(nome):
+    """benchmarks/resultados/<nome>-<data>.json"""
+    data = datetime.now().strftime('%Y%m%d-%H%M%S')
+    return os.path.join(RAIZ, 'benchmarks', 'resultados', f"{nome}-{data}.json")
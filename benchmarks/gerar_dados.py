@@ -0,0 +1,214 @@
+"""Gerador de bancos de chamadas com histórico grande, para testes de escala.
+
+Cria um call_tracker.db com o esquema atual (todas as migrações do main.py)
+e `--sessoes` sessões finalizadas distribuídas pelos últimos `--dias` dias.
+Os usuários seguem uma distribuição de Zipf: poucos usuários concentram
+a maior parte das sessões e a maioria aparece pouco. O horário segue um
+perfil diário com pico à noite e a duração segue uma log-normal (mediana de
+20 minutos, máximo de 8 horas). call_stats e call_daily são preenchidos de
+forma consistente com as sessões.
+
+Uso:
+    python benchmarks/gerar_dados.py --sessoes 1M --saida call_tracker_1m.db
+"""
+import argparse
+import bisect
+import itertools
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from comum import importar_bot
+
+GUILD_ID = 900000000000000001
+
+# Peso relativo de cada hora do dia (0h a 23h) na entrada das sessões
+PERFIL_HORARIO = [2, 1, 1, 1, 1, 1, 2, 3, 4, 5, 5, 5,
+                  6, 6, 6, 6, 7, 8, 10, 12, 13, 12, 8, 4]
+
+# Peso relativo de cada dia da semana (segunda a domingo)
+PERFIL_SEMANAL = [1.0, 1.0, 1.0, 1.0, 1.1, 1.4, 1.3]
+
+DURACAO_MAXIMA = 8 * 3600
+
+
+def ler_quantidade(valor):
+    """Converte '100k', '1M' ou '10M' (ou um número) em inteiro."""
+    valor = valor.strip().lower().replace('_', '')
+    multiplicador = {'k': 1000, 'm': 1000000}.get(valor[-1:], 1)
+    if multiplicador != 1:
+        valor = valor[:-1]
+    return int(float(valor) * multiplicador)
+
+
+def pesos_zipf(usuarios, expoente):
+    """Pesos acumulados de Zipf: o usuário 1 é o mais ativo."""
+    return list(itertools.accumulate(1 / (posicao ** expoente)
+                                     for posicao in range(1, usuarios + 1)))
+
+
+def gerar_banco(main, db_path, sessoes, usuarios=None, servidores=(GUILD_ID, ),
+                dias=365, expoente=1.1, semente=42, progresso=False):
+    """Cria `db_path` com `sessoes` sessões finalizadas e retorna um resumo.
+
+    Os user_ids vão de 1 a `usuarios` em cada servidor, em ordem decrescente
+    de atividade. Por padrão há um usuário para cada 100 sessões.
+    """
+    usuarios = usuarios or max(100, sessoes // 100)
+    main.CallTracker(db_path).fechar()  # Esquema e migrações
+    if not sessoes:
+        return {'sessoes': 0, 'usuarios': 0, 'servidores': len(servidores)}
+
+    rng = random.Random(semente)
+    relogio = main.relogio
+    canais = list(main.CANAIS_VOZ.items())
+    acumulados = pesos_zipf(usuarios, expoente)
+    total_pesos = acumulados[-1]
+    horas = list(itertools.accumulate(PERFIL_HORARIO))
+    # Log-normal com mediana de 20 minutos
+    mu, sigma = math.log(1200), 1.1
+
+    agora = relogio.agora()
+    hoje = relogio.dia_local(agora)
+    calendario = [hoje - timedelta(days=dias - 1 - i) for i in range(dias)]
+    pesos_dias = [PERFIL_SEMANAL[dia.weekday()] for dia in calendario]
+    soma_pesos_dias = sum(pesos_dias)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    stats = {}  # {(guild_id, user_id): [segundos, sessoes, primeira, ultima]}
+    geradas = 0
+    inicio_geracao = time.monotonic()
+    try:
+        for indice, dia in enumerate(calendario):
+            if indice == len(calendario) - 1:
+                quantidade = sessoes - geradas
+            else:
+                quantidade = round(sessoes * pesos_dias[indice] / soma_pesos_dias)
+                quantidade = min(quantidade, sessoes - geradas)
+            inicio_dia, fim_dia = relogio.limites_do_dia(dia)
+            limite = min(fim_dia, agora - 60)
+
+            linhas = []
+            consolidado = {}
+            for _ in range(quantidade):
+                guild_id = servidores[rng.randrange(len(servidores))]
+                user_id = bisect.bisect_left(acumulados,
+                                             rng.random() * total_pesos) + 1
+                hora = bisect.bisect_right(horas, rng.random() * horas[-1])
+                entrada = min(inicio_dia + hora * 3600 + rng.randrange(3600),
+                              limite - 1)
+                duracao = min(DURACAO_MAXIMA,
+                              max(1, int(rng.lognormvariate(mu, sigma))))
+                saida = min(entrada + duracao, agora)
+                duracao = saida - entrada
+                canal, canal_id = canais[rng.randrange(len(canais))]
+                linhas.append((guild_id, user_id, f"usuario{user_id}", canal,
+                               canal_id, entrada, saida, duracao, saida))
+
+                if saida <= fim_dia:
+                    chave = (guild_id, user_id, dia.isoformat(), canal)
+                    valores = consolidado.setdefault(chave, [0, 0])
+                    valores[0] += duracao
+                    valores[1] += 1
+                else:
+                    main.acumular_por_dia(consolidado, guild_id, user_id, canal,
+                                          entrada, saida)
+                total = stats.get((guild_id, user_id))
+                if total is None:
+                    stats[(guild_id, user_id)] = [duracao, 1, entrada, saida]
+                else:
+                    total[0] += duracao
+                    total[1] += 1
+                    total[2] = min(total[2], entrada)
+                    total[3] = max(total[3], saida)
+
+            # Ordem cronológica, como no banco de produção
+            linhas.sort(key=lambda linha: linha[5])
+            with conn:
+                conn.executemany('''
+                    INSERT INTO call_sessions (guild_id, user_id, user_name,
+                                               canal, canal_id, entrada, saida,
+                                               duracao_segundos, last_seen)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', linhas)
+                conn.executemany(main.SQL_SOMAR_CALL_DAILY,
+                                 [(*chave, segundos, n)
+                                  for chave, (segundos, n) in consolidado.items()])
+            decil = geradas * 10 // sessoes
+            geradas += quantidade
+            if progresso and geradas * 10 // sessoes > decil:
+                print(f"  {geradas:,} de {sessoes:,} sessões "
+                      f"({time.monotonic() - inicio_geracao:.0f}s)")
+
+        with conn:
+            conn.executemany('''
+                INSERT INTO call_stats (guild_id, user_id, user_name,
+                                        total_segundos, total_sessoes,
+                                        primeira_call, ultima_call, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(guild_id, user_id, f"usuario{user_id}", segundos, n,
+                   primeira, ultima, ultima)
+                  for (guild_id, user_id), (segundos, n, primeira, ultima)
+                  in stats.items()])
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+    return {
+        'sessoes': geradas,
+        'usuarios': len(stats),
+        'servidores': len(servidores),
+        'dias': dias,
+        'expoente_zipf': expoente,
+        'geracao_s': time.monotonic() - inicio_geracao,
+        'tamanho_mb': os.path.getsize(db_path) / 1024 / 1024
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Gera um call_tracker.db com histórico sintético grande.")
+    parser.add_argument('--sessoes', default="100k",
+                        help="Quantidade de sessões: 100k, 1M, 10M... (padrão: 100k)")
+    parser.add_argument('--usuarios', type=int, default=None,
+                        help="Usuários por servidor (padrão: 1 a cada 100 sessões)")
+    parser.add_argument('--servidores', type=int, default=1,
+                        help="Quantidade de servidores (padrão: 1)")
+    parser.add_argument('--dias', type=int, default=365,
+                        help="Dias de histórico (padrão: 365)")
+    parser.add_argument('--expoente', type=float, default=1.1,
+                        help="Expoente de Zipf; maior = atividade mais concentrada (padrão: 1.1)")
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--saida', required=True, help="Arquivo .db a criar")
+    parser.add_argument('--sobrescrever', action='store_true',
+                        help="Apaga o arquivo de saída se ele já existir")
+    args = parser.parse_args()
+
+    saida = os.path.abspath(args.saida)
+    if os.path.exists(saida):
+        if not args.sobrescrever:
+            parser.error(f"{saida} já existe (use --sobrescrever)")
+        for sufixo in ('', '-wal', '-shm'):
+            if os.path.exists(saida + sufixo):
+                os.remove(saida + sufixo)
+
+    sessoes = ler_quantidade(args.sessoes)
+    servidores = tuple(GUILD_ID + i for i in range(args.servidores))
+    medbot, _ = importar_bot()
+    medbot.call_tracker.fechar()  # A instância global não é usada
+    print(f"Gerando {sessoes:,} sessões em {saida}...")
+    resumo = gerar_banco(medbot, saida, sessoes, args.usuarios, servidores,
+                         args.dias, args.expoente, args.semente, progresso=True)
+    print(f"Pronto: {resumo['sessoes']:,} sessões, {resumo['usuarios']:,} usuários, "
+          f"{resumo['tamanho_mb']:.1f} MB em {resumo['geracao_s']:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
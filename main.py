@@ -7,18 +7,35 @@ from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import os
 import json
+import bisect
 import sqlite3
+import time
+import threading
+import queue
+import functools
+import heapq
+import io
+import math
+import secrets
+import signal
+import subprocess
+import sys
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import pytz
 
-# Configuração de logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ],
-    encoding='utf-8')
+from medbot.armazem import ClienteArmazem, ServidorArmazem, chave_armazem
+from medbot.logs import configurar_logs
+from medbot.metricas import (Histograma, RegistroDesempenho, ServidorMetricas,
+                             cronometrar_http, medicao_atual)
+from medbot.perfil_sql import ConexaoPerfilada, PerfilSQL, formatar_relatorio_sql
+from medbot.views import CachePaginas, RegistroViews
+
+# ============== LOGS ==============
+
+# Fila, rotação e formato configurados por MEDBOT_LOG_* (ver medbot/logs.py)
+ouvinte_logs = configurar_logs()
 logger = logging.getLogger(__name__)
 
 # ============== CONSTANTES E CONFIGURAÇÕES ==============
@@ -43,12 +60,6 @@ CANAIS_TEXTO = {
     "entrevistas-agendadas": 1389791431010418778
 }
 
-# IDs dos cargos
-CARGOS_IDS = {
-    "Estagiário": 1389789893181444116,
-    "Visitante/Observador": 1390158085808586752
-}
-
 # Fuso horário de São Paulo
 TZ_SAO_PAULO = pytz.timezone('America/Sao_Paulo')
 
@@ -58,244 +69,1721 @@ DADOS_TEMPO_FILE = "dados_tempo_call.json"
 # URL do GIF de branding
 SP_CAPITAL_GIF_URL = "https://cdn.discordapp.com/attachments/1388624317159440536/1388624464694087700/SP_Capital_GIF.gif"
 
-# ID do canal para logs de plantão
-CANAL_CONTROLE_PLANTOES_ID = 1389792336363655168 # sp-capital-controle-de-plantões
-CANAL_MODERACAO_ID = 1389792372983992420 # moderação-e-disciplinas
-
-# IDs de Cargos de Punição
-CARGO_PUNICAO_1_ID = 1389790132160434227
-CARGO_PUNICAO_2_ID = 1389790188452184226
-
-# Estrutura Hierárquica de Cargos
-HIERARQUIA_CARGOS = [
-    {"nome": "Direção", "id": 1389788983214604338, "emoji": "🎖️"},
-    {"nome": "Responsável HP", "id": 1389789535097061426, "emoji": "🛡️"},
-    {"nome": "Auxiliar HP", "id": 1389789661769240606, "emoji": "🧰"},
-    {"nome": "Diretor", "id": 1389789326287573013, "emoji": "🧠"},
-    {"nome": "Vice Diretor", "id": 1389789427542397083, "emoji": "🧪"},
-    {"nome": "Paramédico", "id": 1389789708539920517, "emoji": "🚑"},
-    {"nome": "Médico", "id": 1389789787325730948, "emoji": "🩺"},
-    {"nome": "Enfermeiro", "id": 1389789872134553650, "emoji": "💉"},
-    {"nome": "Estagiário", "id": 1389789893181444116, "emoji": "🧪"},
-    {"nome": "Visitante/Observador", "id": 1390158085808586752, "emoji": "🧾"}
-]
-
-# IDs de Cargos Profissionais (para o comando !setar)
-CARGOS_SETAveis_IDS = {
-    1389789708539920517, # Paramédico
-    1389789787325730948, # Médico
-    1389789872134553650  # Enfermeiro
-}
-
 # Cores Padrão
 COR_PRINCIPAL = discord.Color.dark_red()
 COR_VERDE = discord.Color.green()
 COR_LARANJA = discord.Color.orange()
 
+# Configurações opcionais lidas do ambiente (.env)
+load_dotenv()
+
+# Janela de durabilidade das escritas de chamadas (write-behind)
+DIARIO_INTERVALO_MS = int(os.getenv("MEDBOT_DIARIO_INTERVALO_MS", "500"))
+DIARIO_MAX_EVENTOS = int(os.getenv("MEDBOT_DIARIO_MAX_EVENTOS", "200"))
+
+# Intervalo do checkpoint das sessões abertas: limita o tempo creditado
+# indevidamente se o processo cair
+CHECKPOINT_INTERVALO_S = float(os.getenv("MEDBOT_CHECKPOINT_INTERVALO_S", "60"))
+
+# Logs de plantão: "evento" (um envio por evento), "digest" (até 10 embeds
+# por mensagem) ou "resumo" (um embed com uma linha por evento)
+MODO_LOG_PLANTAO = os.getenv("MEDBOT_MODO_LOG_PLANTAO", "digest")
+INTERVALO_DIGEST_PLANTAO = float(os.getenv("MEDBOT_INTERVALO_DIGEST_PLANTAO", "5"))
+
+# Fila de eventos de voz: capacidade (acima dela o gateway espera) e
+# quantidade máxima de eventos aplicados de uma vez
+FILA_VOZ_CAPACIDADE = int(os.getenv("MEDBOT_FILA_VOZ_CAPACIDADE", "1000"))
+FILA_VOZ_LOTE = int(os.getenv("MEDBOT_FILA_VOZ_LOTE", "50"))
+
+# Modo multiprocesso: o lançador (MEDBOT_PAPEL=lancador) inicia um processo
+# "armazem", único dono do banco de chamadas, e MEDBOT_CLUSTERS processos
+# "cluster", cada um com uma fatia dos MEDBOT_TOTAL_SHARDS shards. Sem
+# MEDBOT_PAPEL o bot roda em um único processo, como sempre rodou.
+PAPEL_PROCESSO = os.getenv("MEDBOT_PAPEL", "unico")
+TOTAL_CLUSTERS = int(os.getenv("MEDBOT_CLUSTERS", "2"))
+TOTAL_SHARDS = int(os.getenv("MEDBOT_TOTAL_SHARDS", "2"))
+CLUSTER_ID = int(os.getenv("MEDBOT_CLUSTER_ID", "0"))
+ENDERECO_ARMAZEM = os.getenv("MEDBOT_ARMAZEM_ENDERECO", "medbot_armazem.sock")
+INTERVALO_SAUDE_S = float(os.getenv("MEDBOT_INTERVALO_SAUDE_S", "15"))
+
+# Endpoint de métricas no formato do Prometheus (só em localhost). Porta 0
+# desativa; nos clusters, cada um usa a porta + id do cluster.
+METRICAS_PORTA = int(os.getenv("MEDBOT_METRICAS_PORTA", "0"))
+METRICAS_HOST = os.getenv("MEDBOT_METRICAS_HOST", "127.0.0.1")
+
+# Páginas renderizadas do !consultar e da !hierarquia mantidas em memória
+CACHE_PAGINAS_CAPACIDADE = int(os.getenv("MEDBOT_CACHE_PAGINAS", "512"))
+
+# Limite de views interativas abertas (paginação, hierarquia, ajuda), por
+# usuário e no total. As mais antigas são encerradas e têm os botões desativados.
+VIEWS_POR_USUARIO = int(os.getenv("MEDBOT_VIEWS_POR_USUARIO", "3"))
+VIEWS_MAXIMO = int(os.getenv("MEDBOT_VIEWS_MAXIMO", "200"))
+
+# Servidor dono dos dados anteriores à separação por servidor. Sem ele, os
+# dados só são adotados se o canal de plantões original identificar o
+# servidor ou se o bot estiver em um único servidor.
+GUILD_LEGADO_CONFIGURADO = int(os.getenv("MEDBOT_GUILD_LEGADO", "0"))
+
+# Perfil das consultas SQL do CallTracker (contagem, tempo, linhas e plano de
+# cada statement, ver !perfsql). Custa alguns microssegundos por consulta.
+PERFIL_SQL = os.getenv("MEDBOT_PERFIL_SQL", "0") == "1"
+
+# ============== MEDIÇÃO DE DESEMPENHO ==============
+
+# Histogramas por comando e callback de interface (ver medbot/metricas.py)
+registro_desempenho = RegistroDesempenho(fuso=TZ_SAO_PAULO)
+
+
+def medir_desempenho(funcao):
+    """Registra as latências de um callback de interface (botão, select ou modal)."""
+
+    @functools.wraps(funcao)
+    async def medido(*args, **kwargs):
+        with registro_desempenho.medir(funcao.__qualname__):
+            return await funcao(*args, **kwargs)
+
+    return medido
+
 # ============== NOVO SISTEMA DE RASTREAMENTO DE CHAMADAS ==============
 
 
-class CallTracker:
-    """Sistema completo de rastreamento de chamadas de voz"""
+# ============== SERVIÇO DE TEMPO ==============
+
+
+class Relogio:
+    """Serviço central de tempo do rastreamento de chamadas.
+
+    Instantes são guardados como segundos epoch (inteiros). Durações de
+    sessões abertas nesta execução são medidas com o relógio monotônico,
+    imune a ajustes do NTP. A conversão para o horário de São Paulo fica
+    restrita à exibição e aos limites de dia, que são calculados uma vez
+    por data e reaproveitados.
+    """
+
+    def __init__(self, fuso=TZ_SAO_PAULO):
+        self.fuso = fuso
+        self._limites = {}  # {date: (inicio_epoch, fim_epoch)}
+        self._dia_atual = None  # (inicio_epoch, fim_epoch, date)
+
+    def agora(self):
+        """Instante atual em segundos epoch."""
+        return int(time.time())
+
+    def monotonico(self):
+        return time.monotonic()
+
+    def marcar(self):
+        """Instante atual como (epoch, monotônico), para eventos processados depois."""
+        return self.agora(), self.monotonico()
+
+    def duracao(self, dados_sessao, momento=None):
+        """Duração, em segundos, de uma sessão registrada em usuarios_ativos.
+
+        `momento` é um par (epoch, monotônico) de `marcar()`; por padrão, agora.
+        """
+        agora, agora_mono = momento or self.marcar()
+        entrada_mono = dados_sessao.get('entrada_mono')
+        if entrada_mono is not None:
+            return max(0, int(agora_mono - entrada_mono))
+        # Sessão recuperada do banco: só resta o relógio de parede
+        return max(0, agora - dados_sessao['entrada'])
+
+    def limites_do_dia(self, dia):
+        """(início, fim) em epoch do dia local `dia` em São Paulo."""
+        limites = self._limites.get(dia)
+        if limites is None:
+            inicio = self.fuso.localize(datetime(dia.year, dia.month, dia.day))
+            fim = self.fuso.localize(
+                datetime.combine(dia + timedelta(days=1), datetime.min.time()))
+            limites = (int(inicio.timestamp()), int(fim.timestamp()))
+            self._limites[dia] = limites
+        return limites
+
+    def dia_local(self, epoch):
+        """Data local de São Paulo correspondente a um instante epoch."""
+        atual = self._dia_atual
+        if atual and atual[0] <= epoch < atual[1]:
+            return atual[2]
+        dia = datetime.fromtimestamp(epoch, self.fuso).date()
+        inicio, fim = self.limites_do_dia(dia)
+        if inicio <= self.agora() < fim:
+            self._dia_atual = (inicio, fim, dia)
+        return dia
+
+    def dividir_por_dia(self, entrada, saida):
+        """Divide o intervalo [entrada, saida) em trechos por dia local.
+
+        Retorna uma lista de (data, segundos), cortando nas meias-noites de
+        São Paulo.
+        """
+        trechos = []
+        dia = self.dia_local(entrada)
+        inicio = entrada
+        while True:
+            fim_do_dia = self.limites_do_dia(dia)[1]
+            if saida <= fim_do_dia:
+                trechos.append((dia, saida - inicio))
+                return trechos
+            trechos.append((dia, fim_do_dia - inicio))
+            inicio = fim_do_dia
+            dia = dia + timedelta(days=1)
+
+    def inicio_periodo(self, periodo):
+        """Primeiro dia local do período ('dia', 'semana' ou 'mes') atual."""
+        hoje = self.dia_local(self.agora())
+        if periodo == 'semana':
+            return hoje - timedelta(days=hoje.weekday())
+        if periodo == 'mes':
+            return hoje.replace(day=1)
+        return hoje
+
+    def para_exibicao(self, epoch):
+        """Converte um instante epoch para datetime de São Paulo (só para exibição)."""
+        if epoch is None:
+            return None
+        return datetime.fromtimestamp(epoch, self.fuso)
+
+
+def iso_para_epoch(valor):
+    """Converte um timestamp ISO-8601 legado para segundos epoch."""
+    if valor is None:
+        return None
+    if isinstance(valor, (int, float)):
+        return int(valor)
+    data = datetime.fromisoformat(valor)
+    if data.tzinfo is None:
+        data = TZ_SAO_PAULO.localize(data)
+    return int(data.timestamp())
+
+
+relogio = Relogio()
+
+
+def _migrar_timestamps_epoch(conn):
+    """Reescreve sessões e estatísticas com ids INTEGER e instantes epoch."""
+    conn.create_function("iso_para_epoch", 1, iso_para_epoch)
+
+    conn.execute('''
+        CREATE TABLE call_sessions_nova (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            canal TEXT NOT NULL,
+            canal_id INTEGER,
+            entrada INTEGER NOT NULL,
+            saida INTEGER,
+            duracao_segundos INTEGER,
+            created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO call_sessions_nova
+            (id, user_id, user_name, canal, entrada, saida, duracao_segundos, created_at)
+        SELECT id, CAST(user_id AS INTEGER), user_name, canal,
+               iso_para_epoch(entrada), iso_para_epoch(saida), duracao_segundos,
+               CAST(strftime('%s', created_at) AS INTEGER)
+        FROM call_sessions
+    ''')
+    conn.execute("DROP TABLE call_sessions")
+    conn.execute("ALTER TABLE call_sessions_nova RENAME TO call_sessions")
+
+    conn.execute('''
+        CREATE TABLE call_stats_nova (
+            user_id INTEGER PRIMARY KEY,
+            user_name TEXT NOT NULL,
+            total_segundos INTEGER NOT NULL DEFAULT 0,
+            total_sessoes INTEGER NOT NULL DEFAULT 0,
+            primeira_call INTEGER,
+            ultima_call INTEGER,
+            updated_at INTEGER
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO call_stats_nova
+        SELECT CAST(user_id AS INTEGER), user_name, total_segundos, total_sessoes,
+               iso_para_epoch(primeira_call), iso_para_epoch(ultima_call),
+               iso_para_epoch(updated_at)
+        FROM call_stats
+    ''')
+    conn.execute("DROP TABLE call_stats")
+    conn.execute("ALTER TABLE call_stats_nova RENAME TO call_stats")
+
+    # Os índices caem junto com as tabelas antigas
+    conn.execute('''
+        CREATE INDEX idx_call_sessions_abertas
+        ON call_sessions (user_id, entrada)
+        WHERE saida IS NULL
+    ''')
+    conn.execute('''
+        CREATE INDEX idx_call_sessions_finalizadas
+        ON call_sessions (user_id, entrada)
+        WHERE saida IS NOT NULL
+    ''')
+    conn.execute('''
+        CREATE INDEX idx_call_stats_total
+        ON call_stats (total_segundos, user_id)
+    ''')
+
+
+SQL_SOMAR_CALL_DAILY = '''
+    INSERT INTO call_daily (guild_id, user_id, dia, canal, segundos, sessoes)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(guild_id, user_id, dia, canal) DO UPDATE SET
+        segundos = segundos + excluded.segundos,
+        sessoes = sessoes + excluded.sessoes
+'''
+
+
+def acumular_por_dia(consolidado, guild_id, user_id, canal, entrada, saida,
+                     sessoes=1):
+    """Soma uma sessão em {(guild_id, user_id, dia, canal): [segundos, sessoes]}.
+
+    A sessão conta no dia em que começou; o tempo é dividido entre os dias.
+    """
+    for i, (dia, segundos) in enumerate(relogio.dividir_por_dia(entrada, saida)):
+        chave = (guild_id, user_id, dia.isoformat(), canal)
+        acumulado = consolidado.setdefault(chave, [0, 0])
+        acumulado[0] += segundos
+        if i == 0:
+            acumulado[1] += sessoes
+
+
+def preencher_call_daily(conn):
+    """Recalcula call_daily a partir de todas as sessões finalizadas."""
+    consolidado = {}
+    cursor = conn.execute('''
+        SELECT guild_id, user_id, canal, entrada, saida
+        FROM call_sessions
+        WHERE saida IS NOT NULL
+    ''')
+    for guild_id, user_id, canal, entrada, saida in cursor:
+        acumular_por_dia(consolidado, guild_id, user_id, canal, entrada,
+                         max(entrada, saida))
+    conn.execute("DELETE FROM call_daily")
+    conn.executemany(SQL_SOMAR_CALL_DAILY,
+                     [(*chave, segundos, sessoes)
+                      for chave, (segundos, sessoes) in consolidado.items()])
+    return len(consolidado)
+
+
+# ============== CONFIGURAÇÃO POR SERVIDOR ==============
+
+# Canais e cargos de um servidor, lidos da tabela guild_config
+ConfigServidor = namedtuple('ConfigServidor', [
+    'guild_id', 'canal_plantoes_id', 'canal_moderacao_id', 'canal_afk_id',
+    'canal_logs_inscricao_id', 'cargo_punicao_1_id', 'cargo_punicao_2_id',
+    'cargos', 'hierarquia', 'cargos_setaveis'
+])
+
+# Servidor sem linha em guild_config: nada configurado
+CONFIG_VAZIA = ConfigServidor(None, None, None, None, None, None, None, {}, [],
+                              frozenset())
+
+# Guild dos dados anteriores à migração 6, até a adoção no on_ready
+GUILD_LEGADO_ID = 0
+
+# Configuração do servidor original, gravada pela migração 6
+CONFIG_SERVIDOR_ORIGINAL = {
+    "canal_plantoes_id": 1389792336363655168,  # sp-capital-controle-de-plantões
+    "canal_moderacao_id": 1389792372983992420,  # moderação-e-disciplinas
+    "canal_afk_id": 1388624317159440539,  # Canal AFK: o tempo nele não conta
+    "canal_logs_inscricao_id": CANAIS_TEXTO["logs-de-inscrição"],
+    # IDs de Cargos de Punição
+    "cargo_punicao_1_id": 1389790132160434227,
+    "cargo_punicao_2_id": 1389790188452184226,
+    # IDs dos cargos atribuídos na verificação
+    "cargos": {
+        "Estagiário": 1389789893181444116,
+        "Visitante/Observador": 1390158085808586752
+    },
+    # Estrutura Hierárquica de Cargos
+    "hierarquia": [
+        {"nome": "Direção", "id": 1389788983214604338, "emoji": "🎖️"},
+        {"nome": "Responsável HP", "id": 1389789535097061426, "emoji": "🛡️"},
+        {"nome": "Auxiliar HP", "id": 1389789661769240606, "emoji": "🧰"},
+        {"nome": "Diretor", "id": 1389789326287573013, "emoji": "🧠"},
+        {"nome": "Vice Diretor", "id": 1389789427542397083, "emoji": "🧪"},
+        {"nome": "Paramédico", "id": 1389789708539920517, "emoji": "🚑"},
+        {"nome": "Médico", "id": 1389789787325730948, "emoji": "🩺"},
+        {"nome": "Enfermeiro", "id": 1389789872134553650, "emoji": "💉"},
+        {"nome": "Estagiário", "id": 1389789893181444116, "emoji": "🧪"},
+        {"nome": "Visitante/Observador", "id": 1390158085808586752, "emoji": "🧾"}
+    ],
+    # IDs de Cargos Profissionais (para o comando !setar)
+    "cargos_setaveis": [
+        1389789708539920517,  # Paramédico
+        1389789787325730948,  # Médico
+        1389789872134553650  # Enfermeiro
+    ]
+}
+
+
+def _particionar_por_servidor(conn):
+    """Acrescenta guild_id às tabelas de chamadas e cria guild_config.
+
+    Os dados existentes ficam em GUILD_LEGADO_ID até que o bot descubra, no
+    on_ready, a qual servidor eles pertencem.
+    """
+    conn.execute(f'''
+        ALTER TABLE call_sessions
+        ADD COLUMN guild_id INTEGER NOT NULL DEFAULT {GUILD_LEGADO_ID}
+    ''')
+    conn.execute("DROP INDEX IF EXISTS idx_call_sessions_abertas")
+    conn.execute("DROP INDEX IF EXISTS idx_call_sessions_finalizadas")
+    conn.execute('''
+        CREATE INDEX idx_call_sessions_abertas
+        ON call_sessions (guild_id, user_id, entrada)
+        WHERE saida IS NULL
+    ''')
+    conn.execute('''
+        CREATE INDEX idx_call_sessions_finalizadas
+        ON call_sessions (guild_id, user_id, entrada)
+        WHERE saida IS NOT NULL
+    ''')
+
+    conn.execute('''
+        CREATE TABLE call_stats_nova (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            total_segundos INTEGER NOT NULL DEFAULT 0,
+            total_sessoes INTEGER NOT NULL DEFAULT 0,
+            primeira_call INTEGER,
+            ultima_call INTEGER,
+            updated_at INTEGER,
+            PRIMARY KEY (guild_id, user_id)
+        )
+    ''')
+    conn.execute(f'''
+        INSERT INTO call_stats_nova
+        SELECT {GUILD_LEGADO_ID}, user_id, user_name, total_segundos, total_sessoes,
+               primeira_call, ultima_call, updated_at
+        FROM call_stats
+    ''')
+    conn.execute("DROP TABLE call_stats")
+    conn.execute("ALTER TABLE call_stats_nova RENAME TO call_stats")
+    conn.execute('''
+        CREATE INDEX idx_call_stats_total
+        ON call_stats (guild_id, total_segundos, user_id)
+    ''')
+
+    # O consolidado diário é refeito a partir das sessões, já com guild_id
+    conn.execute("DROP TABLE IF EXISTS call_daily")
+    conn.execute('''
+        CREATE TABLE call_daily (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            dia TEXT NOT NULL,
+            canal TEXT NOT NULL,
+            segundos INTEGER NOT NULL DEFAULT 0,
+            sessoes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id, dia, canal)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE INDEX idx_call_daily_dia
+        ON call_daily (guild_id, dia, user_id, segundos, sessoes)
+    ''')
+    preencher_call_daily(conn)
+
+    conn.execute('''
+        CREATE TABLE guild_config (
+            guild_id INTEGER PRIMARY KEY,
+            canal_plantoes_id INTEGER,
+            canal_moderacao_id INTEGER,
+            canal_afk_id INTEGER,
+            canal_logs_inscricao_id INTEGER,
+            cargo_punicao_1_id INTEGER,
+            cargo_punicao_2_id INTEGER,
+            cargos TEXT NOT NULL DEFAULT '{}',
+            hierarquia TEXT NOT NULL DEFAULT '[]',
+            cargos_setaveis TEXT NOT NULL DEFAULT '[]'
+        )
+    ''')
+    config = CONFIG_SERVIDOR_ORIGINAL
+    conn.execute('''
+        INSERT INTO guild_config VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (GUILD_LEGADO_ID, config["canal_plantoes_id"],
+          config["canal_moderacao_id"], config["canal_afk_id"],
+          config["canal_logs_inscricao_id"], config["cargo_punicao_1_id"],
+          config["cargo_punicao_2_id"],
+          json.dumps(config["cargos"], ensure_ascii=False),
+          json.dumps(config["hierarquia"], ensure_ascii=False),
+          json.dumps(config["cargos_setaveis"])))
+
+
+# ============== MIGRAÇÕES DO BANCO DE DADOS ==============
+
+# Cada migração é (versão, descrição, passos). Um passo é um comando SQL ou
+# uma função que recebe a conexão. Novas migrações vão sempre no final.
+MIGRACOES = [
+    (1, "Tabelas de sessões e estatísticas", [
+        '''
+        CREATE TABLE IF NOT EXISTS call_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            user_name TEXT NOT NULL,
+            canal TEXT NOT NULL,
+            entrada DATETIME NOT NULL,
+            saida DATETIME,
+            duracao_segundos INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS call_stats (
+            user_id TEXT PRIMARY KEY,
+            user_name TEXT NOT NULL,
+            total_segundos INTEGER DEFAULT 0,
+            total_sessoes INTEGER DEFAULT 0,
+            primeira_call DATETIME,
+            ultima_call DATETIME,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, "Índices das consultas de sessões e ranking", [
+        # Sessão aberta do usuário (fechamento em registrar_saida)
+        '''
+        CREATE INDEX IF NOT EXISTS idx_call_sessions_abertas
+        ON call_sessions (user_id, entrada)
+        WHERE saida IS NULL
+        ''',
+        # Última sessão e histórico paginado (consultar)
+        '''
+        CREATE INDEX IF NOT EXISTS idx_call_sessions_finalizadas
+        ON call_sessions (user_id, entrada)
+        WHERE saida IS NOT NULL
+        ''',
+        # Ranking e posição no ranking
+        '''
+        CREATE INDEX IF NOT EXISTS idx_call_stats_total
+        ON call_stats (total_segundos, user_id)
+        ''',
+    ]),
+    (3, "Instantes em epoch e ids INTEGER", [_migrar_timestamps_epoch]),
+    (4, "Consolidado diário por usuário e canal", [
+        '''
+        CREATE TABLE IF NOT EXISTS call_daily (
+            user_id INTEGER NOT NULL,
+            dia TEXT NOT NULL,
+            canal TEXT NOT NULL,
+            segundos INTEGER NOT NULL DEFAULT 0,
+            sessoes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, dia, canal)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_call_daily_dia
+        ON call_daily (dia, user_id, segundos, sessoes)
+        ''',
+        # O preenchimento é feito pela migração 6, já separado por servidor
+    ]),
+    (5, "Checkpoint das sessões abertas", [
+        'ALTER TABLE call_sessions ADD COLUMN last_seen INTEGER',
+    ]),
+    (6, "Dados e configuração por servidor", [_particionar_por_servidor]),
+]
+
+# Consultas quentes do rastreamento de chamadas
+SQL_CHECKPOINT_SESSOES = '''
+    UPDATE call_sessions
+    SET last_seen = ?
+    WHERE saida IS NULL
+'''
+
+SQL_FECHAR_SESSAO = '''
+    UPDATE call_sessions 
+    SET saida = ?, duracao_segundos = ?
+    WHERE id = (
+        SELECT id FROM call_sessions
+        WHERE guild_id = ? AND user_id = ? AND saida IS NULL
+        ORDER BY entrada DESC
+        LIMIT 1
+    )
+'''
+
+SQL_ULTIMA_SESSAO = '''
+    SELECT canal, entrada, saida, duracao_segundos
+    FROM call_sessions
+    WHERE guild_id = ? AND user_id = ? AND saida IS NOT NULL
+    ORDER BY entrada DESC
+    LIMIT 1
+'''
+
+# Histórico paginado por chave (entrada, id): primeira página, páginas mais
+# antigas e mais recentes que uma chave e a última página (sessões mais antigas)
+SQL_HISTORICO_PRIMEIRA_PAGINA = '''
+    SELECT id, user_id, user_name, canal, entrada, saida, duracao_segundos
+    FROM call_sessions
+    WHERE guild_id = ? AND user_id = ? AND saida IS NOT NULL
+    ORDER BY entrada DESC, id DESC
+    LIMIT ?
+'''
+
+SQL_HISTORICO_ANTES = '''
+    SELECT id, user_id, user_name, canal, entrada, saida, duracao_segundos
+    FROM call_sessions
+    WHERE guild_id = ? AND user_id = ? AND saida IS NOT NULL AND (entrada, id) < (?, ?)
+    ORDER BY entrada DESC, id DESC
+    LIMIT ?
+'''
+
+SQL_HISTORICO_DEPOIS = '''
+    SELECT id, user_id, user_name, canal, entrada, saida, duracao_segundos
+    FROM call_sessions
+    WHERE guild_id = ? AND user_id = ? AND saida IS NOT NULL AND (entrada, id) > (?, ?)
+    ORDER BY entrada ASC, id ASC
+    LIMIT ?
+'''
+
+SQL_HISTORICO_ULTIMA_PAGINA = '''
+    SELECT id, user_id, user_name, canal, entrada, saida, duracao_segundos
+    FROM call_sessions
+    WHERE guild_id = ? AND user_id = ? AND saida IS NOT NULL
+    ORDER BY entrada ASC, id ASC
+    LIMIT ?
+'''
+
+SQL_CONTAR_HISTORICO = '''
+    SELECT COUNT(*)
+    FROM call_sessions
+    WHERE guild_id = ? AND user_id = ? AND saida IS NOT NULL
+'''
+
+SQL_ESTATISTICAS_USUARIO = '''
+    SELECT total_segundos, total_sessoes, primeira_call, ultima_call
+    FROM call_stats
+    WHERE guild_id = ? AND user_id = ?
+'''
+
+SQL_RANKING = '''
+    SELECT user_id, user_name, total_segundos, total_sessoes, ultima_call
+    FROM call_stats
+    WHERE guild_id = ?
+    ORDER BY total_segundos DESC, user_id DESC
+    LIMIT ?
+'''
+
+SQL_RANKING_PERIODO = '''
+    SELECT p.user_id,
+           (SELECT user_name FROM call_stats s
+            WHERE s.guild_id = ? AND s.user_id = p.user_id),
+           p.total, p.sessoes
+    FROM (SELECT user_id, SUM(segundos) AS total, SUM(sessoes) AS sessoes
+          FROM call_daily INDEXED BY idx_call_daily_dia
+          WHERE guild_id = ? AND dia >= ?
+          GROUP BY user_id
+          ORDER BY total DESC, user_id DESC
+          LIMIT ?) p
+    ORDER BY p.total DESC, p.user_id DESC
+'''
+
+# Consultas que nunca devem fazer varredura completa:
+# (nome, sql, parâmetros, acesso exigido)
+# Agregações sempre ordenam em B-tree temporária; para elas o que se confere
+# é o trecho do plano com o acesso ao índice (ex.: a faixa de datas).
+CONSULTAS_CRITICAS = [
+    ("fechamento de sessão", SQL_FECHAR_SESSAO, (0, 0, 0, 0), None),
+    ("última sessão do usuário", SQL_ULTIMA_SESSAO, (0, 0), None),
+    ("histórico: primeira página", SQL_HISTORICO_PRIMEIRA_PAGINA, (0, 0, 5), None),
+    ("histórico: página anterior", SQL_HISTORICO_ANTES, (0, 0, 0, 0, 5), None),
+    ("histórico: página seguinte", SQL_HISTORICO_DEPOIS, (0, 0, 0, 0, 5), None),
+    ("histórico: última página", SQL_HISTORICO_ULTIMA_PAGINA, (0, 0, 5), None),
+    ("histórico: total de sessões", SQL_CONTAR_HISTORICO, (0, 0),
+     "idx_call_sessions_finalizadas (guild_id=? AND user_id=?)"),
+    ("estatísticas do usuário", SQL_ESTATISTICAS_USUARIO, (0, 0), None),
+    ("ranking", SQL_RANKING, (0, 10), None),
+    ("ranking do período", SQL_RANKING_PERIODO, (0, 0, "2024-01-01", 10),
+     "idx_call_daily_dia (guild_id=? AND dia>?)"),
+    ("checkpoint das sessões abertas", SQL_CHECKPOINT_SESSOES, (0, ), None),
+]
+
+
+def plano_tem_varredura(detalhe):
+    """Indica se uma linha de EXPLAIN QUERY PLAN é uma varredura sem índice."""
+    if "TEMP B-TREE" in detalhe:
+        return True
+    return detalhe.startswith("SCAN") and "INDEX" not in detalhe
+
+
+def plano_inadequado(detalhes, exigido=None):
+    """Indica se o plano (linhas de EXPLAIN QUERY PLAN) não usa o índice esperado.
+
+    Sem acesso exigido, qualquer varredura sem índice reprova o plano; com ele,
+    basta que o trecho apareça em alguma linha.
+    """
+    if exigido is not None:
+        return not any(exigido in detalhe for detalhe in detalhes)
+    return any(plano_tem_varredura(detalhe) for detalhe in detalhes)
+
+
+class GerenciadorConexoes:
+    """Conexões SQLite de longa duração usadas pelo CallTracker.
+
+    Mantém uma única conexão de escrita em modo WAL e um pequeno pool de
+    conexões de leitura. Como as conexões não são fechadas a cada chamada,
+    o cache de statements preparados do sqlite3 é reaproveitado.
+    """
+
+    def __init__(self, db_path, tamanho_pool_leitura=3, cache_statements=128,
+                 perfil=None):
+        self.db_path = db_path
+        self.tamanho_pool_leitura = tamanho_pool_leitura
+        self.cache_statements = cache_statements
+        self.perfil = perfil  # PerfilSQL, ou None fora do modo de perfil
+        self.conexoes_abertas = 0  # Total de conexões abertas desde o início
+        self._lock_escrita = threading.RLock()
+        self._lock_pool = threading.Lock()
+        self._pool_leitura = queue.LifoQueue()
+        self._leitoras = []
+        self._fechado = False
+
+        self._escrita = self._abrir_conexao()
+        self._escrita.execute("PRAGMA journal_mode=WAL")
+        self._escrita.execute("PRAGMA synchronous=NORMAL")
+
+    def _abrir_conexao(self):
+        """Abre uma nova conexão e atualiza o contador."""
+        conn = sqlite3.connect(self.db_path,
+                               check_same_thread=False,
+                               cached_statements=self.cache_statements,
+                               factory=ConexaoPerfilada if self.perfil else sqlite3.Connection)
+        if self.perfil is not None:
+            conn.ativar_perfil(self.perfil)
+        conn.execute("PRAGMA busy_timeout=5000")
+        self.conexoes_abertas += 1
+        return conn
+
+    @contextmanager
+    def escrita(self):
+        """Fornece a conexão de escrita dentro de uma transação.
+
+        Faz commit ao final do bloco ou rollback se ocorrer uma exceção.
+        """
+        with self._lock_escrita:
+            try:
+                yield self._escrita
+                self._escrita.commit()
+            except Exception:
+                self._escrita.rollback()
+                raise
+
+    @contextmanager
+    def leitura(self):
+        """Empresta uma conexão de leitura do pool."""
+        try:
+            conn = self._pool_leitura.get_nowait()
+        except queue.Empty:
+            with self._lock_pool:
+                if len(self._leitoras) < self.tamanho_pool_leitura:
+                    conn = self._abrir_conexao()
+                    self._leitoras.append(conn)
+                else:
+                    conn = None
+            if conn is None:
+                conn = self._pool_leitura.get()
+        try:
+            yield conn
+        finally:
+            self._pool_leitura.put(conn)
+
+    def fechar(self):
+        """Fecha todas as conexões abertas."""
+        if self._fechado:
+            return
+        self._fechado = True
+        with self._lock_escrita:
+            self._escrita.close()
+        with self._lock_pool:
+            for conn in self._leitoras:
+                conn.close()
+            self._leitoras.clear()
+        logger.info(
+            f"Conexões com o banco fechadas ({self.conexoes_abertas} abertas no total)")
+
+
+class DiarioEscrita:
+    """Fila write-behind das escritas de sessões de voz.
+
+    Aberturas e fechamentos de sessão e os incrementos de `call_stats` ficam
+    em memória e são gravados juntos, em uma única transação, a cada
+    `intervalo_ms` ou assim que `max_eventos` se acumulam. Em caso de queda
+    do processo, perde-se no máximo a janela de `intervalo_ms`.
+
+    Se a gravação falhar (ex.: banco travado além do busy_timeout), o lote
+    volta para a frente da fila e a gravação automática é tentada de novo
+    com espera exponencial. As falhas seguidas aparecem no !saude.
+    """
+
+    ESPERA_MAXIMA_S = 60.0  # Teto da espera entre tentativas após falhas
+    FALHAS_CRITICAS = 5  # A partir daqui, cada falha é registrada como crítica
+
+    def __init__(self, conexoes, intervalo_ms=DIARIO_INTERVALO_MS,
+                 max_eventos=DIARIO_MAX_EVENTOS):
+        self.conexoes = conexoes
+        self.intervalo_ms = intervalo_ms
+        self.max_eventos = max_eventos
+        self.transacoes = 0  # Total de transações gravadas
+        self.eventos_gravados = 0
+        self.falhas_consecutivas = 0
+        self.ultimo_erro = None
+        self._proxima_tentativa = 0.0  # time.monotonic() da próxima gravação automática
+        self.latencia_transacoes = Histograma()
+        self._sessoes = []  # [(operação, parâmetros)] na ordem de chegada
+        self._stats = {}  # {(guild_id, user_id): [user_name, segundos, sessoes, primeira, ultima]}
+        self._diario = {}  # {(guild_id, user_id, dia, canal): [segundos, sessoes]}
+        self._lock = threading.Lock()
+        self._lock_descarga = threading.Lock()
+        self._sinal = threading.Event()
+        self._parado = False
+        self._thread = threading.Thread(target=self._executar,
+                                        name="diario_escrita",
+                                        daemon=True)
+        self._thread.start()
+
+    def pendentes(self):
+        """Quantidade de eventos ainda não gravados."""
+        with self._lock:
+            return len(self._sessoes)
+
+    def abrir_sessao(self, guild_id, user_id, user_name, canal, canal_id,
+                     entrada):
+        self._adicionar(('abrir', (guild_id, user_id, user_name, canal,
+                                   canal_id, entrada)))
+
+    def fechar_sessao(self, guild_id, user_id, user_name, canal, entrada,
+                      saida, duracao):
+        """Enfileira o fechamento da sessão e o incremento de estatísticas."""
+        with self._lock:
+            acumular_por_dia(self._diario, guild_id, user_id, canal, entrada,
+                             saida)
+            self._sessoes.append(('fechar', (saida, duracao, guild_id, user_id)))
+            stats = self._stats.get((guild_id, user_id))
+            if stats is None:
+                self._stats[(guild_id, user_id)] = [user_name, duracao, 1,
+                                                    entrada, saida]
+            else:
+                stats[0] = user_name
+                stats[1] += duracao
+                stats[2] += 1
+                stats[4] = saida
+            cheio = len(self._sessoes) >= self.max_eventos
+        if cheio:
+            self._sinal.set()
+
+    @contextmanager
+    def em_lote(self):
+        """Segura a gravação automática enquanto um lote de operações é enfileirado.
+
+        Ao sair, o lote inteiro fica pendente e é gravado na próxima
+        descarga, em uma única transação.
+        """
+        with self._lock_descarga:
+            yield
+
+    def _adicionar(self, operacao):
+        with self._lock:
+            self._sessoes.append(operacao)
+            cheio = len(self._sessoes) >= self.max_eventos
+        if cheio:
+            self._sinal.set()
+
+    def descarregar(self):
+        """Grava imediatamente tudo o que estiver pendente.
+
+        Retorna False se a gravação falhou; nesse caso o lote continua pendente.
+        """
+        with self._lock_descarga:
+            with self._lock:
+                sessoes, self._sessoes = self._sessoes, []
+                stats, self._stats = self._stats, {}
+                consolidado, self._diario = self._diario, {}
+            if not sessoes and not stats:
+                return True
+
+            try:
+                inicio = time.perf_counter()
+                with self.conexoes.escrita() as conn:
+                    self._gravar(conn, sessoes, stats, consolidado)
+                self.latencia_transacoes.observar(
+                    (time.perf_counter() - inicio) * 1000)
+            except Exception as e:
+                self._devolver(sessoes, stats, consolidado)
+                self._registrar_falha(len(sessoes), e)
+                return False
+            self.transacoes += 1
+            self.eventos_gravados += len(sessoes)
+            if self.falhas_consecutivas:
+                logger.info(
+                    f"Gravação do diário normalizada após {self.falhas_consecutivas} falha(s)")
+            self.falhas_consecutivas = 0
+            self.ultimo_erro = None
+            self._proxima_tentativa = 0.0
+            return True
+
+    def _devolver(self, sessoes, stats, consolidado):
+        """Recoloca um lote que falhou à frente dos eventos que chegaram depois."""
+        with self._lock:
+            self._sessoes = sessoes + self._sessoes
+            for chave, novos in self._stats.items():
+                antigos = stats.get(chave)
+                if antigos is None:
+                    stats[chave] = novos
+                else:
+                    # Nome e última call do lote mais novo; primeira call do antigo
+                    stats[chave] = [novos[0], antigos[1] + novos[1],
+                                    antigos[2] + novos[2], antigos[3], novos[4]]
+            self._stats = stats
+            for chave, (segundos, sessoes_count) in self._diario.items():
+                valores = consolidado.setdefault(chave, [0, 0])
+                valores[0] += segundos
+                valores[1] += sessoes_count
+            self._diario = consolidado
+
+    def _registrar_falha(self, quantidade, erro):
+        self.falhas_consecutivas += 1
+        self.ultimo_erro = str(erro)
+        espera = min(self.ESPERA_MAXIMA_S,
+                     self.intervalo_ms / 1000 * 2 ** self.falhas_consecutivas)
+        self._proxima_tentativa = time.monotonic() + espera
+        mensagem = (f"Erro ao gravar {quantidade} eventos de chamada pendentes "
+                    f"(falha {self.falhas_consecutivas}, nova tentativa em {espera:.1f}s): {erro}")
+        if self.falhas_consecutivas >= self.FALHAS_CRITICAS:
+            logger.critical(mensagem)
+        else:
+            logger.error(mensagem)
+
+    def estatisticas(self):
+        with self._lock:
+            pendentes = len(self._sessoes)
+        return {
+            'pendentes': pendentes,
+            'falhas_consecutivas': self.falhas_consecutivas,
+            'ultimo_erro': self.ultimo_erro
+        }
+
+    def _gravar(self, conn, sessoes, stats, consolidado):
+        agora = relogio.agora()
+        for operacao, parametros in sessoes:
+            if operacao == 'abrir':
+                conn.execute(
+                    '''
+                    INSERT INTO call_sessions (guild_id, user_id, user_name, canal, canal_id, entrada, last_seen)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (*parametros, parametros[-1]))
+            else:
+                conn.execute(SQL_FECHAR_SESSAO, parametros)
+
+        # Um único UPSERT por usuário com o acumulado do lote
+        conn.executemany(
+            '''
+            INSERT INTO call_stats 
+            (guild_id, user_id, user_name, total_segundos, total_sessoes, primeira_call, ultima_call, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(guild_id, user_id) DO UPDATE SET
+                user_name = excluded.user_name,
+                total_segundos = total_segundos + excluded.total_segundos,
+                total_sessoes = total_sessoes + excluded.total_sessoes,
+                primeira_call = COALESCE(primeira_call, excluded.primeira_call),
+                ultima_call = excluded.ultima_call,
+                updated_at = excluded.updated_at
+        ''', [(*chave, user_name, segundos, sessoes_count, primeira, ultima,
+               agora) for chave, (user_name, segundos, sessoes_count, primeira,
+                                  ultima) in stats.items()])
+
+        conn.executemany(SQL_SOMAR_CALL_DAILY,
+                         [(*chave, segundos, sessoes_count)
+                          for chave, (segundos, sessoes_count) in consolidado.items()])
+
+    def _executar(self):
+        while not self._parado:
+            self._sinal.wait(self.intervalo_ms / 1000)
+            self._sinal.clear()
+            # Após uma falha, espera o backoff antes de tentar de novo
+            if time.monotonic() >= self._proxima_tentativa:
+                self.descarregar()
+
+    def parar(self):
+        """Interrompe a thread de gravação após descarregar a fila."""
+        self._parado = True
+        self._sinal.set()
+        self._thread.join()
+        if not self.descarregar():
+            logger.critical(
+                f"{self.pendentes()} eventos de chamada não puderam ser gravados "
+                f"no encerramento: {self.ultimo_erro}")
+        logger.info(
+            f"Diário de escrita encerrado: {self.eventos_gravados} eventos em "
+            f"{self.transacoes} transações")
+
+
+class CheckpointSessoes:
+    """Grava periodicamente `last_seen` em todas as sessões abertas.
+
+    Se o processo cair, as sessões abertas são fechadas na próxima
+    inicialização no último checkpoint, em vez de creditar o tempo em que o
+    bot esteve fora. O erro fica limitado a `intervalo_s`.
+    """
+
+    def __init__(self, conexoes, diario, intervalo_s=CHECKPOINT_INTERVALO_S):
+        self.conexoes = conexoes
+        self.diario = diario
+        self.intervalo_s = intervalo_s
+        self.checkpoints = 0
+        self.sessoes_marcadas = 0  # Linhas atualizadas no último checkpoint
+        self.tempo_total = 0.0  # Segundos gastos em checkpoints
+        self.tempo_maximo = 0.0
+        self._parado = threading.Event()
+        self._thread = threading.Thread(target=self._executar,
+                                        name="checkpoint_sessoes",
+                                        daemon=True)
+        self._thread.start()
+
+    def marcar(self):
+        """Atualiza `last_seen` de todas as sessões abertas em um único UPDATE."""
+        inicio = time.perf_counter()
+        try:
+            # As aberturas pendentes precisam estar no banco para serem marcadas
+            self.diario.descarregar()
+            with self.conexoes.escrita() as conn:
+                cursor = conn.execute(SQL_CHECKPOINT_SESSOES, (relogio.agora(), ))
+            self.sessoes_marcadas = cursor.rowcount
+        except Exception as e:
+            logger.error(f"Erro no checkpoint das sessões abertas: {e}")
+            return
+        custo = time.perf_counter() - inicio
+        self.checkpoints += 1
+        self.tempo_total += custo
+        self.tempo_maximo = max(self.tempo_maximo, custo)
+        logger.debug(
+            f"Checkpoint de {self.sessoes_marcadas} sessões em {custo * 1000:.1f} ms")
+
+    def estatisticas(self):
+        return {
+            'intervalo_s': self.intervalo_s,
+            'checkpoints': self.checkpoints,
+            'sessoes_marcadas': self.sessoes_marcadas,
+            'custo_medio_ms': (self.tempo_total / self.checkpoints * 1000
+                               if self.checkpoints else 0.0),
+            'custo_maximo_ms': self.tempo_maximo * 1000
+        }
+
+    def _executar(self):
+        while not self._parado.wait(self.intervalo_s):
+            self.marcar()
+
+    def parar(self):
+        """Interrompe a thread e grava um último checkpoint."""
+        self._parado.set()
+        self._thread.join()
+        self.marcar()
+        stats = self.estatisticas()
+        logger.info(
+            f"Checkpoint de sessões encerrado: {stats['checkpoints']} checkpoints, "
+            f"custo médio {stats['custo_medio_ms']:.1f} ms, "
+            f"máximo {stats['custo_maximo_ms']:.1f} ms")
+
+
+class IndiceRanking:
+    """Índice de estatísticas de ordem sobre (total_segundos, user_id).
+
+    As chaves ficam em uma lista ordenada dividida em blocos, com uma árvore
+    de Fenwick sobre o tamanho dos blocos. A posição de um usuário é obtida
+    em tempo logarítmico e cada atualização mexe em um único bloco.
+    """
+
+    TAMANHO_BLOCO = 512
 
     def __init__(self):
-        self.db_path = "call_tracker.db"
-        self.usuarios_ativos = {
-        }  # {user_id: {'entrada': datetime, 'canal': str}}
+        self._lock = threading.Lock()
+        self._pontuacoes = {}  # {user_id: total_segundos}
+        self._blocos = []
+        self._maximos = []  # Última chave de cada bloco
+        self._fenwick = [0]
+
+    @staticmethod
+    def _chave(user_id, segundos):
+        # Mais tempo primeiro; empates pelo maior user_id, igual ao SQL_RANKING
+        return (-segundos, -user_id)
+
+    def __len__(self):
+        return len(self._pontuacoes)
+
+    def construir(self, pares):
+        """Reconstrói o índice a partir de pares (user_id, total_segundos)."""
+        with self._lock:
+            self._pontuacoes = dict(pares)
+            chaves = sorted(
+                self._chave(user_id, segundos)
+                for user_id, segundos in self._pontuacoes.items())
+            n = self.TAMANHO_BLOCO
+            self._blocos = [chaves[i:i + n] for i in range(0, len(chaves), n)]
+            self._reindexar()
+
+    def _reindexar(self):
+        self._maximos = [bloco[-1] for bloco in self._blocos]
+        self._fenwick = [0] * (len(self._blocos) + 1)
+        for i, bloco in enumerate(self._blocos, 1):
+            self._fenwick[i] += len(bloco)
+            pai = i + (i & -i)
+            if pai < len(self._fenwick):
+                self._fenwick[pai] += self._fenwick[i]
+
+    def _fenwick_somar(self, indice_bloco, delta):
+        i = indice_bloco + 1
+        while i < len(self._fenwick):
+            self._fenwick[i] += delta
+            i += i & -i
+
+    def _fenwick_prefixo(self, indice_bloco):
+        """Quantidade de chaves nos blocos anteriores a `indice_bloco`."""
+        total = 0
+        i = indice_bloco
+        while i > 0:
+            total += self._fenwick[i]
+            i -= i & -i
+        return total
+
+    def _inserir(self, chave):
+        if not self._blocos:
+            self._blocos.append([chave])
+            self._reindexar()
+            return
+        i = min(bisect.bisect_left(self._maximos, chave), len(self._blocos) - 1)
+        bloco = self._blocos[i]
+        bisect.insort(bloco, chave)
+        self._maximos[i] = bloco[-1]
+        if len(bloco) > 2 * self.TAMANHO_BLOCO:
+            meio = len(bloco) // 2
+            self._blocos[i:i + 1] = [bloco[:meio], bloco[meio:]]
+            self._reindexar()
+        else:
+            self._fenwick_somar(i, 1)
+
+    def _remover_chave(self, chave):
+        i = bisect.bisect_left(self._maximos, chave)
+        bloco = self._blocos[i]
+        del bloco[bisect.bisect_left(bloco, chave)]
+        if bloco:
+            self._maximos[i] = bloco[-1]
+            self._fenwick_somar(i, -1)
+        else:
+            del self._blocos[i]
+            self._reindexar()
+
+    def _atualizar(self, user_id, segundos):
+        antigo = self._pontuacoes.get(user_id)
+        if antigo is not None:
+            self._remover_chave(self._chave(user_id, antigo))
+        self._pontuacoes[user_id] = segundos
+        self._inserir(self._chave(user_id, segundos))
+
+    def atualizar(self, user_id, segundos):
+        """Define o tempo total de um usuário."""
+        with self._lock:
+            self._atualizar(user_id, segundos)
+
+    def somar(self, user_id, segundos):
+        """Soma `segundos` ao tempo total de um usuário."""
+        with self._lock:
+            self._atualizar(user_id,
+                            self._pontuacoes.get(user_id, 0) + segundos)
+
+    def remover(self, user_id):
+        with self._lock:
+            segundos = self._pontuacoes.pop(user_id, None)
+            if segundos is not None:
+                self._remover_chave(self._chave(user_id, segundos))
+
+    def limpar(self):
+        self.construir([])
+
+    def posicao(self, user_id):
+        """Posição (1 = primeiro) do usuário no ranking, ou None."""
+        with self._lock:
+            segundos = self._pontuacoes.get(user_id)
+            if segundos is None:
+                return None
+            chave = self._chave(user_id, segundos)
+            i = bisect.bisect_left(self._maximos, chave)
+            return (self._fenwick_prefixo(i) +
+                    bisect.bisect_left(self._blocos[i], chave) + 1)
+
+
+class CacheRanking:
+    """Cache do top-N do ranking e dos campos já renderizados do embed.
+
+    Cada entrada guarda a versão em que foi montada. Fechamentos de sessão
+    corrigem o ranking geral no lugar quando possível e invalidam o resto;
+    resets invalidam tudo. `acertos` e `falhas` medem a eficácia do cache.
+    """
+
+    LIMITE_RENDERIZADOS = 32
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.versao = 0
+        self.acertos = 0
+        self.falhas = 0
+        self._entradas = {}  # {(período, início, limite): (versão, ranking)}
+        self._renderizados = {}  # {(período, assinatura): texto}
+
+    def obter(self, chave):
+        """Retorna o ranking em cache para `chave`, ou None."""
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is not None and entrada[0] == self.versao:
+                self.acertos += 1
+                return list(entrada[1])
+            self.falhas += 1
+            return None
+
+    def guardar(self, chave, ranking):
+        with self._lock:
+            self._entradas[chave] = (self.versao, list(ranking))
+
+    def invalidar(self):
+        with self._lock:
+            self._invalidar()
+
+    def _invalidar(self):
+        self.versao += 1
+        self._entradas.clear()
+        self._renderizados.clear()
+
+    def registrar_fechamento(self, user_id, user_name, duracao, saida,
+                             posicao):
+        """Atualiza o cache após o fechamento de uma sessão.
+
+        `posicao` é a nova posição do usuário no ranking geral.
+        """
+        with self._lock:
+            atualizadas = {}
+            for chave, (versao, ranking) in self._entradas.items():
+                periodo, _, limite = chave
+                if periodo is not None or versao != self.versao:
+                    continue  # Rankings por período são refeitos
+                corrigido = self._corrigir(ranking, limite, user_id, user_name,
+                                           duracao, saida, posicao)
+                if corrigido is None:
+                    self._invalidar()
+                    return
+                atualizadas[chave] = corrigido
+
+            mudou = any(ranking is not self._entradas[chave][1]
+                        for chave, ranking in atualizadas.items())
+            tem_periodo = any(chave[0] is not None for chave in self._entradas)
+            if not mudou and not tem_periodo:
+                return
+            self.versao += 1
+            self._entradas = {chave: (self.versao, ranking)
+                              for chave, ranking in atualizadas.items()}
+            self._renderizados.clear()
+
+    @staticmethod
+    def _corrigir(ranking, limite, user_id, user_name, duracao, saida,
+                  posicao):
+        """Aplica o fechamento ao top-N; None se não for possível sem o banco."""
+        for i, linha in enumerate(ranking):
+            if linha['user_id'] == user_id:
+                novo = dict(linha,
+                            user_name=user_name,
+                            total_segundos=linha['total_segundos'] + duracao,
+                            total_sessoes=linha['total_sessoes'] + 1,
+                            ultima_call=saida)
+                corrigido = ranking[:i] + [novo] + ranking[i + 1:]
+                corrigido.sort(key=lambda l: (-l['total_segundos'], -l['user_id']))
+                return corrigido
+        if len(ranking) < limite:
+            # Top incompleto contém todos os usuários: este é novo no ranking
+            corrigido = ranking + [{
+                'user_id': user_id,
+                'user_name': user_name,
+                'total_segundos': duracao,
+                'total_sessoes': 1,
+                'ultima_call': saida
+            }]
+            corrigido.sort(key=lambda l: (-l['total_segundos'], -l['user_id']))
+            return corrigido
+        if posicao is not None and posicao <= limite:
+            return None  # Entrou no top-N vindo de fora: precisa do banco
+        return ranking
+
+    @staticmethod
+    def _assinatura(ranking, nomes):
+        # Os nomes de exibição entram no texto: um apelido novo muda a assinatura
+        return tuple((l['user_id'], l['total_segundos'], nome)
+                     for l, nome in zip(ranking, nomes))
+
+    def obter_renderizado(self, periodo, ranking, nomes):
+        """Texto já renderizado para exatamente este ranking e estes nomes, ou None."""
+        assinatura = self._assinatura(ranking, nomes)
+        with self._lock:
+            return self._renderizados.get((periodo, assinatura))
+
+    def guardar_renderizado(self, periodo, ranking, nomes, texto):
+        assinatura = self._assinatura(ranking, nomes)
+        with self._lock:
+            if len(self._renderizados) >= self.LIMITE_RENDERIZADOS:
+                self._renderizados.clear()
+            self._renderizados[(periodo, assinatura)] = texto
+
+    def estatisticas(self):
+        total = self.acertos + self.falhas
+        return {
+            'versao': self.versao,
+            'acertos': self.acertos,
+            'falhas': self.falhas,
+            'taxa_acerto': self.acertos / total if total else 0.0
+        }
+
+
+class ParticaoServidor:
+    """Estado em memória do rastreamento de chamadas de um servidor."""
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.usuarios_ativos = {}  # {user_id: {'entrada': epoch, 'canal': str, ...}}
+        self.indice_ranking = IndiceRanking()
+        self.cache_ranking = CacheRanking()
+        # Versão do histórico de cada usuário: muda quando uma sessão fecha
+        # ou o histórico é apagado (chave do cache de páginas renderizadas)
+        self.versoes_historico = {}  # {user_id: int}
+        self.epoca_historico = 0  # Incrementada pelo reset do servidor
+
+
+class ConfiguracaoServidores:
+    """Configuração de canais e cargos por servidor (tabela guild_config).
+
+    A tabela é lida uma única vez na inicialização; alterações feitas pelo
+    bot gravam no banco e atualizam a cópia em memória.
+    """
+
+    # Campos que podem ser alterados com !configservidor
+    CAMPOS_EDITAVEIS = ('canal_plantoes_id', 'canal_moderacao_id',
+                        'canal_afk_id', 'canal_logs_inscricao_id',
+                        'cargo_punicao_1_id', 'cargo_punicao_2_id')
+
+    def __init__(self, conexoes):
+        self.conexoes = conexoes
+        self._configs = {}  # {guild_id: ConfigServidor}
+
+    def carregar(self):
+        try:
+            with self.conexoes.leitura() as conn:
+                linhas = conn.execute('SELECT * FROM guild_config').fetchall()
+            self._configs = {linha[0]: self._converter(linha) for linha in linhas}
+            logger.info(f"Configuração carregada para {len(self._configs)} servidor(es)")
+        except Exception as e:
+            logger.error(f"Erro ao carregar configuração dos servidores: {e}")
+
+    @staticmethod
+    def _converter(linha):
+        (guild_id, canal_plantoes_id, canal_moderacao_id, canal_afk_id,
+         canal_logs_inscricao_id, cargo_punicao_1_id, cargo_punicao_2_id,
+         cargos, hierarquia, cargos_setaveis) = linha
+        return ConfigServidor(guild_id, canal_plantoes_id, canal_moderacao_id,
+                              canal_afk_id, canal_logs_inscricao_id,
+                              cargo_punicao_1_id, cargo_punicao_2_id,
+                              json.loads(cargos), json.loads(hierarquia),
+                              frozenset(json.loads(cargos_setaveis)))
+
+    def obter(self, guild_id):
+        """Configuração do servidor, ou CONFIG_VAZIA se ele não foi configurado."""
+        return self._configs.get(guild_id, CONFIG_VAZIA)
+
+    def servidores(self):
+        return list(self._configs)
+
+    def todas(self):
+        return list(self._configs.values())
+
+    def guardar(self, config):
+        """Substitui a cópia em memória de um servidor (usado pelos clusters)."""
+        self._configs[config.guild_id] = config
+
+    def atualizar(self, guild_id, campo, valor):
+        """Altera um dos CAMPOS_EDITAVEIS de um servidor."""
+        if campo not in self.CAMPOS_EDITAVEIS:
+            raise ValueError(f"Campo de configuração inválido: {campo}")
+        with self.conexoes.escrita() as conn:
+            conn.execute('INSERT OR IGNORE INTO guild_config (guild_id) VALUES (?)',
+                         (guild_id, ))
+            conn.execute(f'UPDATE guild_config SET {campo} = ? WHERE guild_id = ?',
+                         (valor, guild_id))
+            linha = conn.execute('SELECT * FROM guild_config WHERE guild_id = ?',
+                                 (guild_id, )).fetchone()
+        self._configs[guild_id] = self._converter(linha)
+        return self._configs[guild_id]
+
+    def renomear(self, antigo, novo):
+        """Move a configuração em memória de `antigo` para `novo` (adoção do legado)."""
+        config = self._configs.pop(antigo, None)
+        if config is not None and novo not in self._configs:
+            self._configs[novo] = config._replace(guild_id=novo)
+
+
+class CallTracker:
+    """Sistema completo de rastreamento de chamadas de voz
+
+    Sessões, estatísticas e rankings são separados por servidor (guild_id).
+    """
+
+    def __init__(self, db_path="call_tracker.db", perfil_sql=PERFIL_SQL):
+        self.db_path = db_path
+        self.perfil_sql = PerfilSQL() if perfil_sql else None
+        # Diferencia as versões de histórico entre execuções do rastreador
+        self.geracao = secrets.token_hex(4)
+        self.conexoes = GerenciadorConexoes(self.db_path, perfil=self.perfil_sql)
+        self._particoes = {}  # {guild_id: ParticaoServidor}
+        self._lock_particoes = threading.Lock()
+        self.config_servidores = ConfiguracaoServidores(self.conexoes)
         self.init_database()
+        self.config_servidores.carregar()
         self.carregar_usuarios_ativos()
+        self.carregar_indice_ranking()
+        self.diario = DiarioEscrita(self.conexoes)
+        self.fechar_sessoes_interrompidas()
+        self.checkpoint = CheckpointSessoes(self.conexoes, self.diario)
+
+    def particao(self, guild_id):
+        """Estado em memória do servidor, criado no primeiro uso."""
+        particao = self._particoes.get(guild_id)
+        if particao is None:
+            with self._lock_particoes:
+                particao = self._particoes.setdefault(guild_id,
+                                                      ParticaoServidor(guild_id))
+        return particao
+
+    def ativos(self, guild_id):
+        """Sessões abertas do servidor: {user_id: dados da sessão}."""
+        return self.particao(guild_id).usuarios_ativos
+
+    def sessao_ativa(self, guild_id, user_id):
+        """Canal e duração da sessão aberta do usuário, ou None se ele não está em call."""
+        dados_sessao = self.ativos(guild_id).get(user_id)
+        if dados_sessao is None:
+            return None
+        return {'canal': dados_sessao['canal'],
+                'duracao': relogio.duracao(dados_sessao)}
+
+    def atualizar_config_servidor(self, guild_id, campo, valor):
+        return self.config_servidores.atualizar(guild_id, campo, valor)
+
+    def versao_historico(self, guild_id, user_id):
+        """Identifica o estado atual do histórico do usuário."""
+        particao = self.particao(guild_id)
+        return (self.geracao, particao.epoca_historico,
+                particao.versoes_historico.get(user_id, 0))
+
+    def _nova_versao_historico(self, particao, user_id):
+        particao.versoes_historico[user_id] = (
+            particao.versoes_historico.get(user_id, 0) + 1)
+
+    def listar_configs(self):
+        return self.config_servidores.todas()
+
+    def estatisticas_rastreamento(self):
+        """Sessões abertas e cache de ranking por servidor, e as gravações no banco."""
+        with self._lock_particoes:
+            particoes = list(self._particoes.values())
+        return {
+            'sessoes_ativas': {particao.guild_id: len(particao.usuarios_ativos)
+                               for particao in particoes},
+            'cache_ranking': {particao.guild_id: particao.cache_ranking.estatisticas()
+                              for particao in particoes},
+            'transacoes': self.diario.latencia_transacoes.instantaneo(),
+            'eventos_gravados': self.diario.eventos_gravados,
+            'diario': self.diario.estatisticas(),
+            'checkpoints': self.checkpoint.checkpoints
+        }
+
+    def relatorio_sql(self, quantidade=10, ordem='tempo_total'):
+        """Statements mais caros do modo de perfil, ou None se ele está desligado."""
+        if self.perfil_sql is None:
+            return None
+        return self.perfil_sql.relatorio(quantidade, ordem)
+
+    def limpar_perfil_sql(self):
+        if self.perfil_sql is not None:
+            self.perfil_sql.limpar()
+
+    def descarregar(self):
+        """Grava as escritas pendentes do diário (False se a gravação falhou)."""
+        return self.diario.descarregar()
+
+    def fechar(self):
+        """Encerra o acesso ao banco de dados (usado no desligamento)."""
+        for particao in list(self._particoes.values()):
+            stats_cache = particao.cache_ranking.estatisticas()
+            logger.info(
+                f"Cache de ranking do servidor {particao.guild_id}: "
+                f"{stats_cache['acertos']} acertos, {stats_cache['falhas']} falhas")
+        # O último checkpoint marca o desligamento como fim das sessões abertas
+        self.checkpoint.parar()
+        self.diario.parar()
+        self.conexoes.fechar()
 
     def init_database(self):
         """Inicializa o banco de dados SQLite"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            # Tabela para sessões de call
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS call_sessions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT NOT NULL,
-                    user_name TEXT NOT NULL,
-                    canal TEXT NOT NULL,
-                    entrada DATETIME NOT NULL,
-                    saida DATETIME,
-                    duracao_segundos INTEGER,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            # Tabela para estatísticas agregadas
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS call_stats (
-                    user_id TEXT PRIMARY KEY,
-                    user_name TEXT NOT NULL,
-                    total_segundos INTEGER DEFAULT 0,
-                    total_sessoes INTEGER DEFAULT 0,
-                    primeira_call DATETIME,
-                    ultima_call DATETIME,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            conn.commit()
-            conn.close()
+            self.aplicar_migracoes()
+            self.verificar_planos_consulta()
             logger.info("Banco de dados inicializado com sucesso")
 
         except Exception as e:
             logger.error(f"Erro ao inicializar banco de dados: {e}")
 
+    def aplicar_migracoes(self):
+        """Aplica, em ordem, as migrações ainda não registradas em schema_version."""
+        with self.conexoes.escrita() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    versao INTEGER PRIMARY KEY,
+                    descricao TEXT NOT NULL,
+                    aplicada_em DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            versao_atual = conn.execute(
+                "SELECT COALESCE(MAX(versao), 0) FROM schema_version").fetchone()[0]
+
+        for versao, descricao, passos in MIGRACOES:
+            if versao <= versao_atual:
+                continue
+            # Cada migração roda em uma transação própria (DDL incluso)
+            with self.conexoes.escrita() as conn:
+                conn.execute("BEGIN")
+                for passo in passos:
+                    if callable(passo):
+                        passo(conn)
+                    else:
+                        conn.execute(passo)
+                conn.execute(
+                    "INSERT INTO schema_version (versao, descricao) VALUES (?, ?)",
+                    (versao, descricao))
+            logger.info(f"Migração {versao} aplicada: {descricao}")
+
+    def verificar_planos_consulta(self):
+        """Confere com EXPLAIN QUERY PLAN se as consultas críticas usam índices.
+
+        Retorna a lista de consultas que caíram em varredura completa.
+        """
+        com_varredura = []
+        with self.conexoes.leitura() as conn:
+            for nome, sql, parametros, exigido in CONSULTAS_CRITICAS:
+                plano = conn.execute(f"EXPLAIN QUERY PLAN {sql}",
+                                     parametros).fetchall()
+                detalhes = [linha[-1] for linha in plano]
+                if plano_inadequado(detalhes, exigido):
+                    com_varredura.append(nome)
+                    logger.warning(
+                        f"Consulta '{nome}' sem índice adequado: {' | '.join(detalhes)}")
+        return com_varredura
+
     def carregar_usuarios_ativos(self):
         """Carrega usuários que estavam em call na última execução"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            # Busca sessões não finalizadas
-            cursor.execute('''
-                SELECT user_id, user_name, canal, entrada 
-                FROM call_sessions 
-                WHERE saida IS NULL
-            ''')
-
-            for row in cursor.fetchall():
-                user_id, user_name, canal, entrada_str = row
-                entrada = datetime.fromisoformat(entrada_str)
-                self.usuarios_ativos[int(user_id)] = {
+            with self.conexoes.leitura() as conn:
+                # Busca sessões não finalizadas
+                rows = conn.execute('''
+                    SELECT guild_id, user_id, user_name, canal, canal_id, entrada, last_seen
+                    FROM call_sessions 
+                    WHERE saida IS NULL
+                ''').fetchall()
+
+            for row in rows:
+                guild_id, user_id, user_name, canal, canal_id, entrada, last_seen = row
+                self.ativos(guild_id)[user_id] = {
                     'entrada': entrada,
+                    'entrada_mono': None,
                     'canal': canal,
-                    'user_name': user_name
+                    'canal_id': canal_id,
+                    'user_name': user_name,
+                    'last_seen': last_seen
                 }
 
-            conn.close()
-            logger.info(
-                f"Carregados {len(self.usuarios_ativos)} usuários ativos")
+            logger.info(f"Carregados {len(rows)} usuários ativos")
 
         except Exception as e:
             logger.error(f"Erro ao carregar usuários ativos: {e}")
 
-    def registrar_entrada(self, user_id, user_name, canal):
-        """Registra entrada de usuário em canal de voz"""
+    def fechar_sessoes_interrompidas(self):
+        """Fecha no último checkpoint as sessões que a execução anterior deixou abertas.
+
+        O bot não observou nada depois do `last_seen`, então esse tempo não é
+        creditado. Quem ainda estiver em call ganha uma sessão nova na
+        reconciliação do on_ready. Sessões sem checkpoint (anteriores à
+        migração 5) continuam abertas, como antes.
+        """
         try:
-            entrada = datetime.now(TZ_SAO_PAULO)
+            interrompidas = [(guild_id, user_id, dados)
+                             for guild_id, particao in list(self._particoes.items())
+                             for user_id, dados in particao.usuarios_ativos.items()
+                             if dados.get('last_seen') is not None]
+            with self.diario.em_lote():
+                for guild_id, user_id, dados in interrompidas:
+                    ultimo_checkpoint = max(dados['last_seen'], dados['entrada'])
+                    self.registrar_saida(guild_id, user_id, dados['user_name'],
+                                         dados['canal'],
+                                         momento=(ultimo_checkpoint, None))
+            self.descarregar()
+            if interrompidas:
+                logger.info(
+                    f"{len(interrompidas)} sessões interrompidas fechadas no último checkpoint")
+        except Exception as e:
+            logger.error(f"Erro ao fechar sessões interrompidas: {e}")
+
+    def carregar_indice_ranking(self, guild_id=None):
+        """Monta os índices de ranking em memória a partir de call_stats.
+
+        Com `guild_id`, remonta apenas o índice daquele servidor.
+        """
+        try:
+            with self.conexoes.leitura() as conn:
+                if guild_id is None:
+                    linhas = conn.execute(
+                        "SELECT guild_id, user_id, total_segundos FROM call_stats").fetchall()
+                else:
+                    linhas = conn.execute(
+                        "SELECT guild_id, user_id, total_segundos FROM call_stats WHERE guild_id = ?",
+                        (guild_id, )).fetchall()
+            por_servidor = {} if guild_id is None else {guild_id: []}
+            for guild, user_id, total_segundos in linhas:
+                por_servidor.setdefault(guild, []).append((user_id, total_segundos))
+            for guild, pares in por_servidor.items():
+                self.particao(guild).indice_ranking.construir(pares)
+            logger.info(
+                f"Índice de ranking montado com {len(linhas)} usuários em "
+                f"{len(por_servidor)} servidor(es)")
+        except Exception as e:
+            logger.error(f"Erro ao montar índice de ranking: {e}")
+
+    def adotar_servidor_legado(self, guild_id):
+        """Atribui ao servidor `guild_id` os dados gravados antes da separação por servidor."""
+        try:
+            self.descarregar()
+            with self.diario.em_lote():
+                with self.conexoes.escrita() as conn:
+                    for tabela in ('call_sessions', 'call_stats', 'call_daily'):
+                        conn.execute(
+                            f"UPDATE {tabela} SET guild_id = ? WHERE guild_id = ?",
+                            (guild_id, GUILD_LEGADO_ID))
+                    # Uma configuração já feita para o servidor prevalece
+                    conn.execute(
+                        "UPDATE OR IGNORE guild_config SET guild_id = ? WHERE guild_id = ?",
+                        (guild_id, GUILD_LEGADO_ID))
+                    conn.execute("DELETE FROM guild_config WHERE guild_id = ?",
+                                 (GUILD_LEGADO_ID, ))
+                with self._lock_particoes:
+                    legado = self._particoes.pop(GUILD_LEGADO_ID, None)
+                self.config_servidores.renomear(GUILD_LEGADO_ID, guild_id)
+                if legado is not None:
+                    ativos = self.ativos(guild_id)
+                    for user_id, dados in legado.usuarios_ativos.items():
+                        ativos.setdefault(user_id, dados)
+                self.carregar_indice_ranking(guild_id)
+                self.particao(guild_id).cache_ranking.invalidar()
+            logger.info(f"Dados anteriores à separação por servidor atribuídos ao servidor {guild_id}")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Erro ao atribuir dados legados ao servidor {guild_id}: {e}")
+            return False
+
+    def registrar_entrada(self, guild_id, user_id, user_name, canal,
+                          canal_id=None, momento=None):
+        """Registra entrada de usuário em canal de voz
+
+        `momento` é o (epoch, monotônico) do evento; por padrão, agora.
+        """
+        try:
+            entrada, entrada_mono = momento or relogio.marcar()
 
             # Adiciona aos usuários ativos
-            self.usuarios_ativos[user_id] = {
+            self.ativos(guild_id)[user_id] = {
                 'entrada': entrada,
+                'entrada_mono': entrada_mono,
                 'canal': canal,
+                'canal_id': canal_id,
                 'user_name': user_name
             }
 
-            # Registra no banco
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            cursor.execute(
-                '''
-                INSERT INTO call_sessions (user_id, user_name, canal, entrada)
-                VALUES (?, ?, ?, ?)
-            ''', (str(user_id), user_name, canal, entrada.isoformat()))
+            # Registra no banco (gravação agrupada pelo diário)
+            self.diario.abrir_sessao(guild_id, user_id, user_name, canal,
+                                     canal_id, entrada)
 
-            conn.commit()
-            conn.close()
-
-            logger.info(f"🔊 {user_name} entrou no canal {canal}")
+            logger.info(f"🔊 {user_name} entrou no canal {canal}",
+                        extra={'evento': 'entrada_call', 'guild_id': guild_id,
+                               'user_id': user_id, 'canal': canal})
 
         except Exception as e:
             logger.error(f"Erro ao registrar entrada: {e}")
 
-    def registrar_saida(self, user_id, user_name, canal):
+    def registrar_saida(self, guild_id, user_id, user_name, canal,
+                        momento=None):
         """Registra saída de usuário e calcula duração"""
         try:
-            if user_id not in self.usuarios_ativos:
+            particao = self.particao(guild_id)
+            if user_id not in particao.usuarios_ativos:
                 logger.warning(
                     f"Usuário {user_name} saiu sem entrada registrada")
                 return 0
 
-            dados_entrada = self.usuarios_ativos.pop(user_id)
+            dados_entrada = particao.usuarios_ativos.pop(user_id)
             entrada = dados_entrada['entrada']
-            saida = datetime.now(TZ_SAO_PAULO)
-            duracao = int((saida - entrada).total_seconds())
-
-            # Atualiza no banco
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            # Atualiza a sessão
-            cursor.execute(
-                '''
-                UPDATE call_sessions 
-                SET saida = ?, duracao_segundos = ?
-                WHERE id = (
-                    SELECT id FROM call_sessions
-                    WHERE user_id = ? AND saida IS NULL
-                    ORDER BY entrada DESC
-                    LIMIT 1
-                )
-            ''', (saida.isoformat(), duracao, str(user_id)))
-
-            # Atualiza estatísticas
-            cursor.execute(
-                '''
-                INSERT OR REPLACE INTO call_stats 
-                (user_id, user_name, total_segundos, total_sessoes, primeira_call, ultima_call, updated_at)
-                VALUES (
-                    ?, ?, 
-                    COALESCE((SELECT total_segundos FROM call_stats WHERE user_id = ?), 0) + ?,
-                    COALESCE((SELECT total_sessoes FROM call_stats WHERE user_id = ?), 0) + 1,
-                    COALESCE((SELECT primeira_call FROM call_stats WHERE user_id = ?), ?),
-                    ?, ?
-                )
-            ''', (str(user_id), user_name, str(user_id), duracao, str(user_id),
-                  str(user_id), entrada.isoformat(), saida.isoformat(),
-                  datetime.now(TZ_SAO_PAULO).isoformat()))
-
-            conn.commit()
-            conn.close()
+            duracao = relogio.duracao(dados_entrada, momento)
+            saida = entrada + duracao
+
+            # Atualiza a sessão e as estatísticas (gravação agrupada pelo diário)
+            self.diario.fechar_sessao(guild_id, user_id, user_name,
+                                      dados_entrada['canal'], entrada, saida,
+                                      duracao)
+            particao.indice_ranking.somar(user_id, duracao)
+            self._nova_versao_historico(particao, user_id)
+            particao.cache_ranking.registrar_fechamento(
+                user_id, user_name, duracao, saida,
+                particao.indice_ranking.posicao(user_id))
 
             logger.info(
-                f"🔇 {user_name} saiu do canal {canal}. Duração: {self.formatar_tempo(duracao)}"
-            )
+                f"🔇 {user_name} saiu do canal {canal}. Duração: {self.formatar_tempo(duracao)}",
+                extra={'evento': 'saida_call', 'guild_id': guild_id,
+                       'user_id': user_id, 'canal': canal, 'duracao_s': duracao})
             return duracao
 
         except Exception as e:
             logger.error(f"Erro ao registrar saída: {e}")
             return 0
 
-    def obter_estatisticas_usuario(self, user_id):
-        """Obtém estatísticas completas do usuário"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            # Busca estatísticas gerais
-            cursor.execute(
-                '''
-                SELECT total_segundos, total_sessoes, primeira_call, ultima_call
-                FROM call_stats
-                WHERE user_id = ?
-            ''', (str(user_id), ))
-
-            result = cursor.fetchone()
-            if not result:
-                conn.close()
-                return None
+    def aplicar_transicoes(self, transicoes):
+        """Aplica, em ordem, uma lista de transições de voz.
+
+        Cada transição é ('entrada', guild_id, user_id, user_name, canal,
+        canal_id, momento) ou ('saida', guild_id, user_id, user_name, canal,
+        momento).
+        """
+        for tipo, *args in transicoes:
+            if tipo == 'entrada':
+                self.registrar_entrada(*args)
+            else:
+                self.registrar_saida(*args)
 
-            total_segundos, total_sessoes, primeira_call, ultima_call = result
+    def obter_estatisticas_usuario(self, guild_id, user_id):
+        """Obtém estatísticas completas do usuário no servidor"""
+        try:
+            self.descarregar()
+            with self.conexoes.leitura() as conn:
+                # Busca estatísticas gerais
+                result = conn.execute(SQL_ESTATISTICAS_USUARIO,
+                                      (guild_id, user_id)).fetchone()
 
-            # Busca última sessão
-            cursor.execute(
-                '''
-                SELECT canal, entrada, saida, duracao_segundos
-                FROM call_sessions
-                WHERE user_id = ? AND saida IS NOT NULL
-                ORDER BY entrada DESC
-                LIMIT 1
-            ''', (str(user_id), ))
+                if not result:
+                    return None
 
-            ultima_sessao = cursor.fetchone()
+                total_segundos, total_sessoes, primeira_call, ultima_call = result
 
-            conn.close()
+                # Busca última sessão
+                ultima_sessao = conn.execute(SQL_ULTIMA_SESSAO,
+                                             (guild_id, user_id)).fetchone()
 
             # Calcula média
             media_segundos = total_segundos / total_sessoes if total_sessoes > 0 else 0
@@ -308,40 +1796,40 @@ class CallTracker:
                 'media_segundos':
                 media_segundos,
                 'primeira_call':
-                datetime.fromisoformat(primeira_call)
-                if primeira_call else None,
+                primeira_call,
                 'ultima_call':
-                datetime.fromisoformat(ultima_call) if ultima_call else None,
+                ultima_call,
                 'ultima_sessao':
                 ultima_sessao,
                 'em_call':
-                user_id in self.usuarios_ativos
+                user_id in self.ativos(guild_id),
+                'versao':
+                self.versao_historico(guild_id, user_id)
             }
 
         except Exception as e:
             logger.error(f"Erro ao obter estatísticas: {e}")
             return None
 
-    def obter_ranking(self, limite=10):
-        """Obtém ranking dos usuários mais ativos"""
+    def obter_ranking(self, guild_id, limite=10):
+        """Obtém ranking dos usuários mais ativos do servidor"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            cache_ranking = self.particao(guild_id).cache_ranking
+            chave = (None, None, limite)
+            ranking = cache_ranking.obter(chave)
+            if ranking is not None:
+                return ranking
 
-            cursor.execute(
-                '''
-                SELECT user_id, user_name, total_segundos, total_sessoes, ultima_call
-                FROM call_stats
-                ORDER BY total_segundos DESC
-                LIMIT ?
-            ''', (limite, ))
+            self.descarregar()
+            with self.conexoes.leitura() as conn:
+                rows = conn.execute(SQL_RANKING, (guild_id, limite)).fetchall()
 
             ranking = []
-            for row in cursor.fetchall():
+            for row in rows:
                 user_id, user_name, total_segundos, total_sessoes, ultima_call = row
                 ranking.append({
                     'user_id':
-                    int(user_id),
+                    user_id,
                     'user_name':
                     user_name,
                     'total_segundos':
@@ -349,28 +1837,116 @@ class CallTracker:
                     'total_sessoes':
                     total_sessoes,
                     'ultima_call':
-                    datetime.fromisoformat(ultima_call)
-                    if ultima_call else None
+                    ultima_call
                 })
 
-            conn.close()
+            cache_ranking.guardar(chave, ranking)
             return ranking
 
         except Exception as e:
             logger.error(f"Erro ao obter ranking: {e}")
             return []
 
-    def obter_tempo_atual(self, user_id):
+    def obter_pagina_historico(self, guild_id, user_id, limite, antes=None,
+                               depois=None):
+        """Obtém uma página de sessões finalizadas, da mais recente para a mais antiga.
+
+        `antes`/`depois` são chaves (entrada, id) de uma página vizinha: a
+        página retornada fica imediatamente antes (mais antiga) ou depois
+        (mais recente) dessa chave. Sem chave, retorna a primeira página.
+        """
+        try:
+            self.descarregar()
+            with self.conexoes.leitura() as conn:
+                if antes is not None:
+                    return conn.execute(SQL_HISTORICO_ANTES,
+                                        (guild_id, user_id, *antes, limite)).fetchall()
+                if depois is not None:
+                    linhas = conn.execute(SQL_HISTORICO_DEPOIS,
+                                          (guild_id, user_id, *depois, limite)).fetchall()
+                    return linhas[::-1]
+                return conn.execute(SQL_HISTORICO_PRIMEIRA_PAGINA,
+                                    (guild_id, user_id, limite)).fetchall()
+        except Exception as e:
+            logger.error(f"Erro ao obter histórico do usuário {user_id}: {e}")
+            return []
+
+    def obter_ultima_pagina_historico(self, guild_id, user_id, limite):
+        """Obtém as `limite` sessões finalizadas mais antigas (última página)."""
+        try:
+            self.descarregar()
+            with self.conexoes.leitura() as conn:
+                linhas = conn.execute(SQL_HISTORICO_ULTIMA_PAGINA,
+                                      (guild_id, user_id, limite)).fetchall()
+            return linhas[::-1]
+        except Exception as e:
+            logger.error(f"Erro ao obter histórico do usuário {user_id}: {e}")
+            return []
+
+    def contar_sessoes_historico(self, guild_id, user_id):
+        """Conta as sessões finalizadas do usuário, como o histórico as pagina."""
+        try:
+            self.descarregar()
+            with self.conexoes.leitura() as conn:
+                return conn.execute(SQL_CONTAR_HISTORICO,
+                                    (guild_id, user_id)).fetchone()[0]
+        except Exception as e:
+            logger.error(f"Erro ao contar histórico do usuário {user_id}: {e}")
+            return 0
+
+    def obter_ranking_periodo(self, guild_id, periodo, limite=10):
+        """Obtém o ranking do período ('dia', 'semana' ou 'mes') a partir de call_daily."""
+        try:
+            cache_ranking = self.particao(guild_id).cache_ranking
+            inicio = relogio.inicio_periodo(periodo).isoformat()
+            chave = (periodo, inicio, limite)
+            ranking = cache_ranking.obter(chave)
+            if ranking is not None:
+                return ranking
+
+            self.descarregar()
+            with self.conexoes.leitura() as conn:
+                rows = conn.execute(SQL_RANKING_PERIODO,
+                                    (guild_id, guild_id, inicio, limite)).fetchall()
+
+            ranking = [{
+                'user_id': user_id,
+                'user_name': user_name or 'Usuário Desconhecido',
+                'total_segundos': total_segundos,
+                'total_sessoes': total_sessoes,
+                'ultima_call': None
+            } for user_id, user_name, total_segundos, total_sessoes in rows]
+            cache_ranking.guardar(chave, ranking)
+            return ranking
+
+        except Exception as e:
+            logger.error(f"Erro ao obter ranking do período {periodo}: {e}")
+            return []
+
+    def reconstruir_consolidado_diario(self):
+        """Reconstrói call_daily a partir de call_sessions (backfill manual)."""
+        try:
+            self.descarregar()
+            with self.conexoes.escrita() as conn:
+                linhas = preencher_call_daily(conn)
+            for particao in list(self._particoes.values()):
+                particao.cache_ranking.invalidar()
+            logger.info(f"Consolidado diário reconstruído com {linhas} linhas")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Erro ao reconstruir consolidado diário: {e}")
+            return False
+
+    def obter_tempo_atual(self, guild_id, user_id):
         """Obtém tempo da sessão atual se usuário estiver em call"""
-        if user_id not in self.usuarios_ativos:
+        dados_sessao = self.ativos(guild_id).get(user_id)
+        if dados_sessao is None:
             return None
 
-        entrada = self.usuarios_ativos[user_id]['entrada']
-        tempo_atual = int(
-            (datetime.now(TZ_SAO_PAULO) - entrada).total_seconds())
-        return tempo_atual
+        return relogio.duracao(dados_sessao)
 
-    def formatar_tempo(self, segundos):
+    @staticmethod
+    def formatar_tempo(segundos):
         """Formata tempo em segundos para formato legível"""
         if segundos < 60:
             return f"{segundos}s"
@@ -384,7 +1960,8 @@ class CallTracker:
             secs = segundos % 60
             return f"{hours}h {mins}m {secs}s"
 
-    def formatar_tempo_hhmmss(self, segundos):
+    @staticmethod
+    def formatar_tempo_hhmmss(segundos):
         """Formata segundos para o formato HH:MM:SS."""
         segundos = int(segundos)
         horas = segundos // 3600
@@ -392,78 +1969,354 @@ class CallTracker:
         segundos_restantes = segundos % 60
         return f"{horas:02}:{minutos:02}:{segundos_restantes:02}"
 
-    def get_user_rank(self, user_id):
-        """Obtém a posição de um usuário no ranking."""
+    def get_user_rank(self, guild_id, user_id):
+        """Obtém a posição de um usuário no ranking do servidor."""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT user_id FROM call_stats ORDER BY total_segundos DESC
-            ''')
-            ranking = cursor.fetchall()
-            conn.close()
-
-            for i, (uid, ) in enumerate(ranking):
-                if str(user_id) == uid:
-                    return i + 1
-            return None
+            return self.particao(guild_id).indice_ranking.posicao(user_id)
         except Exception as e:
             logger.error(f"Erro ao obter rank do usuário {user_id}: {e}")
             return None
 
-    def reset_user_calls(self, user_id):
-        """Apaga todos os registros de chamadas e estatísticas de um usuário."""
+    def reset_user_calls(self, guild_id, user_id):
+        """Apaga todos os registros de chamadas e estatísticas de um usuário no servidor."""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            # Apaga sessões individuais
-            cursor.execute("DELETE FROM call_sessions WHERE user_id = ?", (str(user_id),))
-            # Apaga estatísticas agregadas
-            cursor.execute("DELETE FROM call_stats WHERE user_id = ?", (str(user_id),))
-            conn.commit()
-            conn.close()
+            self.descarregar()
+            with self.conexoes.escrita() as conn:
+                # Apaga sessões individuais
+                conn.execute("DELETE FROM call_sessions WHERE guild_id = ? AND user_id = ?",
+                             (guild_id, user_id))
+                # Apaga estatísticas agregadas
+                conn.execute("DELETE FROM call_stats WHERE guild_id = ? AND user_id = ?",
+                             (guild_id, user_id))
+                conn.execute("DELETE FROM call_daily WHERE guild_id = ? AND user_id = ?",
+                             (guild_id, user_id))
+            particao = self.particao(guild_id)
+            particao.indice_ranking.remover(user_id)
+            particao.cache_ranking.invalidar()
+            self._nova_versao_historico(particao, user_id)
             logger.info(f"Todos os registros de chamadas e estatísticas para o user_id {user_id} foram apagados.")
             return True
         except sqlite3.Error as e:
             logger.error(f"Erro ao apagar registros para o user_id {user_id}: {e}")
             return False
 
-    def reset_all_calls(self):
-        """Apaga TODOS os registros de chamadas e estatísticas do banco de dados."""
+    def reset_all_calls(self, guild_id):
+        """Apaga TODOS os registros de chamadas e estatísticas do servidor."""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM call_sessions")
-            cursor.execute("DELETE FROM call_stats")
-            cursor.execute("DELETE FROM active_users")
-            conn.commit()
-            conn.close()
-            self.usuarios_ativos.clear()
-            logger.info("TODOS os registros de chamadas, estatísticas e usuários ativos foram apagados.")
+            self.descarregar()
+            with self.conexoes.escrita() as conn:
+                conn.execute("DELETE FROM call_sessions WHERE guild_id = ?", (guild_id, ))
+                conn.execute("DELETE FROM call_stats WHERE guild_id = ?", (guild_id, ))
+                conn.execute("DELETE FROM call_daily WHERE guild_id = ?", (guild_id, ))
+            particao = self.particao(guild_id)
+            particao.usuarios_ativos.clear()
+            particao.indice_ranking.limpar()
+            particao.cache_ranking.invalidar()
+            particao.epoca_historico += 1
+            logger.info(f"TODOS os registros de chamadas, estatísticas e usuários ativos do servidor {guild_id} foram apagados.")
             return True
         except sqlite3.Error as e:
             logger.error(f"Erro ao apagar todos os registros: {e}")
             return False
 
-    def recuperar_usuarios_em_call(self, bot):
+    def recuperar_usuarios_em_call(self, bot, desconexao=None):
         """Recupera usuários em call após reinicialização"""
+        return self.reconciliar_presenca([guild.id for guild in bot.guilds],
+                                         listar_membros_em_voz(bot), desconexao)
+
+    def reconciliar_presenca(self, servidores, membros, desconexao=None):
+        """Alinha as sessões abertas com quem está de fato em call.
+
+        `membros` é uma lista de tuplas (guild_id, user_id, user_name, canal,
+        canal_id) sem o canal AFK de cada servidor. Só os servidores em
+        `servidores` são reconciliados. Fecha as sessões de quem saiu enquanto o bot estava
+        fora, abre as de quem entrou e reabre as de quem trocou de canal, tudo
+        em uma única transação. Rodar de novo sem mudanças não altera nada.
+
+        `desconexao` é o momento (epoch, monotônico) em que o gateway caiu,
+        numa reconexão sem reinício, ou o último contato do processo anterior
+        quando um cluster é reiniciado. O tempo depois dele não foi observado:
+        as sessões abertas antes dele são fechadas nesse momento e quem
+        continua em call ganha uma sessão nova, como no reinício com o
+        `last_seen` (o checkpoint continua rodando com o gateway fora, então
+        o `last_seen` não serve de limite aqui).
+        Retorna {'abertas', 'fechadas', 'mantidas'}.
+        """
+        resultado = {'abertas': 0, 'fechadas': 0, 'mantidas': 0}
         try:
-            for guild in bot.guilds:
-                for channel in guild.voice_channels:
-                    for member in channel.members:
-                        if member.id not in self.usuarios_ativos:
-                            self.registrar_entrada(member.id,
-                                                   member.display_name,
-                                                   channel.name)
-                            logger.info(
-                                f"Recuperado: {member.display_name} em {channel.name}"
-                            )
-        except Exception as e:
-            logger.error(f"Erro ao recuperar usuários: {e}")
-
+            presentes = {membro[:2]: membro for membro in membros}
+            with self.diario.em_lote():
+                for guild_id in servidores:
+                    ativos = self.ativos(guild_id)
+                    for user_id, dados in list(ativos.items()):
+                        membro = presentes.get((guild_id, user_id))
+                        interrompida = (desconexao is not None and
+                                        dados['entrada'] < desconexao[0])
+                        if (membro is not None and not interrompida
+                                and self._mesmo_canal(membro, dados)):
+                            resultado['mantidas'] += 1
+                            continue
+                        self.registrar_saida(
+                            guild_id, user_id, dados['user_name'], dados['canal'],
+                            momento=desconexao if interrompida else None)
+                        resultado['fechadas'] += 1
+
+                for guild_id, user_id, user_name, canal, canal_id in presentes.values():
+                    if user_id not in self.ativos(guild_id):
+                        self.registrar_entrada(guild_id, user_id, user_name,
+                                               canal, canal_id)
+                        resultado['abertas'] += 1
+            self.descarregar()
 
-# Instância global do novo sistema
-call_tracker = CallTracker()  # NOVO SISTEMA
+            logger.info(
+                f"Presença reconciliada: {resultado['abertas']} sessões abertas, "
+                f"{resultado['fechadas']} fechadas, {resultado['mantidas']} mantidas")
+        except Exception as e:
+            logger.error(f"Erro ao reconciliar usuários em call: {e}")
+        return resultado
+
+
+    @staticmethod
+    def _mesmo_canal(membro, dados):
+        """Indica se o membro presente continua no canal da sessão aberta."""
+        if dados.get('canal_id') is None:
+            # Sessões migradas pela migração 3 não têm canal_id: compara
+            # pelo nome e passa a guardar o id
+            if membro[3] != dados['canal']:
+                return False
+            dados['canal_id'] = membro[4]
+            return True
+        return membro[4] == dados['canal_id']
+
+
+def listar_membros_em_voz(bot):
+    """Lista (guild_id, user_id, user_name, canal, canal_id) dos membros em canais de voz, exceto o AFK."""
+    return [(guild.id, member.id, member.display_name, channel.name, channel.id)
+            for guild in bot.guilds
+            for channel in guild.voice_channels
+            if channel.id != config_servidor(guild.id).canal_afk_id
+            for member in channel.members
+            if not member.bot]
+
+
+class AsyncCallTracker:
+    """Fachada assíncrona do CallTracker.
+
+    Todo acesso ao banco roda em uma thread dedicada, então o loop do asyncio
+    (gateway, interações e botões) nunca espera pelo disco. Como a thread é
+    única, as operações são aplicadas na mesma ordem em que foram pedidas e
+    `sessao_ativa()` reflete cada operação assim que ela é aguardada. No
+    modo multiprocesso, `tracker` é um ProxyArmazem e a mesma thread faz as
+    chamadas ao processo armazém.
+    """
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="call_tracker")
+
+    async def _executar(self, funcao, *args):
+        """Executa uma função do tracker na thread do banco."""
+        loop = asyncio.get_running_loop()
+        medicao = medicao_atual.get()
+        inicio = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor,
+                                              functools.partial(funcao, *args))
+        finally:
+            # O tempo de espera pela thread também conta como tempo de banco
+            if medicao is not None:
+                medicao.db += time.perf_counter() - inicio
+
+    async def registrar_entrada(self, guild_id, user_id, user_name, canal,
+                                canal_id=None):
+        return await self._executar(self.tracker.registrar_entrada, guild_id,
+                                    user_id, user_name, canal, canal_id)
+
+    async def registrar_saida(self, guild_id, user_id, user_name, canal):
+        return await self._executar(self.tracker.registrar_saida, guild_id,
+                                    user_id, user_name, canal)
+
+    async def aplicar_transicoes(self, transicoes):
+        return await self._executar(self.tracker.aplicar_transicoes,
+                                    transicoes)
+
+    async def obter_estatisticas_usuario(self, guild_id, user_id):
+        return await self._executar(self.tracker.obter_estatisticas_usuario,
+                                    guild_id, user_id)
+
+    async def obter_ranking(self, guild_id, limite=10):
+        return await self._executar(self.tracker.obter_ranking, guild_id,
+                                    limite)
+
+    async def obter_ranking_periodo(self, guild_id, periodo, limite=10):
+        return await self._executar(self.tracker.obter_ranking_periodo,
+                                    guild_id, periodo, limite)
+
+    async def obter_pagina_historico(self, guild_id, user_id, limite,
+                                     antes=None, depois=None):
+        return await self._executar(self.tracker.obter_pagina_historico,
+                                    guild_id, user_id, limite, antes, depois)
+
+    async def obter_ultima_pagina_historico(self, guild_id, user_id, limite):
+        return await self._executar(
+            self.tracker.obter_ultima_pagina_historico, guild_id, user_id,
+            limite)
+
+    async def contar_sessoes_historico(self, guild_id, user_id):
+        return await self._executar(self.tracker.contar_sessoes_historico,
+                                    guild_id, user_id)
+
+    async def get_user_rank(self, guild_id, user_id):
+        return await self._executar(self.tracker.get_user_rank, guild_id,
+                                    user_id)
+
+    async def sessao_ativa(self, guild_id, user_id):
+        return await self._executar(self.tracker.sessao_ativa, guild_id,
+                                    user_id)
+
+    async def estatisticas_rastreamento(self):
+        return await self._executar(self.tracker.estatisticas_rastreamento)
+
+    async def relatorio_sql(self, quantidade=10, ordem='tempo_total'):
+        return await self._executar(self.tracker.relatorio_sql, quantidade,
+                                    ordem)
+
+    async def limpar_perfil_sql(self):
+        return await self._executar(self.tracker.limpar_perfil_sql)
+
+    async def reset_user_calls(self, guild_id, user_id):
+        return await self._executar(self.tracker.reset_user_calls, guild_id,
+                                    user_id)
+
+    async def reset_all_calls(self, guild_id):
+        return await self._executar(self.tracker.reset_all_calls, guild_id)
+
+    async def recuperar_usuarios_em_call(self, bot, desconexao=None):
+        # O estado do Discord é lido no loop; só a escrita vai para a thread
+        servidores = [guild.id for guild in bot.guilds]
+        membros = listar_membros_em_voz(bot)
+        return await self._executar(self.tracker.reconciliar_presenca,
+                                    servidores, membros, desconexao)
+
+    async def atualizar_config_servidor(self, guild_id, campo, valor):
+        return await self._executar(self.tracker.atualizar_config_servidor,
+                                    guild_id, campo, valor)
+
+    async def adotar_servidor_legado(self, bot):
+        """Descobre o servidor dos dados anteriores à separação e os transfere para ele."""
+        config = self.tracker.config_servidores.obter(GUILD_LEGADO_ID)
+        if config is CONFIG_VAZIA:
+            return False
+        canal = bot.get_channel(config.canal_plantoes_id)
+        if GUILD_LEGADO_CONFIGURADO:
+            if bot.get_guild(GUILD_LEGADO_CONFIGURADO) is None:
+                # Pode estar em outro shard/cluster, que fará a adoção
+                logger.info(
+                    f"Servidor {GUILD_LEGADO_CONFIGURADO} (MEDBOT_GUILD_LEGADO) não está "
+                    f"neste processo; dados legados de chamadas mantidos")
+                return False
+            guild_id = GUILD_LEGADO_CONFIGURADO
+        elif canal is not None:
+            guild_id = canal.guild.id
+        elif len(bot.guilds) == 1 and (bot.shard_count or 1) == 1:
+            # Com vários shards, o único servidor deste processo pode não ser o original
+            guild_id = bot.guilds[0].id
+        else:
+            logger.warning(
+                f"Não foi possível identificar o servidor dos dados legados de chamadas "
+                f"({len(bot.guilds)} servidores); dados mantidos. Defina "
+                f"MEDBOT_GUILD_LEGADO com o id do servidor para atribuí-los")
+            return False
+        return await self._executar(self.tracker.adotar_servidor_legado,
+                                    guild_id)
+
+    async def registrar_saude(self, dados):
+        """Envia ao armazém o estado deste cluster (modo multiprocesso)."""
+        return await self._executar(self.tracker.registrar_saude, CLUSTER_ID,
+                                    dados)
+
+    async def saude_clusters(self):
+        """Visão agregada de saúde de todos os clusters (modo multiprocesso)."""
+        return await self._executar(self.tracker.saude_clusters)
+
+    async def descarregar(self):
+        return await self._executar(self.tracker.descarregar)
+
+    async def fechar(self):
+        """Conclui as operações pendentes e fecha o banco."""
+        await self._executar(self.tracker.fechar)
+        self._executor.shutdown(wait=True)
+
+
+# ============== MODO MULTIPROCESSO (CLUSTERS DE SHARDS) ==============
+
+def shards_do_cluster(cluster_id, total_clusters=None, total_shards=None):
+    """Shards atendidos por um cluster: 0, N, 2N... deslocados pelo id do cluster."""
+    total_clusters = total_clusters or TOTAL_CLUSTERS
+    total_shards = total_shards or TOTAL_SHARDS
+    return list(range(cluster_id, total_shards, total_clusters))
+
+
+class ProxyArmazem(ClienteArmazem):
+    """CallTracker remoto usado pelos clusters no modo multiprocesso.
+
+    As chamadas ao armazém passam pelo ClienteArmazem (medbot/armazem.py).
+    A configuração dos servidores fica em uma cópia local, atualizada pelas
+    respostas do armazém, e as partições locais só guardam rankings já
+    renderizados. Configurações trafegam como tuplas simples. Os instantes
+    monotônicos dos eventos valem no armazém porque todos os processos
+    rodam na mesma máquina.
+    """
+
+    formatar_tempo = staticmethod(CallTracker.formatar_tempo)
+    formatar_tempo_hhmmss = staticmethod(CallTracker.formatar_tempo_hhmmss)
+
+    def __init__(self, endereco, chave, espera_conexao=60.0, cluster_id=None):
+        super().__init__(endereco, chave, espera_conexao, cluster_id)
+        self._particoes = {}  # {guild_id: ParticaoServidor}
+        self.config_servidores = ConfiguracaoServidores(None)
+        for valores in self._chamar('listar_configs'):
+            self.config_servidores.guardar(ConfigServidor(*valores))
+
+    def particao(self, guild_id):
+        return self._particoes.setdefault(guild_id, ParticaoServidor(guild_id))
+
+    def atualizar_config_servidor(self, guild_id, campo, valor):
+        config = ConfigServidor(*self._chamar('atualizar_config_servidor',
+                                              guild_id, campo, valor))
+        self.config_servidores.guardar(config)
+        return config
+
+    def adotar_servidor_legado(self, guild_id):
+        adotado = self._chamar_ou_padrao('adotar_servidor_legado', guild_id)
+        if adotado:
+            self.config_servidores.renomear(GUILD_LEGADO_ID, guild_id)
+        return adotado
+
+
+if PAPEL_PROCESSO in ("armazem", "cluster") and chave_armazem() is None:
+    # O lançador sempre gera a chave; os papéis iniciados à mão precisam dela
+    logger.error(
+        "❌ MEDBOT_ARMAZEM_CHAVE não definida! O armazém e os clusters não iniciam "
+        "sem a chave; use MEDBOT_PAPEL=lancador ou defina a mesma chave em todos.")
+    sys.exit(1)
+
+# Instância global do novo sistema. Nos clusters, o tracker é o proxy do
+# processo armazém; o lançador não acessa o banco.
+if PAPEL_PROCESSO == "cluster":
+    call_tracker = ProxyArmazem(ENDERECO_ARMAZEM, chave_armazem(),
+                                cluster_id=CLUSTER_ID)
+elif PAPEL_PROCESSO == "lancador":
+    call_tracker = None
+else:
+    call_tracker = CallTracker()  # NOVO SISTEMA
+call_tracker_async = AsyncCallTracker(call_tracker)
+
+
+def config_servidor(guild_id):
+    """Canais e cargos configurados para o servidor (tabela guild_config)."""
+    return call_tracker.config_servidores.obter(guild_id)
 
 # Configuração dos intents (permissões do bot)
 intents = discord.Intents.default()
@@ -471,8 +2324,905 @@ intents.message_content = True
 intents.members = True
 intents.voice_states = True
 
+# ============== AGENDADOR DE ENVIOS ==============
+
+# Prioridades dos envios (menor = mais urgente)
+PRIORIDADE_MODERACAO = 0
+PRIORIDADE_VERIFICACAO = 1
+PRIORIDADE_RESPOSTA = 2
+PRIORIDADE_PLANTAO = 3
+
+
+class BaldeRota:
+    """Balde de tokens que estima o limite de envios de uma rota do Discord."""
+
+    def __init__(self, capacidade, janela):
+        self.capacidade = capacidade
+        self.taxa = capacidade / janela  # Tokens por segundo
+        self.tokens = float(capacidade)
+        self.atualizado_em = time.monotonic()
+
+    def _repor(self, agora):
+        self.tokens = min(self.capacidade,
+                          self.tokens + (agora - self.atualizado_em) * self.taxa)
+        self.atualizado_em = agora
+
+    def espera(self, agora):
+        """Segundos até haver um token disponível (0 se já houver)."""
+        self._repor(agora)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.taxa
+
+    def consumir(self):
+        self.tokens -= 1
+
+
+class ItemEnvio:
+    """Mensagem aguardando envio pelo agendador."""
+
+    __slots__ = ('prioridade', 'seq', 'rota', 'funcao', 'args', 'kwargs',
+                 'futuros', 'criado_em', 'mesclavel', 'propagar_erros',
+                 'medicao', 'na_fila')
+
+    def __init__(self, prioridade, seq, rota, funcao, args, kwargs, futuro,
+                 mesclavel, propagar_erros):
+        self.prioridade = prioridade
+        self.seq = seq
+        self.rota = rota
+        self.funcao = funcao
+        self.args = args
+        self.kwargs = kwargs
+        self.futuros = [futuro]
+        self.criado_em = time.monotonic()
+        self.mesclavel = mesclavel
+        self.propagar_erros = propagar_erros
+        # O tempo HTTP do envio conta para o comando que o pediu
+        self.medicao = medicao_atual.get()
+        self.na_fila = True  # False depois de enviado, descartado ou mesclado
+
+    def __lt__(self, outro):
+        return (self.prioridade, self.seq) < (outro.prioridade, outro.seq)
+
+
+class AgendadorEnvios:
+    """Fila única de envios ao Discord, ordenada por prioridade.
+
+    Cada rota (canal) tem um balde de tokens que antecipa o limite de taxa do
+    Discord, além de um balde global. Em uma rota, as mensagens saem uma de
+    cada vez e em ordem. Quando a fila passa de `limite_pressao`, itens de
+    baixa prioridade mais velhos que `validade_baixa_prioridade` são
+    descartados e os mescláveis (só embeds) são agrupados em até 10 embeds e
+    6000 caracteres por mensagem. Envios de moderação nunca são mesclados.
+    O alívio é feito em lotes: os descartáveis ficam em ordem de chegada,
+    só as rotas que mudaram são reagrupadas e o próximo alívio espera a
+    fila crescer de novo (metade do limite ou da profundidade).
+    """
+
+    CAPACIDADE_ROTA = 5  # Mensagens por canal...
+    JANELA_ROTA = 5.0  # ...a cada 5 segundos
+    CAPACIDADE_GLOBAL = 50  # Requisições por segundo
+    MAX_EMBEDS = 10
+    MAX_CARACTERES = 6000  # Soma de títulos, descrições, campos e rodapés
+
+    def __init__(self, limite_pressao=50, validade_baixa_prioridade=60.0,
+                 max_simultaneos=4, capacidade_global=CAPACIDADE_GLOBAL):
+        self.limite_pressao = limite_pressao
+        self.validade_baixa_prioridade = validade_baixa_prioridade
+        self.max_simultaneos = max_simultaneos
+        self._filas = {}  # {rota: [ItemEnvio]} (heap)
+        self._profundidade = 0
+        self._descartaveis = deque()  # Itens de baixa prioridade, na ordem de chegada
+        self._rotas_alteradas = set()  # Rotas com itens novos desde o último alívio
+        self._nivel_alivio = limite_pressao  # Profundidade que dispara o próximo alívio
+        self._baldes = {}  # {rota: BaldeRota}
+        self._balde_global = BaldeRota(max(1, capacidade_global), 1.0)
+        self._em_envio = set()  # Rotas com envio em andamento
+        self._tarefas = set()
+        self._seq = 0
+        self._sinal = None
+        self._laco_tarefa = None
+        self.enviados = 0
+        self.descartados = 0
+        self.mesclados = 0
+        self.falhas = 0
+        self._esperas = deque(maxlen=1000)  # Segundos na fila dos últimos envios
+
+    @property
+    def profundidade(self):
+        return self._profundidade
+
+    def agendar(self, rota, prioridade, funcao, *args, mesclavel=False,
+                propagar_erros=False, **kwargs):
+        """Coloca `funcao(*args, **kwargs)` na fila e retorna um Future.
+
+        O Future resolve com o retorno do envio, ou None se o item for
+        descartado ou falhar (exceto com `propagar_erros`).
+        """
+        loop = asyncio.get_running_loop()
+        if self._sinal is None:
+            self._sinal = asyncio.Event()
+        if self._laco_tarefa is None or self._laco_tarefa.done():
+            self._laco_tarefa = loop.create_task(self._laco())
+
+        futuro = loop.create_future()
+        self._seq += 1
+        item = ItemEnvio(prioridade, self._seq, rota, funcao, args, kwargs,
+                         futuro, mesclavel, propagar_erros)
+        heapq.heappush(self._filas.setdefault(rota, []), item)
+        self._profundidade += 1
+        self._rotas_alteradas.add(rota)
+        if prioridade >= PRIORIDADE_PLANTAO:
+            # Os da frente que já saíram da fila não precisam ficar aqui
+            while self._descartaveis and not self._descartaveis[0].na_fila:
+                self._descartaveis.popleft()
+            self._descartaveis.append(item)
+        if self._profundidade > self._nivel_alivio:
+            self._aliviar_pressao()
+        self._sinal.set()
+        return futuro
+
+    def enviar(self, destino, prioridade, **kwargs):
+        """Agenda `destino.send(**kwargs)`; embeds soltos podem ser mesclados."""
+        if 'embed' in kwargs:
+            kwargs['embeds'] = [kwargs.pop('embed')]
+        mesclavel = set(kwargs) == {'embeds'}
+        return self.agendar(destino.id, prioridade, destino.send,
+                            mesclavel=mesclavel, **kwargs)
+
+    def _aliviar_pressao(self):
+        agora = time.monotonic()
+        # Os descartáveis estão em ordem de chegada: só os vencidos são visitados
+        while (self._descartaveis and agora - self._descartaveis[0].criado_em >
+               self.validade_baixa_prioridade):
+            item = self._descartaveis.popleft()
+            if item.na_fila:
+                item.na_fila = False
+                self.descartados += len(item.futuros)
+                self._resolver(item, None)
+                self._rotas_alteradas.add(item.rota)
+
+        for rota in self._rotas_alteradas:
+            fila = self._filas.get(rota)
+            if not fila:
+                continue
+            fila = self._mesclar([item for item in fila if item.na_fila])
+            heapq.heapify(fila)
+            self._filas[rota] = fila
+        self._rotas_alteradas.clear()
+        self._profundidade = sum(len(fila) for fila in self._filas.values())
+        self._nivel_alivio = (self._profundidade +
+                              max(self.limite_pressao, self._profundidade) // 2)
+
+    @staticmethod
+    def _caracteres(item):
+        return sum(len(embed) for embed in item.kwargs['embeds'])
+
+    def _cabe_junto(self, anterior, item):
+        """Indica se os embeds de `item` cabem na mesma mensagem de `anterior`."""
+        if not (item.mesclavel and anterior.mesclavel):
+            return False
+        if (anterior.prioridade != item.prioridade or
+                item.prioridade == PRIORIDADE_MODERACAO):
+            return False
+        if (len(anterior.kwargs['embeds']) + len(item.kwargs['embeds']) >
+                self.MAX_EMBEDS):
+            return False
+        return (self._caracteres(anterior) + self._caracteres(item) <=
+                self.MAX_CARACTERES)
+
+    def _mesclar(self, itens):
+        """Agrupa itens mescláveis da mesma prioridade em mensagens de até 10 embeds."""
+        itens.sort()
+        resultado = []
+        for item in itens:
+            anterior = resultado[-1] if resultado else None
+            if anterior is not None and self._cabe_junto(anterior, item):
+                anterior.kwargs['embeds'] = (anterior.kwargs['embeds'] +
+                                             item.kwargs['embeds'])
+                anterior.futuros.extend(item.futuros)
+                item.na_fila = False
+                self.mesclados += 1
+            else:
+                resultado.append(item)
+        return resultado
+
+    def _proximo(self):
+        """Escolhe o próximo item pronto; senão, retorna a espera sugerida."""
+        agora = time.monotonic()
+        espera_global = self._balde_global.espera(agora)
+        if espera_global:
+            return None, espera_global
+
+        melhor = None
+        menor_espera = None
+        for rota, fila in self._filas.items():
+            if not fila or rota in self._em_envio:
+                continue
+            balde = self._baldes.get(rota)
+            if balde is None:
+                balde = self._baldes[rota] = BaldeRota(self.CAPACIDADE_ROTA,
+                                                       self.JANELA_ROTA)
+            espera = balde.espera(agora)
+            if espera:
+                menor_espera = espera if menor_espera is None else min(menor_espera, espera)
+            elif melhor is None or fila[0] < melhor:
+                melhor = fila[0]
+
+        if melhor is None:
+            return None, menor_espera
+        heapq.heappop(self._filas[melhor.rota])
+        melhor.na_fila = False
+        self._profundidade -= 1
+        if self._profundidade <= self.limite_pressao:
+            self._nivel_alivio = self.limite_pressao
+        self._baldes[melhor.rota].consumir()
+        self._balde_global.consumir()
+        return melhor, None
+
+    async def _laco(self):
+        while True:
+            if len(self._tarefas) >= self.max_simultaneos:
+                await asyncio.wait(self._tarefas,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            item, espera = self._proximo()
+            if item is None:
+                self._sinal.clear()
+                try:
+                    await asyncio.wait_for(self._sinal.wait(), timeout=espera)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._em_envio.add(item.rota)
+            tarefa = asyncio.create_task(self._executar(item))
+            self._tarefas.add(tarefa)
+            tarefa.add_done_callback(self._tarefas.discard)
+
+    async def _executar(self, item):
+        self._esperas.append(time.monotonic() - item.criado_em)
+        token = medicao_atual.set(item.medicao)
+        try:
+            resultado = await item.funcao(*item.args, **item.kwargs)
+        except Exception as e:
+            self.falhas += 1
+            if item.propagar_erros:
+                for futuro in item.futuros:
+                    if not futuro.done():
+                        futuro.set_exception(e)
+            else:
+                logger.error(f"Falha em envio agendado para a rota {item.rota}: {e}")
+                self._resolver(item, None)
+        else:
+            self.enviados += 1
+            self._resolver(item, resultado)
+        finally:
+            medicao_atual.reset(token)
+            self._em_envio.discard(item.rota)
+            self._sinal.set()
+
+    @staticmethod
+    def _resolver(item, resultado):
+        for futuro in item.futuros:
+            if not futuro.done():
+                futuro.set_result(resultado)
+
+    def estatisticas(self):
+        esperas = sorted(self._esperas)
+
+        def percentil(p):
+            if not esperas:
+                return 0.0
+            return esperas[min(len(esperas) - 1, int(p * len(esperas)))]
+
+        return {
+            'profundidade': self.profundidade,
+            'por_prioridade': {
+                prioridade: sum(1 for fila in self._filas.values()
+                                for item in fila if item.prioridade == prioridade)
+                for prioridade in (PRIORIDADE_MODERACAO, PRIORIDADE_VERIFICACAO,
+                                   PRIORIDADE_RESPOSTA, PRIORIDADE_PLANTAO)
+            },
+            'enviados': self.enviados,
+            'descartados': self.descartados,
+            'mesclados': self.mesclados,
+            'falhas': self.falhas,
+            'espera_p50': percentil(0.50),
+            'espera_p95': percentil(0.95),
+            'espera_max': esperas[-1] if esperas else 0.0
+        }
+
+    async def parar(self, timeout=10.0):
+        """Aguarda a fila esvaziar (até `timeout`) e encerra o laço."""
+        limite = time.monotonic() + timeout
+        while (self.profundidade or self._tarefas) and time.monotonic() < limite:
+            await asyncio.sleep(0.1)
+        if self._laco_tarefa is not None:
+            self._laco_tarefa.cancel()
+            self._laco_tarefa = None
+
+
+# O limite global do Discord vale para o bot inteiro: no modo multiprocesso,
+# cada cluster fica com uma fração dele
+agendador_envios = AgendadorEnvios(
+    capacidade_global=AgendadorEnvios.CAPACIDADE_GLOBAL //
+    (TOTAL_CLUSTERS if PAPEL_PROCESSO == "cluster" else 1))
+
+
+class ContextoMedBot(commands.Context):
+    """Contexto de comando cujas respostas passam pelo agendador de envios."""
+
+    async def send(self, *args, **kwargs):
+        return await agendador_envios.agendar(self.channel.id,
+                                              PRIORIDADE_RESPOSTA,
+                                              super().send,
+                                              *args,
+                                              propagar_erros=True,
+                                              **kwargs)
+
+
+class MedBot(commands.AutoShardedBot
+             if PAPEL_PROCESSO == "cluster" else commands.Bot):
+    """Bot do servidor, com os ganchos de desligamento dos serviços em segundo plano.
+
+    Nos clusters do modo multiprocesso é um AutoShardedBot que abre só os
+    shards do cluster.
+    """
+
+    # Momento (epoch, monotônico) em que o gateway caiu; None se conectado
+    # ou se a sessão foi retomada (o Discord reenvia os eventos perdidos)
+    desconectado_em = None
+
+    async def setup_hook(self):
+        # Requisições REST (comandos e envios) e respostas de interações
+        cronometrar_http(self.http)
+        cronometrar_http(discord.webhook.async_.async_context.get())
+        if PAPEL_PROCESSO == "cluster":
+            self._tarefa_saude = asyncio.create_task(relatar_saude())
+
+    async def get_context(self, origin, *, cls=ContextoMedBot):
+        return await super().get_context(origin, cls=cls)
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        nome = f"!{ctx.command.qualified_name}"
+        inicio = time.perf_counter()
+        with registro_desempenho.medir(nome) as medicao:
+            await super().invoke(ctx)
+            medicao.erro = ctx.command_failed
+        logger.info(
+            f"Comando {nome} usado por {ctx.author}",
+            extra={'evento': 'comando', 'comando': nome,
+                   'guild_id': ctx.guild.id if ctx.guild else None,
+                   'user_id': ctx.author.id,
+                   'duracao_ms': round((time.perf_counter() - inicio) * 1000, 1),
+                   'erro': ctx.command_failed})
+
+    async def close(self):
+        # Aplica os eventos de voz pendentes e envia os logs acumulados
+        # enquanto a sessão HTTP ainda está aberta
+        await pipeline_voz.parar()
+        await digest_plantao.parar()
+        await agendador_envios.parar()
+        await super().close()
+
+
 # Inicialização do bot
-bot = commands.Bot(command_prefix='!', intents=intents, help_command=None)
+opcoes_shards = {}
+if PAPEL_PROCESSO == "cluster":
+    opcoes_shards = {'shard_ids': shards_do_cluster(CLUSTER_ID),
+                     'shard_count': TOTAL_SHARDS}
+bot = MedBot(command_prefix='!', intents=intents, help_command=None,
+             **opcoes_shards)
+
+# ============== RESOLUÇÃO DE NOMES ==============
+
+
+class ResolvedorNomes:
+    """Resolve nomes de exibição de usuários para os embeds.
+
+    Consulta primeiro o cache de membros do servidor, depois um cache LRU com
+    TTL de usuários já buscados e só então chama `fetch_user`, em paralelo e
+    limitado por um semáforo. Se tudo falhar, usa o nome informado como
+    padrão (o `user_name` guardado em call_stats).
+    """
+
+    def __init__(self, bot, capacidade=512, ttl_segundos=600,
+                 max_concorrentes=4):
+        self.bot = bot
+        self.capacidade = capacidade
+        self.ttl_segundos = ttl_segundos
+        self._cache = OrderedDict()  # {user_id: (nome, expira_em)}
+        self._semaforo = asyncio.Semaphore(max_concorrentes)
+        self._buscando = {}  # {user_id: asyncio.Task}
+        self.acertos = 0  # Nomes resolvidos sem chamar a API
+        self.falhas = 0
+
+    def nome_em_cache(self, user_id, guild=None):
+        """Nome disponível sem chamadas à API, ou None."""
+        nome = self._nome_em_cache(user_id, guild)
+        if nome is None:
+            self.falhas += 1
+        else:
+            self.acertos += 1
+        return nome
+
+    def _nome_em_cache(self, user_id, guild):
+        if guild is not None:
+            membro = guild.get_member(user_id)
+            if membro is not None:
+                return membro.display_name
+
+        entrada = self._cache.get(user_id)
+        if entrada is not None:
+            nome, expira_em = entrada
+            if expira_em > time.monotonic():
+                self._cache.move_to_end(user_id)
+                return nome
+            del self._cache[user_id]
+
+        usuario = self.bot.get_user(user_id)
+        return usuario.display_name if usuario else None
+
+    def _guardar(self, user_id, nome):
+        self._cache[user_id] = (nome, time.monotonic() + self.ttl_segundos)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.capacidade:
+            self._cache.popitem(last=False)
+
+    async def _buscar(self, user_id):
+        async with self._semaforo:
+            try:
+                usuario = await self.bot.fetch_user(user_id)
+            except discord.HTTPException:
+                return None
+        self._guardar(user_id, usuario.display_name)
+        return usuario.display_name
+
+    async def nome(self, user_id, guild=None, padrao="Usuário Desconhecido"):
+        """Resolve o nome de exibição de um usuário."""
+        nome = self.nome_em_cache(user_id, guild)
+        if nome is not None:
+            return nome
+
+        # Pedidos simultâneos do mesmo usuário compartilham a busca
+        tarefa = self._buscando.get(user_id)
+        if tarefa is None:
+            tarefa = asyncio.ensure_future(self._buscar(user_id))
+            self._buscando[user_id] = tarefa
+            tarefa.add_done_callback(
+                lambda _: self._buscando.pop(user_id, None))
+        nome = await tarefa
+        return nome if nome is not None else padrao
+
+    async def nomes(self, usuarios, guild=None):
+        """Resolve vários nomes em paralelo; `usuarios` é [(user_id, padrão)]."""
+        return await asyncio.gather(*(self.nome(user_id, guild, padrao)
+                                      for user_id, padrao in usuarios))
+
+
+resolvedor_nomes = ResolvedorNomes(bot)
+
+# ============== LOGS DE PLANTÃO ==============
+
+
+class DigestPlantao:
+    """Agrupa os logs de voz por canal antes de enviá-los.
+
+    No modo "evento" cada embed é enviado na hora. Nos modos "digest" e
+    "resumo" os embeds ficam em um buffer por canal e são enviados a cada
+    `intervalo` segundos: até 10 embeds por mensagem ou um único embed
+    compacto com uma linha por evento.
+    """
+
+    MAX_EMBEDS_POR_MENSAGEM = 10
+    MAX_DESCRICAO = 4096
+
+    def __init__(self, bot, modo=MODO_LOG_PLANTAO,
+                 intervalo=INTERVALO_DIGEST_PLANTAO):
+        self.bot = bot
+        self.modo = modo
+        self.intervalo = intervalo
+        self._buffers = {}  # {canal_id: [embed]}
+        self._tarefa = None
+
+    async def registrar(self, canal_id, embed):
+        """Envia ou acumula o log de um evento de voz."""
+        if self.modo == "evento":
+            await self._enviar(canal_id, embeds=[embed])
+            return
+        self._buffers.setdefault(canal_id, []).append(embed)
+        if self._tarefa is None or self._tarefa.done():
+            self._tarefa = asyncio.create_task(self._laco())
+
+    async def _laco(self):
+        while self._buffers:
+            await asyncio.sleep(self.intervalo)
+            await self.descarregar()
+
+    async def descarregar(self):
+        """Envia imediatamente todos os logs acumulados."""
+        buffers, self._buffers = self._buffers, {}
+        for canal_id, embeds in buffers.items():
+            if self.modo == "resumo":
+                for resumo in self._montar_resumos(embeds):
+                    await self._enviar(canal_id, embeds=[resumo])
+            else:
+                n = self.MAX_EMBEDS_POR_MENSAGEM
+                for i in range(0, len(embeds), n):
+                    await self._enviar(canal_id, embeds=embeds[i:i + n])
+
+    def _montar_resumos(self, embeds):
+        """Compacta os eventos em embeds de resumo, uma linha por evento."""
+        resumos = []
+        linhas = []
+        tamanho = 0
+        for embed in embeds:
+            hora = embed.timestamp.astimezone(TZ_SAO_PAULO).strftime('%H:%M:%S')
+            linha = f"`{hora}` {embed.description}"
+            if linhas and tamanho + len(linha) + 1 > self.MAX_DESCRICAO:
+                resumos.append(linhas)
+                linhas, tamanho = [], 0
+            linhas.append(linha)
+            tamanho += len(linha) + 1
+        if linhas:
+            resumos.append(linhas)
+
+        return [discord.Embed(
+            title="📋 Resumo de Plantão",
+            description="\n".join(linhas_resumo),
+            color=COR_PRINCIPAL,
+            timestamp=datetime.now(TZ_SAO_PAULO)
+        ).set_footer(text=f"{len(linhas_resumo)} eventos de voz")
+                for linhas_resumo in resumos]
+
+    async def _enviar(self, canal_id, embeds):
+        canal = self.bot.get_channel(canal_id)
+        if not canal:
+            return
+        # Baixa prioridade: não aguarda o envio efetivo
+        agendador_envios.enviar(canal, PRIORIDADE_PLANTAO, embeds=embeds)
+
+    async def parar(self):
+        """Cancela o envio periódico e envia o que restou no buffer."""
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            self._tarefa = None
+        await self.descarregar()
+
+
+digest_plantao = DigestPlantao(bot)
+
+# ============== PIPELINE DE EVENTOS DE VOZ ==============
+
+# Registro compacto de um evento de voz: só o necessário para as transições e o log
+EventoVoz = namedtuple('EventoVoz', [
+    'guild_id', 'user_id', 'nome', 'mencao', 'avatar_url', 'antes_id', 'antes_nome',
+    'depois_id', 'depois_nome', 'epoch', 'mono'
+])
+
+
+class PipelineVoz:
+    """Desacopla o gateway do processamento dos eventos de voz.
+
+    O handler só coloca um `EventoVoz` na fila e retorna. Um único worker
+    consome a fila em lotes, aplica as transições no CallTracker (uma ida à
+    thread do banco por lote) e gera os logs de plantão. Com um só worker, os
+    eventos de cada usuário são aplicados na ordem em que chegaram. A fila é
+    limitada: quando enche, o handler espera (backpressure).
+    """
+
+    ETAPAS = ('fila', 'rastreamento', 'logs')
+
+    def __init__(self, tracker_async, digest, capacidade=FILA_VOZ_CAPACIDADE,
+                 tamanho_lote=FILA_VOZ_LOTE):
+        self.tracker_async = tracker_async
+        self.digest = digest
+        self.capacidade = capacidade
+        self.tamanho_lote = tamanho_lote
+        self._fila = None
+        self._tarefa = None
+        self.processados = 0
+        self.lotes = 0
+        self.esperas_fila_cheia = 0
+        # Últimas medições (segundos) de cada etapa
+        self._tempos = {etapa: deque(maxlen=1000) for etapa in self.ETAPAS}
+
+    @property
+    def profundidade(self):
+        return self._fila.qsize() if self._fila is not None else 0
+
+    async def registrar(self, member, before, after):
+        """Enfileira o evento de voz de `member`; espera apenas se a fila estiver cheia."""
+        if self._fila is None:
+            self._fila = asyncio.Queue(maxsize=self.capacidade)
+        if self._tarefa is None or self._tarefa.done():
+            self._tarefa = asyncio.create_task(self._laco())
+
+        epoch, mono = relogio.marcar()
+        evento = EventoVoz(
+            member.guild.id, member.id, member.display_name, member.mention,
+            member.display_avatar.url,
+            before.channel.id if before.channel else None,
+            before.channel.name if before.channel else None,
+            after.channel.id if after.channel else None,
+            after.channel.name if after.channel else None,
+            epoch, mono)
+        if self._fila.full():
+            self.esperas_fila_cheia += 1
+        await self._fila.put(evento)
+
+    async def _laco(self):
+        while True:
+            lote = [await self._fila.get()]
+            while len(lote) < self.tamanho_lote:
+                try:
+                    lote.append(self._fila.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await self._processar(lote)
+            except Exception as e:
+                logger.error(f"Erro ao processar lote de eventos de voz: {e}")
+            finally:
+                for _ in lote:
+                    self._fila.task_done()
+
+    async def _processar(self, lote):
+        inicio = time.monotonic()
+        for evento in lote:
+            self._tempos['fila'].append(inicio - evento.mono)
+
+        transicoes = []
+        for evento in lote:
+            transicoes.extend(self._transicoes(evento))
+        if transicoes:
+            await self.tracker_async.aplicar_transicoes(transicoes)
+        meio = time.monotonic()
+        self._tempos['rastreamento'].append(meio - inicio)
+
+        for evento in lote:
+            canal_plantoes_id = config_servidor(evento.guild_id).canal_plantoes_id
+            if canal_plantoes_id:
+                await self.digest.registrar(canal_plantoes_id,
+                                            self._montar_log(evento))
+        self._tempos['logs'].append(time.monotonic() - meio)
+
+        self.processados += len(lote)
+        self.lotes += 1
+
+    def _transicoes(self, evento):
+        """Transições de voz do evento; o tempo no canal AFK não é contado."""
+        transicoes = []
+        momento = (evento.epoch, evento.mono)
+        canal_afk_id = config_servidor(evento.guild_id).canal_afk_id
+        if evento.antes_id is not None and evento.antes_id != canal_afk_id:
+            transicoes.append(('saida', evento.guild_id, evento.user_id,
+                               evento.nome, evento.antes_nome, momento))
+        if evento.depois_id is not None and evento.depois_id != canal_afk_id:
+            transicoes.append(('entrada', evento.guild_id, evento.user_id,
+                               evento.nome, evento.depois_nome,
+                               evento.depois_id, momento))
+        return transicoes
+
+    def _montar_log(self, evento):
+        # Caso 1: Usuário entra em um canal de voz
+        if evento.antes_id is None:
+            descricao = f"▶️ {evento.mencao} entrou no canal de voz `{evento.depois_nome}`."
+            cor = COR_VERDE
+        # Caso 2: Usuário sai de um canal de voz
+        elif evento.depois_id is None:
+            descricao = f"⏹️ {evento.mencao} saiu do canal de voz `{evento.antes_nome}`."
+            cor = COR_PRINCIPAL
+        # Caso 3: Usuário muda de canal de voz
+        else:
+            descricao = f"🔄 {evento.mencao} mudou do canal `{evento.antes_nome}` para `{evento.depois_nome}`."
+            cor = COR_LARANJA
+
+        return discord.Embed(
+            description=descricao,
+            color=cor,
+            timestamp=datetime.fromtimestamp(evento.epoch, TZ_SAO_PAULO)
+        ).set_author(name=evento.nome, icon_url=evento.avatar_url)
+
+    def estatisticas(self):
+        """Profundidade da fila, totais e tempos (média/p95/máx) por etapa."""
+        etapas = {}
+        for etapa, tempos in self._tempos.items():
+            ordenados = sorted(tempos)
+            if ordenados:
+                etapas[etapa] = {
+                    'media': sum(ordenados) / len(ordenados),
+                    'p95': ordenados[min(len(ordenados) - 1,
+                                         int(0.95 * len(ordenados)))],
+                    'max': ordenados[-1]
+                }
+            else:
+                etapas[etapa] = {'media': 0.0, 'p95': 0.0, 'max': 0.0}
+        return {
+            'profundidade': self.profundidade,
+            'processados': self.processados,
+            'lotes': self.lotes,
+            'esperas_fila_cheia': self.esperas_fila_cheia,
+            'etapas': etapas
+        }
+
+    async def esvaziar(self):
+        """Aguarda até que todos os eventos enfileirados tenham sido aplicados."""
+        if self._fila is not None and self._tarefa is not None:
+            await self._fila.join()
+
+    async def parar(self, timeout=10.0):
+        """Processa os eventos pendentes (até `timeout`) e encerra o worker."""
+        if self._tarefa is None:
+            return
+        try:
+            await asyncio.wait_for(self._fila.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"{self.profundidade} eventos de voz descartados no desligamento")
+        self._tarefa.cancel()
+        self._tarefa = None
+        stats = self.estatisticas()
+        logger.info(
+            f"Pipeline de voz encerrado: {stats['processados']} eventos em {stats['lotes']} lotes")
+
+
+pipeline_voz = PipelineVoz(call_tracker_async, digest_plantao)
+
+# ============== SAÚDE DOS CLUSTERS ==============
+
+
+def coletar_saude():
+    """Estado deste processo de bot, no formato da visão agregada de saúde."""
+    if PAPEL_PROCESSO == "cluster":
+        latencias = dict(bot.latencies)
+    else:
+        latencias = {0: bot.latency}
+    envios = agendador_envios.estatisticas()
+    return {
+        'pid': os.getpid(),
+        'pronto': bot.is_ready(),
+        'servidores': len(bot.guilds),
+        'latencias': {shard: latencia * 1000 if math.isfinite(latencia) else None
+                      for shard, latencia in latencias.items()},
+        'fila_voz': pipeline_voz.profundidade,
+        'fila_envios': envios['profundidade'],
+        'falhas_envio': envios['falhas'],
+        'atualizado': time.time()
+    }
+
+
+async def relatar_saude():
+    """Envia periodicamente ao armazém o estado deste cluster."""
+    while True:
+        try:
+            await call_tracker_async.registrar_saude(coletar_saude())
+        except Exception as e:
+            logger.error(f"Erro ao relatar a saúde do cluster {CLUSTER_ID}: {e}")
+        await asyncio.sleep(INTERVALO_SAUDE_S)
+
+# ============== MÉTRICAS (PROMETHEUS) ==============
+
+
+async def coletar_metricas(saida):
+    """Escreve em `saida` (TextoPrometheus) as métricas do bot para o /metrics."""
+    saida.metrica("medbot_info", "gauge", "Papel e cluster deste processo.",
+                  [({'papel': PAPEL_PROCESSO, 'cluster': CLUSTER_ID}, 1)])
+
+    # Rastreamento de chamadas (no armazém, no modo multiprocesso)
+    rastreamento = await call_tracker_async.estatisticas_rastreamento()
+    saida.metrica("medbot_sessoes_ativas", "gauge",
+                  "Usuários em call sendo rastreados, por servidor.",
+                  [({'guild': guild_id}, total) for guild_id, total
+                   in rastreamento['sessoes_ativas'].items()])
+    saida.histograma("medbot_db_transacao_segundos",
+                     "Duração das transações de escrita do diário no banco.",
+                     [({}, rastreamento['transacoes'])])
+    saida.metrica("medbot_db_eventos_gravados_total", "counter",
+                  "Sessões gravadas pelo diário de escrita.",
+                  [({}, rastreamento['eventos_gravados'])])
+    saida.metrica("medbot_db_falhas_gravacao_consecutivas", "gauge",
+                  "Gravações seguidas do diário que falharam (0 = normal).",
+                  [({}, rastreamento['diario']['falhas_consecutivas'])])
+    saida.metrica("medbot_db_eventos_pendentes", "gauge",
+                  "Eventos do diário aguardando gravação.",
+                  [({}, rastreamento['diario']['pendentes'])])
+    saida.metrica("medbot_db_checkpoints_total", "counter",
+                  "Checkpoints das sessões abertas.",
+                  [({}, rastreamento['checkpoints'])])
+
+    # Pipeline de eventos de voz
+    voz = pipeline_voz.estatisticas()
+    saida.metrica("medbot_eventos_voz_processados_total", "counter",
+                  "Eventos de voz aplicados no rastreamento.",
+                  [({}, voz['processados'])])
+    saida.metrica("medbot_eventos_voz_lotes_total", "counter",
+                  "Lotes de eventos de voz processados.", [({}, voz['lotes'])])
+    saida.metrica("medbot_fila_voz_profundidade", "gauge",
+                  "Eventos de voz aguardando na fila.", [({}, voz['profundidade'])])
+    saida.metrica("medbot_fila_voz_esperas_total", "counter",
+                  "Vezes em que o handler esperou a fila de voz cheia.",
+                  [({}, voz['esperas_fila_cheia'])])
+
+    # Fila de envios
+    envios = agendador_envios.estatisticas()
+    saida.metrica("medbot_fila_envios_profundidade", "gauge",
+                  "Mensagens aguardando envio, por prioridade.",
+                  [({'prioridade': prioridade}, total) for prioridade, total
+                   in envios['por_prioridade'].items()])
+    saida.metrica("medbot_envios_total", "counter",
+                  "Mensagens que saíram da fila, por resultado.",
+                  [({'resultado': resultado}, envios[resultado]) for resultado
+                   in ('enviados', 'descartados', 'mesclados', 'falhas')])
+
+    # Gateway
+    if PAPEL_PROCESSO == "cluster":
+        latencias = dict(bot.latencies)
+    else:
+        latencias = {0: bot.latency}
+    saida.metrica("medbot_gateway_latencia_segundos", "gauge",
+                  "Latência do heartbeat do gateway, por shard.",
+                  [({'shard': shard}, latencia) for shard, latencia
+                   in latencias.items() if math.isfinite(latencia)])
+
+    # Caches
+    acertos, falhas = [], []
+    for guild_id, cache in rastreamento['cache_ranking'].items():
+        rotulos = {'cache': 'ranking', 'guild': guild_id}
+        acertos.append((rotulos, cache['acertos']))
+        falhas.append((rotulos, cache['falhas']))
+    acertos.append(({'cache': 'nomes', 'guild': ''}, resolvedor_nomes.acertos))
+    falhas.append(({'cache': 'nomes', 'guild': ''}, resolvedor_nomes.falhas))
+    acertos.append(({'cache': 'paginas', 'guild': ''}, cache_paginas.acertos))
+    falhas.append(({'cache': 'paginas', 'guild': ''}, cache_paginas.falhas))
+    saida.metrica("medbot_cache_acertos_total", "counter",
+                  "Consultas respondidas pelo cache.", acertos)
+    saida.metrica("medbot_cache_falhas_total", "counter",
+                  "Consultas que não estavam no cache.", falhas)
+    taxas = []
+    for (rotulos, acerto), (_, falha) in zip(acertos, falhas):
+        if acerto + falha:
+            taxas.append((rotulos, acerto / (acerto + falha)))
+    saida.metrica("medbot_cache_taxa_acerto", "gauge",
+                  "Fração das consultas respondidas pelo cache.", taxas)
+
+    # Views interativas abertas
+    views = registro_views.estatisticas()
+    saida.metrica("medbot_views_abertas", "gauge",
+                  "Views interativas abertas, por tipo.",
+                  [({'tipo': tipo}, total) for tipo, total
+                   in views['por_tipo'].items()])
+    saida.metrica("medbot_views_memoria_bytes", "gauge",
+                  "Memória aproximada do estado das views abertas.",
+                  [({}, views['memoria_bytes'])])
+    saida.metrica("medbot_views_despejadas_total", "counter",
+                  "Views encerradas por passar do limite.",
+                  [({'limite': limite}, total) for limite, total
+                   in views['despejadas'].items()])
+
+    # Comandos e interações (mesmos dados do !perf)
+    metricas = registro_desempenho.metricas()
+    for sufixo, campo, ajuda in (
+            ('duracao', 'total', "Duração dos comandos e interações."),
+            ('banco', 'db', "Tempo gasto no banco por comando ou interação."),
+            ('http', 'http', "Tempo gasto em chamadas HTTP por comando ou interação.")):
+        saida.histograma(f"medbot_comando_{sufixo}_segundos", ajuda,
+                         [({'comando': nome}, dados[campo].instantaneo())
+                          for nome, dados in metricas.items()])
+    saida.metrica("medbot_comando_erros_total", "counter",
+                  "Comandos e interações que terminaram em erro.",
+                  [({'comando': nome}, dados['erros'])
+                   for nome, dados in metricas.items()])
+
+
+servidor_metricas = ServidorMetricas(
+    METRICAS_HOST,
+    METRICAS_PORTA + (CLUSTER_ID if PAPEL_PROCESSO == "cluster" else 0),
+    coletar_metricas)
 
 # ============== EVENTOS ==============
 
@@ -483,14 +3233,38 @@ async def on_ready():
     logger.info(f'{bot.user} está online!')
     logger.info(f'Bot conectado em {len(bot.guilds)} servidor(es)')
 
-    # Recupera usuários que estavam em call antes do reinício
-    call_tracker.recuperar_usuarios_em_call(bot)  # NOVO
+    # Dados gravados antes da separação por servidor vão para o servidor original
+    await call_tracker_async.adotar_servidor_legado(bot)
+
+    # Reconcilia as sessões abertas com quem está em call agora (também
+    # roda nas reconexões). Os eventos já enfileirados são aplicados antes.
+    await pipeline_voz.esvaziar()
+    desconexao, bot.desconectado_em = bot.desconectado_em, None
+    if desconexao is None and PAPEL_PROCESSO == "cluster":
+        # Cluster reiniciado pelo lançador: o armazém manteve as sessões dele
+        # abertas (e o checkpoint seguiu avançando o last_seen); o limite é o
+        # último contato do processo anterior com o armazém
+        desconexao, call_tracker.contato_anterior = call_tracker.contato_anterior, None
+    await call_tracker_async.recuperar_usuarios_em_call(bot, desconexao)
 
     # Ativa o status do bot
     await bot.change_presence(activity=discord.Activity(
         type=discord.ActivityType.watching, name="novos membros e calls!"))
 
 
+@bot.event
+async def on_disconnect():
+    """Guarda quando o gateway caiu, para a reconciliação do próximo on_ready."""
+    if bot.desconectado_em is None:
+        bot.desconectado_em = relogio.marcar()
+
+
+@bot.event
+async def on_resumed():
+    """Sessão retomada: os eventos perdidos são reenviados pelo Discord."""
+    bot.desconectado_em = None
+
+
 @bot.event
 async def on_member_join(member):
     """Evento executado quando um membro entra no servidor"""
@@ -540,68 +3314,54 @@ async def on_member_join(member):
         logger.error(f"Erro ao enviar boas-vindas para {member.name}: {e}")
 
 
+@bot.event
+async def on_member_update(before, after):
+    if before.roles != after.roles:
+        invalidar_hierarquia(after.guild.id)
+
+
+@bot.event
+async def on_member_remove(member):
+    invalidar_hierarquia(member.guild.id)
+
+
+@bot.event
+async def on_guild_role_update(before, after):
+    invalidar_hierarquia(after.guild.id)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    invalidar_hierarquia(role.guild.id)
+
+
 @bot.event
 async def on_voice_state_update(member, before, after):
     """Monitora as atividades de voz dos membros e registra no canal de plantão."""
     if member.bot:
         return
 
-    canal_log = bot.get_channel(CANAL_CONTROLE_PLANTOES_ID)
-    afk_channel_id = 1388624317159440539  # Certifique-se que este é o ID correto do seu canal AFK
+    # Mute, deafen, transmissão etc. não mudam o canal: nada a registrar
+    if before.channel == after.channel:
+        return
 
-    # Função auxiliar para enviar logs de forma segura
-    async def enviar_log(embed):
-        if canal_log:
-            try:
-                await canal_log.send(embed=embed)
-            except Exception as e:
-                logger.error(f"Falha ao enviar log para o canal de plantão: {e}")
+    # O rastreamento e os logs são aplicados pelo worker do pipeline
+    await pipeline_voz.registrar(member, before, after)
 
-    # Caso 1: Usuário entra em um canal de voz
-    if before.channel is None and after.channel is not None:
-        if after.channel.id != afk_channel_id:
-            call_tracker.registrar_entrada(member.id, member.display_name, after.channel.name)
 
-        embed = discord.Embed(
-            description=f"▶️ {member.mention} entrou no canal de voz `{after.channel.name}`.",
-            color=COR_VERDE,
-            timestamp=datetime.now(TZ_SAO_PAULO)
-        ).set_author(name=member.display_name, icon_url=member.display_avatar.url)
-        await enviar_log(embed)
+# ============== REGISTRO DE VIEWS ==============
 
-    # Caso 2: Usuário sai de um canal de voz
-    elif before.channel is not None and after.channel is None:
-        if before.channel.id != afk_channel_id:
-            call_tracker.registrar_saida(member.id, member.display_name, before.channel.name)
 
-        embed = discord.Embed(
-            description=f"⏹️ {member.mention} saiu do canal de voz `{before.channel.name}`.",
-            color=COR_PRINCIPAL,
-            timestamp=datetime.now(TZ_SAO_PAULO)
-        ).set_author(name=member.display_name, icon_url=member.display_avatar.url)
-        await enviar_log(embed)
-
-    # Caso 3: Usuário muda de canal de voz
-    elif before.channel is not None and after.channel is not None and before.channel != after.channel:
-        # Lógica de contagem de tempo com AFK
-        # Saiu de um canal válido e foi para o AFK
-        if before.channel.id != afk_channel_id and after.channel.id == afk_channel_id:
-            call_tracker.registrar_saida(member.id, member.display_name, before.channel.name)
-        # Saiu do AFK e foi para um canal válido
-        elif before.channel.id == afk_channel_id and after.channel.id != afk_channel_id:
-            call_tracker.registrar_entrada(member.id, member.display_name, after.channel.name)
-        # Mudou entre dois canais válidos
-        elif before.channel.id != afk_channel_id and after.channel.id != afk_channel_id:
-            call_tracker.registrar_saida(member.id, member.display_name, before.channel.name)
-            call_tracker.registrar_entrada(member.id, member.display_name, after.channel.name)
+def desativar_view_despejada(view, mensagem):
+    """Edita a mensagem de uma view despejada com os botões desativados."""
+    # Só desativa os botões: baixa prioridade na fila de envios
+    agendador_envios.agendar(mensagem.channel.id, PRIORIDADE_PLANTAO,
+                             mensagem.edit, view=view)
 
-        embed = discord.Embed(
-            description=f"🔄 {member.mention} mudou do canal `{before.channel.name}` para `{after.channel.name}`.",
-            color=COR_LARANJA,
-            timestamp=datetime.now(TZ_SAO_PAULO)
-        ).set_author(name=member.display_name, icon_url=member.display_avatar.url)
-        await enviar_log(embed)
 
+registro_views = RegistroViews(VIEWS_POR_USUARIO, VIEWS_MAXIMO,
+                               ao_despejar=desativar_view_despejada,
+                               compartilhados=lambda: globals().values())
 
 # ============== LÓGICA DE PAGINAÇÃO PARA EMBEDS ==============
 
@@ -622,15 +3382,30 @@ MESES_PT = {
 }
 
 
-def build_consultar_embed(sessoes_pagina, usuario, pagina_atual, total_paginas, total_segundos_geral, rank):
-    """Constrói o embed modernizado para a consulta de histórico de chamadas."""
+cache_paginas = CachePaginas(CACHE_PAGINAS_CAPACIDADE)
+
+# Versão dos cargos de cada servidor para a !hierarquia: muda quando um membro
+# ganha ou perde cargos, sai do servidor ou quando um cargo é alterado
+versoes_hierarquia = {}  # {guild_id: int}
+
+
+def invalidar_hierarquia(guild_id):
+    versoes_hierarquia[guild_id] = versoes_hierarquia.get(guild_id, 0) + 1
+
+
+def build_consultar_embed(sessoes_pagina, usuario, pagina_atual, total_paginas, total_segundos_geral, rank, nome=None):
+    """Constrói o embed modernizado para a consulta de histórico de chamadas.
+
+    `nome` é o nome de exibição já resolvido pelo ResolvedorNomes.
+    """
+    nome = nome or usuario.display_name
     embed = discord.Embed(
         title="📜 Histórico de Sessões",
         color=discord.Color.from_rgb(255, 0, 0), # Vermelho
         timestamp=datetime.now(TZ_SAO_PAULO)
     )
     embed.set_author(
-        name=f"Relatório de {usuario.display_name}",
+        name=f"Relatório de {nome}",
         icon_url=usuario.avatar.url if usuario.avatar else usuario.default_avatar.url
     )
     embed.set_thumbnail(url=SP_CAPITAL_GIF_URL)
@@ -660,7 +3435,7 @@ def build_consultar_embed(sessoes_pagina, usuario, pagina_atual, total_paginas,
         lista_sessoes_str = []
         last_date_str = None
         for s in sessoes_pagina:
-            entrada = datetime.fromisoformat(s[4]).astimezone(TZ_SAO_PAULO)
+            entrada = relogio.para_exibicao(s[4])
             duracao_segundos = s[6] if s[6] is not None else 0
             duracao_formatada = call_tracker.formatar_tempo_hhmmss(duracao_segundos)
             canal_nome = s[3] if s[3] else "N/A"
@@ -681,31 +3456,142 @@ def build_consultar_embed(sessoes_pagina, usuario, pagina_atual, total_paginas,
 
         embed.description = "\n".join(lista_sessoes_str)
 
-    embed.set_footer(text=f"Página {pagina_atual}/{total_paginas} • Histórico de {usuario.display_name}")
+    embed.set_footer(text=f"Página {pagina_atual}/{total_paginas} • Histórico de {nome}")
     return embed
 
 
+class CursorHistorico:
+    """Cursor do histórico de sessões de um usuário, carregado página a página.
+
+    Usa paginação por chave (entrada, id) a partir das páginas vizinhas já
+    carregadas, então nunca lê o histórico inteiro. Mantém em memória apenas
+    a página atual e as vizinhas, e pode pré-carregar a próxima em segundo
+    plano. `total_sessoes` deve ser contado em `call_sessions` (o mesmo filtro
+    das páginas), senão a última página fica desalinhada das vizinhas.
+    """
+
+    def __init__(self, tracker, guild_id, user_id, total_sessoes,
+                 items_per_page=5):
+        self.tracker = tracker
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.total_sessoes = total_sessoes
+        self.items_per_page = items_per_page
+        self.total_pages = max(
+            1, (total_sessoes + items_per_page - 1) // items_per_page)
+        self._paginas = {}  # {número: [sessões]}
+        self._carregando = {}  # {número: asyncio.Task}
+
+    @staticmethod
+    def _chave(sessao):
+        return (sessao[4], sessao[0])  # (entrada, id)
+
+    async def _buscar(self, numero):
+        if numero == 1:
+            return await self.tracker.obter_pagina_historico(
+                self.guild_id, self.user_id, self.items_per_page)
+        if numero == self.total_pages:
+            restantes = self.total_sessoes - (numero - 1) * self.items_per_page
+            return await self.tracker.obter_ultima_pagina_historico(
+                self.guild_id, self.user_id, restantes)
+        anterior = self._paginas.get(numero - 1)
+        if anterior:
+            return await self.tracker.obter_pagina_historico(
+                self.guild_id, self.user_id, self.items_per_page,
+                antes=self._chave(anterior[-1]))
+        seguinte = self._paginas.get(numero + 1)
+        if seguinte:
+            return await self.tracker.obter_pagina_historico(
+                self.guild_id, self.user_id, self.items_per_page,
+                depois=self._chave(seguinte[0]))
+        # Sem vizinha carregada: anda pela chave a partir da ponta mais
+        # próxima (da última página para trás, em ordem crescente)
+        if numero - 1 <= self.total_pages - numero:
+            for n in range(1, numero):
+                await self.pagina(n)
+        else:
+            for n in range(self.total_pages, numero, -1):
+                await self.pagina(n)
+        return await self._buscar(numero)
+
+    async def pagina(self, numero):
+        """Retorna as sessões da página `numero` (1 = mais recentes)."""
+        if numero in self._paginas:
+            return self._paginas[numero]
+        tarefa = self._carregando.get(numero)
+        if tarefa is None:
+            tarefa = asyncio.ensure_future(self._buscar(numero))
+            self._carregando[numero] = tarefa
+        try:
+            sessoes = await tarefa
+        finally:
+            self._carregando.pop(numero, None)
+        self._paginas[numero] = sessoes
+        return sessoes
+
+    def pre_carregar(self, numero):
+        """Agenda o carregamento da página vizinha a `numero`."""
+        for vizinha in (numero + 1, numero - 1):
+            if (1 <= vizinha <= self.total_pages
+                    and vizinha not in self._paginas
+                    and vizinha not in self._carregando):
+                tarefa = asyncio.ensure_future(self._buscar(vizinha))
+                tarefa.add_done_callback(
+                    functools.partial(self._pre_carregada, vizinha))
+                self._carregando[vizinha] = tarefa
+                break
+
+    def _pre_carregada(self, numero, tarefa):
+        """Guarda a página pré-carregada mesmo que ninguém a tenha aguardado."""
+        if self._carregando.get(numero) is tarefa:
+            del self._carregando[numero]
+        if tarefa.cancelled():
+            return
+        erro = tarefa.exception()
+        if erro is not None:
+            logger.error(f"Erro ao pré-carregar página {numero} do histórico: {erro}")
+            return
+        self._paginas.setdefault(numero, tarefa.result())
+
+    def fechar(self):
+        """Cancela os carregamentos pendentes e libera as páginas em memória."""
+        for tarefa in self._carregando.values():
+            tarefa.cancel()
+        self._carregando.clear()
+        self._paginas.clear()
+
+    def adotar(self, numero, sessoes):
+        """Usa sessões já conhecidas (do cache de páginas) como a página `numero`."""
+        self._paginas[numero] = sessoes
+
+    def descartar_distantes(self, numero):
+        """Mantém em memória só a página atual e as vizinhas."""
+        for n in list(self._paginas):
+            if abs(n - numero) > 1:
+                del self._paginas[n]
+
+
 class PaginationView(discord.ui.View):
     """View para criar embeds com botões de paginação para o histórico de chamadas."""
 
     def __init__(self,
                  author: discord.Member,
-                 all_sessoes: list,
+                 cursor: CursorHistorico,
                  usuario_alvo: discord.Member,
                  total_segundos: int,
                  rank: int,
-                 items_per_page: int = 5):
+                 versao=None,
+                 nome_alvo=None):
         super().__init__(timeout=180)
         self.author = author
-        self.all_sessoes = all_sessoes
+        self.cursor = cursor
         self.usuario_alvo = usuario_alvo
+        self.nome_alvo = nome_alvo or usuario_alvo.display_name
         self.total_segundos = total_segundos
         self.rank = rank
-        self.items_per_page = items_per_page
+        self.versao = versao  # Versão do histórico (CallTracker.versao_historico)
         self.current_page = 1
-        self.total_pages = max(
-            1, (len(self.all_sessoes) + self.items_per_page - 1) //
-            self.items_per_page)
+        self.total_pages = cursor.total_pages
         self.update_buttons()
 
     async def interaction_check(self,
@@ -717,10 +3603,19 @@ class PaginationView(discord.ui.View):
             return False
         return True
 
-    def get_page_data(self):
-        start_index = (self.current_page - 1) * self.items_per_page
-        end_index = start_index + self.items_per_page
-        return self.all_sessoes[start_index:end_index]
+    async def on_timeout(self):
+        self.cursor.fechar()
+
+    def stop(self):
+        # Encerrada antes do timeout (ex.: despejada pelo registro de views)
+        self.cursor.fechar()
+        super().stop()
+
+    async def get_page_data(self):
+        sessoes = await self.cursor.pagina(self.current_page)
+        self.cursor.descartar_distantes(self.current_page)
+        self.cursor.pre_carregar(self.current_page)
+        return sessoes
 
     def update_buttons(self):
         self.children[0].disabled = self.current_page == 1
@@ -730,21 +3625,46 @@ class PaginationView(discord.ui.View):
         self.children[
             2].label = f"Página {self.current_page}/{self.total_pages}"
 
-    async def update_embed(self, interaction: discord.Interaction):
-        sessoes_pagina = self.get_page_data()
-        self.update_buttons()
+    async def montar_embed(self):
+        """Embed da página atual, do cache de páginas quando ela já foi renderizada."""
+        chave = ('historico', self.cursor.guild_id, self.usuario_alvo.id,
+                 self.versao, self.current_page, self.total_pages,
+                 self.total_segundos, self.rank, self.nome_alvo,
+                 self.usuario_alvo.display_avatar.url)
+        em_cache = cache_paginas.obter(chave) if self.versao is not None else None
+        if em_cache is not None:
+            sessoes_pagina, payload = em_cache
+            # As vizinhas continuam sendo buscadas a partir desta página
+            self.cursor.adotar(self.current_page, sessoes_pagina)
+            self.cursor.descartar_distantes(self.current_page)
+            self.cursor.pre_carregar(self.current_page)
+            embed = discord.Embed.from_dict(payload)
+            embed.timestamp = datetime.now(TZ_SAO_PAULO)
+            return embed
+
+        sessoes_pagina = await self.get_page_data()
         embed = build_consultar_embed(sessoes_pagina, self.usuario_alvo,
                                       self.current_page, self.total_pages,
-                                      self.total_segundos, self.rank)
+                                      self.total_segundos, self.rank,
+                                      nome=self.nome_alvo)
+        if self.versao is not None:
+            cache_paginas.guardar(chave, (sessoes_pagina, embed.to_dict()))
+        return embed
+
+    async def update_embed(self, interaction: discord.Interaction):
+        embed = await self.montar_embed()
+        self.update_buttons()
         await interaction.response.edit_message(embed=embed, view=self)
 
     @discord.ui.button(label="⏪", style=discord.ButtonStyle.primary, row=0)
+    @medir_desempenho
     async def first_page(self, interaction: discord.Interaction,
                          button: discord.ui.Button):
         self.current_page = 1
         await self.update_embed(interaction)
 
     @discord.ui.button(label="⬅️", style=discord.ButtonStyle.secondary, row=0)
+    @medir_desempenho
     async def prev_page(self, interaction: discord.Interaction,
                         button: discord.ui.Button):
         if self.current_page > 1:
@@ -755,11 +3675,13 @@ class PaginationView(discord.ui.View):
                        style=discord.ButtonStyle.grey,
                        disabled=True,
                        row=0)
+    @medir_desempenho
     async def page_label(self, interaction: discord.Interaction,
                          button: discord.ui.Button):
         pass
 
     @discord.ui.button(label="➡️", style=discord.ButtonStyle.secondary, row=0)
+    @medir_desempenho
     async def next_page(self, interaction: discord.Interaction,
                         button: discord.ui.Button):
         if self.current_page < self.total_pages:
@@ -767,6 +3689,7 @@ class PaginationView(discord.ui.View):
         await self.update_embed(interaction)
 
     @discord.ui.button(label="⏩", style=discord.ButtonStyle.primary, row=0)
+    @medir_desempenho
     async def last_page(self, interaction: discord.Interaction,
                         button: discord.ui.Button):
         self.current_page = self.total_pages
@@ -797,12 +3720,14 @@ class ConfirmationView(discord.ui.View):
         await interaction.message.edit(view=self)
 
     @discord.ui.button(label="Confirmar", style=discord.ButtonStyle.danger)
+    @medir_desempenho
     async def confirm(self, interaction: discord.Interaction, button: discord.ui.Button):
         self.confirmed = True
         await self.disable_buttons(interaction)
         self.stop()
 
     @discord.ui.button(label="Cancelar", style=discord.ButtonStyle.secondary)
+    @medir_desempenho
     async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
         self.confirmed = False
         await self.disable_buttons(interaction)
@@ -881,11 +3806,13 @@ async def tempo(ctx):
 
 
 @bot.command(name='chamada', aliases=['minhachamada'])
+@commands.guild_only()
 async def chamada(ctx):
     """Exibe um painel com o status da sua sessão de chamada atual."""
     user_id = ctx.author.id
+    sessao = await call_tracker_async.sessao_ativa(ctx.guild.id, user_id)
 
-    if user_id not in call_tracker.usuarios_ativos:
+    if sessao is None:
         embed = discord.Embed(
             title="**📞 Status da Chamada**",
             description="Você não está em uma chamada de voz no momento.",
@@ -897,10 +3824,8 @@ async def chamada(ctx):
         return
 
     # Dados da sessão ativa
-    dados_sessao = call_tracker.usuarios_ativos[user_id]
-    canal_nome = dados_sessao['canal']
-    entrada = dados_sessao['entrada']
-    duracao_segundos = (datetime.now(TZ_SAO_PAULO) - entrada).total_seconds()
+    canal_nome = sessao['canal']
+    duracao_segundos = sessao['duracao']
 
     embed = discord.Embed(
         title="**📞 Painel de Sessão Ativa**",
@@ -933,11 +3858,31 @@ async def chamada(ctx):
     logger.info(f"Comando chamada executado por {ctx.author.name}")
 
 
+# Períodos aceitos por !rankingchamadas: {argumento: (período, título)}
+PERIODOS_RANKING = {
+    "dia": ("dia", "Hoje"),
+    "hoje": ("dia", "Hoje"),
+    "semana": ("semana", "Esta Semana"),
+    "mes": ("mes", "Este Mês"),
+    "mês": ("mes", "Este Mês"),
+}
+
+
 @bot.command(name='rankingchamadas', aliases=['topcalls'])
-async def ranking_chamadas(ctx):
+@commands.guild_only()
+async def ranking_chamadas(ctx, periodo: str = None):
     """Exibe o ranking dos usuários mais ativos em chamadas de voz."""
     try:
-        ranking_data = call_tracker.obter_ranking(10)
+        titulo_periodo = None
+        if periodo is None:
+            ranking_data = await call_tracker_async.obter_ranking(ctx.guild.id, 10)
+        elif periodo.lower() in PERIODOS_RANKING:
+            periodo, titulo_periodo = PERIODOS_RANKING[periodo.lower()]
+            ranking_data = await call_tracker_async.obter_ranking_periodo(
+                ctx.guild.id, periodo, 10)
+        else:
+            await ctx.send("❌ Período inválido. Use `!rankingchamadas`, `!rankingchamadas dia`, `semana` ou `mes`.")
+            return
 
         if not ranking_data:
             embed = discord.Embed(
@@ -955,31 +3900,42 @@ async def ranking_chamadas(ctx):
             color=COR_PRINCIPAL,
             timestamp=datetime.now(TZ_SAO_PAULO)
         )
+        if titulo_periodo:
+            embed.title = f"🏆 Ranking de Atividade em Chamada • {titulo_periodo}"
+            embed.description = f"Os membros mais ativos em chamada no período: **{titulo_periodo.lower()}**."
         embed.set_thumbnail(url=SP_CAPITAL_GIF_URL)
 
-        ranking_list_str = []
-        medals = ["🥇", "🥈", "🥉"]
+        # Campos já renderizados para este mesmo ranking (e os mesmos nomes
+        # de exibição) são reaproveitados
+        nomes = await resolvedor_nomes.nomes(
+            [(user_data['user_id'], user_data.get('user_name') or 'Usuário Desconhecido')
+             for user_data in ranking_data], ctx.guild)
+        cache_ranking = call_tracker.particao(ctx.guild.id).cache_ranking
+        ranking_renderizado = cache_ranking.obter_renderizado(
+            periodo, ranking_data, nomes)
+        if ranking_renderizado is None:
+            ranking_list_str = []
+            medals = ["🥇", "🥈", "🥉"]
 
-        for i, user_data in enumerate(ranking_data):
-            position = i + 1
-            try:
-                user = await bot.fetch_user(user_data['user_id'])
-                display_name = user.display_name
-            except discord.NotFound:
-                display_name = user_data.get('user_name', 'Usuário Desconhecido')
+            for i, (user_data, display_name) in enumerate(zip(ranking_data, nomes)):
+                position = i + 1
 
-            medal = medals[i] if i < 3 else f"`#{position:02}`"
+                medal = medals[i] if i < 3 else f"`#{position:02}`"
 
-            total_time_formatted = call_tracker.formatar_tempo_hhmmss(user_data['total_segundos'])
+                total_time_formatted = call_tracker.formatar_tempo_hhmmss(user_data['total_segundos'])
 
-            ranking_list_str.append(
-                f"{medal} **{display_name}**\n"
-                f"> `Tempo Total:` {total_time_formatted}"
-            )
+                ranking_list_str.append(
+                    f"{medal} **{display_name}**\n"
+                    f"> `Tempo Total:` {total_time_formatted}"
+                )
+
+            ranking_renderizado = "\n\n".join(ranking_list_str)
+            cache_ranking.guardar_renderizado(
+                periodo, ranking_data, nomes, ranking_renderizado)
 
         embed.add_field(
             name="Top 10 - Lendas das Calls",
-            value="\n\n".join(ranking_list_str),
+            value=ranking_renderizado,
             inline=False
         )
 
@@ -994,6 +3950,7 @@ async def ranking_chamadas(ctx):
 
 
 @bot.command(name='statscall')
+@commands.guild_only()
 async def stats_call(ctx, member: discord.Member = None):
     """Exibe um relatório de atividade em chamadas de um usuário."""
     try:
@@ -1003,7 +3960,8 @@ async def stats_call(ctx, member: discord.Member = None):
             await ctx.send("\u274c Você não tem permissão para consultar as estatísticas de outros usuários.")
             return
 
-        stats = call_tracker.obter_estatisticas_usuario(target_user.id)
+        stats = await call_tracker_async.obter_estatisticas_usuario(
+            ctx.guild.id, target_user.id)
 
         if not stats or stats['total_sessoes'] == 0:
             embed = discord.Embed(
@@ -1016,7 +3974,8 @@ async def stats_call(ctx, member: discord.Member = None):
             await ctx.send(embed=embed)
             return
 
-        user_rank = call_tracker.get_user_rank(target_user.id)
+        user_rank = await call_tracker_async.get_user_rank(ctx.guild.id,
+                                                           target_user.id)
         rank_badge = "\ud83c\udf96\ufe0f Top " + str(user_rank) if user_rank and user_rank <= 10 else f"#{user_rank}"
         rank_text = f"**Posição no Ranking:** {rank_badge}" if user_rank else "Não ranqueado"
 
@@ -1041,16 +4000,16 @@ async def stats_call(ctx, member: discord.Member = None):
         embed.add_field(
             name="\ud83d\udcc8 Análise de Atividade",
             value=f"\ud83d\udcc9 **Média / Sessão:** `{call_tracker.formatar_tempo_hhmmss(stats['media_segundos'])}`\n"
-                  f"\ud83d\udcc5 **Última Atividade:** {stats['ultima_call'].strftime('%d/%m/%Y às %H:%M')}",
+                  f"\ud83d\udcc5 **Última Atividade:** {relogio.para_exibicao(stats['ultima_call']).strftime('%d/%m/%Y às %H:%M')}",
             inline=False
         )
 
         # --- Status Atual ---
-        if target_user.id in call_tracker.usuarios_ativos:
-            dados_sessao = call_tracker.usuarios_ativos[target_user.id]
-            duracao_segundos = (datetime.now(TZ_SAO_PAULO) - dados_sessao['entrada']).total_seconds()
-            status_value = f"""\ud83d\udfe2 **Online** no canal `{dados_sessao['canal']}`
-**Duração:** `{call_tracker.formatar_tempo_hhmmss(duracao_segundos)}`"""
+        sessao = await call_tracker_async.sessao_ativa(ctx.guild.id,
+                                                       target_user.id)
+        if sessao is not None:
+            status_value = f"""\ud83d\udfe2 **Online** no canal `{sessao['canal']}`
+**Duração:** `{call_tracker.formatar_tempo_hhmmss(sessao['duracao'])}`"""
             embed.color = discord.Color.from_rgb(0, 255, 136) # Verde Neon
         else:
             status_value = "\ud83d\udd34 **Offline** - Não está em uma chamada."
@@ -1072,10 +4031,12 @@ async def stats_call(ctx, member: discord.Member = None):
 
 
 @bot.command(name='analisar')
+@commands.guild_only()
 async def analisar_desempenho(ctx):
     """Comando para gerar uma análise interpretativa do desempenho em calls"""
     try:
-        stats = call_tracker.obter_estatisticas_usuario(ctx.author.id)
+        stats = await call_tracker_async.obter_estatisticas_usuario(
+            ctx.guild.id, ctx.author.id)
 
         if not stats:
             await ctx.send(
@@ -1086,14 +4047,9 @@ async def analisar_desempenho(ctx):
         tempo_total = stats['total_segundos']
         sessoes = stats['total_sessoes']
         media = stats['media_segundos']
-        primeira = stats['primeira_call']
-        ultima = stats['ultima_call']
-
-        # Garante que os datetimes do banco de dados sejam 'aware' (cientes do fuso horário)
-        if primeira and primeira.tzinfo is None:
-            primeira = TZ_SAO_PAULO.localize(primeira)
-        if ultima and ultima.tzinfo is None:
-            ultima = TZ_SAO_PAULO.localize(ultima)
+        # Instantes do banco (epoch) convertidos para o horário de São Paulo
+        primeira = relogio.para_exibicao(stats['primeira_call'])
+        ultima = relogio.para_exibicao(stats['ultima_call'])
 
         interpretacao = []
 
@@ -1182,6 +4138,7 @@ async def analisar_desempenho(ctx):
 @bot.command(name='consultar',
              aliases=['pontos_consultar'],
              help="Consulta seu histórico de tempo em chamadas.")
+@commands.guild_only()
 async def consultar_command(ctx, usuario: discord.Member = None):
     """Consulta o histórico de tempo em chamadas de um usuário com a nova interface."""
     if usuario is None:
@@ -1194,49 +4151,49 @@ async def consultar_command(ctx, usuario: discord.Member = None):
 
     try:
         # Obter estatísticas e ranking
-        stats = call_tracker.obter_estatisticas_usuario(usuario.id)
-        rank = call_tracker.get_user_rank(usuario.id)
+        stats = await call_tracker_async.obter_estatisticas_usuario(
+            ctx.guild.id, usuario.id)
+        rank = await call_tracker_async.get_user_rank(ctx.guild.id, usuario.id)
         total_segundos_geral = stats['total_segundos'] if stats else 0
-
-        # Obter todas as sessões
-        conn = sqlite3.connect(call_tracker.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            '''
-            SELECT id, user_id, user_name, canal, entrada, saida, duracao_segundos
-            FROM call_sessions
-            WHERE user_id = ? AND duracao_segundos IS NOT NULL
-            ORDER BY entrada DESC
-        ''', (str(usuario.id), ))
-        sessoes = cursor.fetchall()
-        conn.close()
-
-        if not sessoes:
+        # As páginas vêm de call_sessions; o total também, para a última
+        # página não divergir de call_stats
+        total_sessoes = await call_tracker_async.contar_sessoes_historico(
+            ctx.guild.id, usuario.id)
+        nome_alvo = await resolvedor_nomes.nome(usuario.id, ctx.guild,
+                                                padrao=usuario.display_name)
+
+        if not total_sessoes:
             embed = discord.Embed(
                 title="📜 Histórico de Atividade",
                 description="💤 Este usuário ainda não possui um histórico de chamadas para exibir.",
                 color=discord.Color.from_rgb(255, 170, 0) # Laranja
             )
-            embed.set_author(name=f"Relatório de: {usuario.display_name}",
+            embed.set_author(name=f"Relatório de: {nome_alvo}",
                              icon_url=usuario.avatar.url if usuario.avatar else usuario.default_avatar.url)
             embed.set_thumbnail(url=SP_CAPITAL_GIF_URL)
             embed.set_footer(text="Nenhuma sessão encontrada.")
             await ctx.send(embed=embed)
             return
 
-        # Configura a view de paginação com os novos dados
+        # Configura a view de paginação; as sessões são lidas página a página
+        cursor = CursorHistorico(call_tracker_async,
+                                 ctx.guild.id,
+                                 usuario.id,
+                                 total_sessoes,
+                                 items_per_page=5)
         view = PaginationView(author=ctx.author,
-                              all_sessoes=sessoes,
+                              cursor=cursor,
                               usuario_alvo=usuario,
                               total_segundos=total_segundos_geral,
                               rank=rank,
-                              items_per_page=5)
+                              versao=stats.get('versao') if stats else None,
+                              nome_alvo=nome_alvo)
 
         # Constrói e envia o embed inicial
-        sessoes_iniciais = view.get_page_data()
-        embed = build_consultar_embed(sessoes_iniciais, usuario, 1, view.total_pages, total_segundos_geral, rank)
+        embed = await view.montar_embed()
 
-        await ctx.send(embed=embed, view=view)
+        mensagem = await ctx.send(embed=embed, view=view)
+        registro_views.registrar(view, ctx.author.id, mensagem)
         logger.info(
             f"Comando consultar executado por {ctx.author.name} para {usuario.name}"
         )
@@ -1272,6 +4229,7 @@ class HelpSelect(discord.ui.Select):
                          max_values=1,
                          options=options)
 
+    @medir_desempenho
     async def callback(self, interaction: discord.Interaction):
         # Obtém a categoria selecionada e cria um novo embed
         selected_category = self.values[0]
@@ -1293,7 +4251,7 @@ class HelpSelect(discord.ui.Select):
             embed.add_field(name="`!chamada` (ou `!minhachamada`)", value="Painel com o status da sua chamada atual.", inline=False)
             embed.add_field(name="`!statscall [usuário]`", value="Relatório de atividade de um usuário (ou seu).", inline=False)
             embed.add_field(name="`!consultar [usuário]`", value="Seu histórico paginado de sessões.", inline=False)
-            embed.add_field(name="`!rankingchamadas` (ou `!topcalls`)", value="Ranking dos usuários mais ativos.", inline=False)
+            embed.add_field(name="`!rankingchamadas` `[dia|semana|mes]` (ou `!topcalls`)", value="Ranking dos usuários mais ativos (geral ou do período).", inline=False)
             embed.add_field(name="`!analisar`", value="Análise sobre seu desempenho em chamadas.", inline=False)
 
         elif selected_category == "Moderação":
@@ -1305,6 +4263,12 @@ class HelpSelect(discord.ui.Select):
             embed.add_field(name="`!setar` `[membro]` `[cargo]`", value="Atribui um cargo profissional a um membro.", inline=False)
             embed.add_field(name="`!say` `[canal]` `[mensagem]`", value="Envia uma mensagem através do bot.", inline=False)
             embed.add_field(name="`!hierarquia`", value="Mostra a hierarquia de cargos do servidor.", inline=False)
+            embed.add_field(name="`!configservidor` `[campo]` `[valor]`", value="Mostra ou altera os canais e cargos deste servidor.", inline=False)
+            embed.add_field(name="`!filaenvios`", value="Mostra o estado da fila de envios de mensagens do bot.", inline=False)
+            embed.add_field(name="`!saude`", value="Mostra a saúde de cada cluster do bot.", inline=False)
+            embed.add_field(name="`!perf`", value="Mostra as latências por comando e as invocações mais lentas.", inline=False)
+            embed.add_field(name="`!perfsql [quantidade|limpar] [ordem]`", value="Mostra as consultas SQL mais caras (requer MEDBOT_PERFIL_SQL=1).", inline=False)
+            embed.add_field(name="`!views`", value="Mostra as views interativas abertas e a memória que elas ocupam.", inline=False)
 
         # Edita a mensagem original com o novo embed da categoria
         await interaction.response.edit_message(embed=embed)
@@ -1330,7 +4294,8 @@ async def help_command(ctx):
     embed.set_footer(text="Selecione uma categoria para ver os comandos.")
 
     view = HelpView()
-    await ctx.send(embed=embed, view=view)
+    mensagem = await ctx.send(embed=embed, view=view)
+    registro_views.registrar(view, ctx.author.id, mensagem)
 
 
 # ============== SISTEMA DE VERIFICAÇÃO (MANTIDO INTOCADO) ==============
@@ -1374,6 +4339,7 @@ class VerificationModal(discord.ui.Modal, title='Formulário de Verificação'):
             max_length=15)
         self.add_item(self.tipo_acesso)
 
+    @medir_desempenho
     async def on_submit(self, interaction: discord.Interaction):
         """Processa o formulário de verificação"""
         try:
@@ -1402,7 +4368,8 @@ class VerificationModal(discord.ui.Modal, title='Formulário de Verificação'):
                                                      ] else "Visitante"
 
             cargo_key = "Estagiário" if tipo_final == "Médico" else "Visitante/Observador"
-            cargo_id = CARGOS_IDS.get(cargo_key)
+            config = config_servidor(guild.id)
+            cargo_id = config.cargos.get(cargo_key)
             cargo = guild.get_role(cargo_id) if cargo_id else None
 
             if not cargo:
@@ -1454,8 +4421,8 @@ class VerificationModal(discord.ui.Modal, title='Formulário de Verificação'):
                 f"Usuário {interaction.user.name} verificado com sucesso.")
 
             # Envia log para canal de logs se existir (com tema vermelho)
-            canal_logs = guild.get_channel(
-                CANAIS_TEXTO.get("logs-de-inscrição"))
+            canal_logs = (guild.get_channel(config.canal_logs_inscricao_id)
+                          if config.canal_logs_inscricao_id else None)
             if canal_logs:
                 log_embed = discord.Embed(
                     title="⚕️ Nova Verificação Realizada ⚕️",
@@ -1494,7 +4461,8 @@ class VerificationModal(discord.ui.Modal, title='Formulário de Verificação'):
                 log_embed.set_footer(
                     text=f"Sistema de Verificação • {interaction.guild.name}")
 
-                await canal_logs.send(embed=log_embed)
+                agendador_envios.enviar(canal_logs, PRIORIDADE_VERIFICACAO,
+                                        embed=log_embed)
 
         except Exception as e:
             logger.error(
@@ -1513,6 +4481,7 @@ class VerificationView(discord.ui.View):
     @discord.ui.button(label="Iniciar Verificação",
                        style=discord.ButtonStyle.green,
                        emoji="✅")
+    @medir_desempenho
     async def start_verification(self, interaction: discord.Interaction,
                                  button: discord.ui.Button):
         """Inicia o processo de verificação"""
@@ -1549,7 +4518,7 @@ async def reset_calls(ctx, usuario: discord.Member):
         item.disabled = True
 
     if view.confirmed is True:
-        if call_tracker.reset_user_calls(usuario.id):
+        if await call_tracker_async.reset_user_calls(ctx.guild.id, usuario.id):
             success_embed = discord.Embed(
                 title="✅ Dados Apagados com Sucesso",
                 description=f"Todos os registros de chamadas e estatísticas de {usuario.mention} foram permanentemente apagados.",
@@ -1613,12 +4582,14 @@ class ResetAllConfirmationView(discord.ui.View):
         await interaction.response.edit_message(view=self)
 
     @discord.ui.button(label="DESTRUIR TODOS OS DADOS", style=discord.ButtonStyle.danger, emoji="💥")
+    @medir_desempenho
     async def confirm(self, interaction: discord.Interaction, button: discord.ui.Button):
         self.confirmed = True
         await self.disable_buttons(interaction)
         self.stop()
 
     @discord.ui.button(label="Cancelar", style=discord.ButtonStyle.secondary, emoji="✖️")
+    @medir_desempenho
     async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
         self.confirmed = False
         await self.disable_buttons(interaction)
@@ -1648,7 +4619,7 @@ async def reset_all_calls_command(ctx):
     await view.wait()
 
     if view.confirmed is True:
-        if call_tracker.reset_all_calls():
+        if await call_tracker_async.reset_all_calls(ctx.guild.id):
             success_embed = discord.Embed(
                 title="✅ Reset Geral Concluído",
                 description="Todos os dados de chamadas do servidor foram permanentemente apagados.",
@@ -1752,8 +4723,9 @@ async def punir_command(ctx, membro: discord.Member, nivel: int):
         await ctx.send("❌ Nível de punição inválido. Use 1 ou 2.")
         return
 
-    cargo_id = CARGO_PUNICAO_1_ID if nivel == 1 else CARGO_PUNICAO_2_ID
-    cargo = ctx.guild.get_role(cargo_id)
+    config = config_servidor(ctx.guild.id)
+    cargo_id = config.cargo_punicao_1_id if nivel == 1 else config.cargo_punicao_2_id
+    cargo = ctx.guild.get_role(cargo_id) if cargo_id else None
 
     if not cargo:
         await ctx.send(f"❌ O cargo de Punição {nivel} não foi encontrado no servidor.")
@@ -1773,7 +4745,8 @@ async def punir_command(ctx, membro: discord.Member, nivel: int):
         logger.info(f"{ctx.author.name} aplicou a punição de nível {nivel} em {membro.name}.")
 
         # Envia o log para o canal de moderação
-        canal_log_mod = bot.get_channel(CANAL_MODERACAO_ID)
+        canal_log_mod = (bot.get_channel(config.canal_moderacao_id)
+                         if config.canal_moderacao_id else None)
         if canal_log_mod:
             log_embed = discord.Embed(
                 title="📝 Log de Punição",
@@ -1785,12 +4758,11 @@ async def punir_command(ctx, membro: discord.Member, nivel: int):
             log_embed.add_field(name="Punição Aplicada", value=f"**{cargo.name}** (Nível {nivel})", inline=False)
             log_embed.set_footer(text=f"ID do Usuário: {membro.id}")
 
-            try:
-                await canal_log_mod.send(embed=log_embed)
-            except Exception as e:
-                logger.error(f"Falha ao enviar log de punição para o canal {CANAL_MODERACAO_ID}: {e}")
+            # Falhas de envio são registradas pelo agendador
+            agendador_envios.enviar(canal_log_mod, PRIORIDADE_MODERACAO,
+                                    embed=log_embed)
         else:
-            logger.warning(f"Canal de log de moderação (ID: {CANAL_MODERACAO_ID}) não encontrado.")
+            logger.warning(f"Canal de log de moderação (ID: {config.canal_moderacao_id}) não encontrado.")
     except discord.Forbidden:
         await ctx.send("❌ O bot não tem permissão para adicionar este cargo.")
     except Exception as e:
@@ -1814,7 +4786,7 @@ async def punir_error(ctx, error):
 @commands.has_permissions(administrator=True)
 async def setar_cargo_command(ctx, membro: discord.Member, cargo: discord.Role):
     """Atribui um cargo profissional a um membro."""
-    cargos_permitidos = CARGOS_SETAveis_IDS
+    cargos_permitidos = config_servidor(ctx.guild.id).cargos_setaveis
 
     if cargo.id not in cargos_permitidos:
         await ctx.send("❌ Você só pode setar os cargos de `Paramédico`, `Médico` ou `Enfermeiro`.")
@@ -1856,12 +4828,25 @@ class HierarquiaView(discord.ui.View):
         self.ctx = ctx
         self.cargos_por_pagina = cargos_por_pagina
         self.pagina_atual = 0
-        self.total_paginas = (len(HIERARQUIA_CARGOS) + self.cargos_por_pagina - 1) // self.cargos_por_pagina
+        self.hierarquia = config_servidor(ctx.guild.id).hierarquia
+        self.total_paginas = max(
+            1, (len(self.hierarquia) + self.cargos_por_pagina - 1) // self.cargos_por_pagina)
 
     async def criar_embed_pagina(self):
         start_index = self.pagina_atual * self.cargos_por_pagina
         end_index = start_index + self.cargos_por_pagina
-        cargos_da_pagina = HIERARQUIA_CARGOS[start_index:end_index]
+        cargos_da_pagina = self.hierarquia[start_index:end_index]
+
+        # O total de membros em cache entra na chave: ele muda enquanto os
+        # membros do servidor ainda estão sendo carregados, sem eventos
+        guild = self.ctx.guild
+        chave = ('hierarquia', guild.id, versoes_hierarquia.get(guild.id, 0),
+                 len(guild.members), self.pagina_atual, self.total_paginas,
+                 tuple((cargo_info['id'], cargo_info['emoji'])
+                       for cargo_info in cargos_da_pagina))
+        payload = cache_paginas.obter(chave)
+        if payload is not None:
+            return discord.Embed.from_dict(payload)
 
         embed = discord.Embed(
             title="📊 Estrutura Hierárquica do Servidor",
@@ -1883,6 +4868,7 @@ class HierarquiaView(discord.ui.View):
                 )
 
         embed.set_footer(text=f"Página {self.pagina_atual + 1}/{self.total_paginas} | 👥 Total de membros listados: {total_membros_listados}")
+        cache_paginas.guardar(chave, embed.to_dict())
         return embed
 
     async def atualizar_botoes(self):
@@ -1890,6 +4876,7 @@ class HierarquiaView(discord.ui.View):
         self.children[1].disabled = self.pagina_atual == self.total_paginas - 1
 
     @discord.ui.button(label="Anterior", style=discord.ButtonStyle.grey)
+    @medir_desempenho
     async def anterior_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         if self.pagina_atual > 0:
             self.pagina_atual -= 1
@@ -1898,6 +4885,7 @@ class HierarquiaView(discord.ui.View):
             await interaction.response.edit_message(embed=embed, view=self)
 
     @discord.ui.button(label="Próximo", style=discord.ButtonStyle.grey)
+    @medir_desempenho
     async def proximo_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         if self.pagina_atual < self.total_paginas - 1:
             self.pagina_atual += 1
@@ -1912,7 +4900,8 @@ async def hierarquia_command(ctx):
     view = HierarquiaView(ctx)
     await view.atualizar_botoes()
     embed = await view.criar_embed_pagina()
-    await ctx.send(embed=embed, view=view)
+    mensagem = await ctx.send(embed=embed, view=view)
+    registro_views.registrar(view, ctx.author.id, mensagem)
 
 @hierarquia_command.error
 async def hierarquia_error(ctx, error):
@@ -1923,6 +4912,306 @@ async def hierarquia_error(ctx, error):
         await ctx.send("❌ Ocorreu um erro inesperado.")
 
 
+# Campos de !configservidor: {argumento: (coluna em guild_config, tipo)}
+CAMPOS_CONFIG_SERVIDOR = {
+    "plantoes": ("canal_plantoes_id", "canal"),
+    "moderacao": ("canal_moderacao_id", "canal"),
+    "afk": ("canal_afk_id", "canal"),
+    "inscricoes": ("canal_logs_inscricao_id", "canal"),
+    "punicao1": ("cargo_punicao_1_id", "cargo"),
+    "punicao2": ("cargo_punicao_2_id", "cargo"),
+}
+
+
+@bot.command(name='configservidor')
+@commands.has_permissions(administrator=True)
+async def config_servidor_command(ctx, campo: str = None, valor: str = None):
+    """Mostra ou altera os canais e cargos configurados para este servidor."""
+    if campo is not None:
+        if campo.lower() not in CAMPOS_CONFIG_SERVIDOR or valor is None:
+            await ctx.send(
+                "❌ Uso: `!configservidor <campo> <#canal|@cargo|ID>`. Campos: " +
+                ", ".join(f"`{nome}`" for nome in CAMPOS_CONFIG_SERVIDOR))
+            return
+        digitos = "".join(c for c in valor if c.isdigit())
+        if not digitos:
+            await ctx.send("❌ Informe uma menção ou o ID do canal/cargo.")
+            return
+        coluna, _ = CAMPOS_CONFIG_SERVIDOR[campo.lower()]
+        await call_tracker_async.atualizar_config_servidor(ctx.guild.id, coluna,
+                                                           int(digitos))
+        logger.info(
+            f"{ctx.author.name} alterou {coluna} do servidor {ctx.guild.id} para {digitos}")
+
+    config = config_servidor(ctx.guild.id)
+    embed = discord.Embed(title="⚙️ Configuração do Servidor",
+                          color=COR_PRINCIPAL,
+                          timestamp=datetime.now(TZ_SAO_PAULO))
+    for nome, (coluna, tipo) in CAMPOS_CONFIG_SERVIDOR.items():
+        item_id = getattr(config, coluna)
+        if item_id is None:
+            texto = "*não configurado*"
+        else:
+            texto = f"<#{item_id}>" if tipo == "canal" else f"<@&{item_id}>"
+        embed.add_field(name=f"`{nome}`", value=texto, inline=True)
+    embed.set_footer(text="Use !configservidor <campo> <#canal|@cargo|ID> para alterar.")
+    await ctx.send(embed=embed)
+
+@config_servidor_command.error
+async def config_servidor_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ Você não tem permissão para usar este comando.")
+    else:
+        logger.error(f"Erro inesperado no comando !configservidor: {error}")
+        await ctx.send("❌ Ocorreu um erro inesperado.")
+
+
+@bot.command(name='filaenvios')
+@commands.has_permissions(administrator=True)
+async def fila_envios_command(ctx):
+    """Mostra o estado da fila de envios de mensagens do bot."""
+    stats = agendador_envios.estatisticas()
+    nomes_prioridade = {
+        PRIORIDADE_MODERACAO: "Moderação",
+        PRIORIDADE_VERIFICACAO: "Verificação",
+        PRIORIDADE_RESPOSTA: "Respostas",
+        PRIORIDADE_PLANTAO: "Plantão"
+    }
+
+    embed = discord.Embed(title="📨 Fila de Envios",
+                          color=COR_PRINCIPAL,
+                          timestamp=datetime.now(TZ_SAO_PAULO))
+    embed.add_field(
+        name="📥 Na fila",
+        value=f"**Total:** `{stats['profundidade']}`\n" + "\n".join(
+            f"**{nomes_prioridade[p]}:** `{qtd}`"
+            for p, qtd in stats['por_prioridade'].items()),
+        inline=True)
+    embed.add_field(
+        name="⏱️ Espera na fila",
+        value=f"**p50:** `{stats['espera_p50'] * 1000:.0f} ms`\n"
+              f"**p95:** `{stats['espera_p95'] * 1000:.0f} ms`\n"
+              f"**Máx:** `{stats['espera_max'] * 1000:.0f} ms`",
+        inline=True)
+    embed.add_field(
+        name="📊 Totais",
+        value=f"**Enviados:** `{stats['enviados']}`\n"
+              f"**Mesclados:** `{stats['mesclados']}`\n"
+              f"**Descartados:** `{stats['descartados']}`\n"
+              f"**Falhas:** `{stats['falhas']}`",
+        inline=True)
+    await ctx.send(embed=embed)
+
+@fila_envios_command.error
+async def fila_envios_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ Você não tem permissão para usar este comando.")
+    else:
+        logger.error(f"Erro inesperado no comando !filaenvios: {error}")
+        await ctx.send("❌ Ocorreu um erro inesperado.")
+
+
+@bot.command(name='saude')
+@commands.has_permissions(administrator=True)
+async def saude_command(ctx):
+    """Mostra a saúde de todos os clusters do bot (ou do processo único)."""
+    if PAPEL_PROCESSO == "cluster":
+        # Atualiza o próprio relato para que ele não apareça atrasado
+        await call_tracker_async.registrar_saude(coletar_saude())
+        relatorio = await call_tracker_async.saude_clusters()
+    else:
+        relatorio = {'armazem': None, 'clusters': {CLUSTER_ID: coletar_saude()}}
+
+    embed = discord.Embed(title="🩺 Saúde do Bot",
+                          color=COR_PRINCIPAL,
+                          timestamp=datetime.now(TZ_SAO_PAULO))
+    agora = time.time()
+    total_servidores = 0
+    for cluster_id, dados in sorted(relatorio['clusters'].items()):
+        idade = agora - dados['atualizado']
+        if idade > 3 * INTERVALO_SAUDE_S:
+            status = "🔴 Sem relato"
+        elif not dados['pronto']:
+            status = "🟡 Conectando"
+        else:
+            status = "🟢 Online"
+        latencias = [ms for ms in dados['latencias'].values() if ms is not None]
+        latencia = f"{max(latencias):.0f} ms" if latencias else "—"
+        total_servidores += dados['servidores']
+        embed.add_field(
+            name=f"Cluster {cluster_id} • {status}",
+            value=f"**Shards:** `{', '.join(map(str, sorted(dados['latencias'])))}`\n"
+                  f"**Servidores:** `{dados['servidores']}`\n"
+                  f"**Latência (pior shard):** `{latencia}`\n"
+                  f"**Filas (voz/envios):** `{dados['fila_voz']}` / `{dados['fila_envios']}`\n"
+                  f"**Falhas de envio:** `{dados['falhas_envio']}`\n"
+                  f"**Último relato:** há `{idade:.0f}s` (pid `{dados['pid']}`)",
+            inline=True)
+    diario = (await call_tracker_async.estatisticas_rastreamento())['diario']
+    if diario['falhas_consecutivas']:
+        embed.add_field(
+            name="💾 Gravação no banco • 🔴 Falhando",
+            value=f"**Falhas seguidas:** `{diario['falhas_consecutivas']}`\n"
+                  f"**Eventos pendentes:** `{diario['pendentes']}`\n"
+                  f"**Último erro:** `{(diario['ultimo_erro'] or '')[:200]}`",
+            inline=False)
+    else:
+        embed.add_field(
+            name="💾 Gravação no banco • 🟢 OK",
+            value=f"**Eventos pendentes:** `{diario['pendentes']}`",
+            inline=False)
+    armazem = relatorio['armazem']
+    if armazem is not None:
+        faltando = TOTAL_CLUSTERS - len(relatorio['clusters'])
+        embed.add_field(
+            name="🗄️ Armazém de chamadas",
+            value=f"**Clusters conectados:** `{armazem['conexoes']}`\n"
+                  f"**Requisições:** `{armazem['requisicoes']}` "
+                  f"(`{armazem['erros']}` com erro)\n"
+                  f"**Clusters sem relato:** `{max(0, faltando)}`",
+            inline=False)
+    embed.set_footer(text=f"{total_servidores} servidor(es) no total")
+    await ctx.send(embed=embed)
+
+@saude_command.error
+async def saude_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ Você não tem permissão para usar este comando.")
+    else:
+        logger.error(f"Erro inesperado no comando !saude: {error}")
+        await ctx.send("❌ Ocorreu um erro inesperado.")
+
+
+@bot.command(name='perf')
+@commands.has_permissions(administrator=True)
+async def perf_command(ctx):
+    """Mostra as latências por comando e as invocações mais lentas."""
+    relatorio = registro_desempenho.relatorio()
+    embed = discord.Embed(
+        title="⏱️ Desempenho dos Comandos",
+        description="Latência total e, no p95, o tempo gasto no banco e no HTTP do Discord.",
+        color=COR_PRINCIPAL,
+        timestamp=datetime.now(TZ_SAO_PAULO))
+    if not relatorio:
+        embed.description = "Nenhum comando foi medido ainda."
+    for linha in relatorio[:15]:
+        embed.add_field(
+            name=f"`{linha['nome']}` • {linha['chamadas']} chamada(s)",
+            value=f"**Total:** p50 `{linha['p50']:.0f} ms` • p95 `{linha['p95']:.0f} ms` • "
+                  f"p99 `{linha['p99']:.0f} ms`\n"
+                  f"**Banco (p95):** `{linha['db_p95']:.0f} ms` • "
+                  f"**HTTP (p95):** `{linha['http_p95']:.0f} ms`"
+                  + (f" • **Erros:** `{linha['erros']}`" if linha['erros'] else ""),
+            inline=False)
+    lentas = registro_desempenho.mais_lentas()
+    if lentas:
+        embed.add_field(
+            name="🐢 Mais lentas recentes",
+            value="\n".join(
+                f"`{nome}` **{total:.0f} ms** (banco {db:.0f} ms, HTTP {http:.0f} ms) "
+                f"às {quando.strftime('%H:%M:%S')}"
+                for total, nome, db, http, quando in lentas),
+            inline=False)
+    embed.set_footer(text="Percentis estimados a partir de histogramas de baldes fixos.")
+    await ctx.send(embed=embed)
+
+@perf_command.error
+async def perf_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ Você não tem permissão para usar este comando.")
+    else:
+        logger.error(f"Erro inesperado no comando !perf: {error}")
+        await ctx.send("❌ Ocorreu um erro inesperado.")
+
+
+@bot.command(name='perfsql')
+@commands.has_permissions(administrator=True)
+async def perfsql_command(ctx, quantidade: str = "10", ordem: str = "tempo_total"):
+    """Mostra os statements SQL mais caros do modo de perfil (ou limpa o perfil)."""
+    if quantidade.lower() == "limpar":
+        await call_tracker_async.limpar_perfil_sql()
+        await ctx.send("✅ Perfil SQL zerado.")
+        return
+    if not quantidade.isdigit() or ordem not in PerfilSQL.ORDENS:
+        await ctx.send(f"❌ Uso: `!perfsql [quantidade|limpar] [ordem]`. "
+                       f"Ordens: {', '.join(PerfilSQL.ORDENS)}.")
+        return
+    relatorio = await call_tracker_async.relatorio_sql(
+        max(1, min(int(quantidade), 50)), ordem)
+    if relatorio is None:
+        await ctx.send("ℹ️ O perfil SQL está desligado. Inicie o bot com "
+                       "`MEDBOT_PERFIL_SQL=1` para coletá-lo.")
+        return
+
+    embed = discord.Embed(
+        title="🧮 Perfil SQL",
+        description=f"Statements ordenados por `{ordem}`. O SQL completo e os "
+                    "planos estão no arquivo anexo.",
+        color=COR_PRINCIPAL,
+        timestamp=datetime.now(TZ_SAO_PAULO))
+    if not relatorio:
+        embed.description = "Nenhuma consulta foi registrada ainda."
+    for posicao, linha in enumerate(relatorio[:10], start=1):
+        sql = linha['sql'] if len(linha['sql']) <= 200 else linha['sql'][:197] + "..."
+        plano = "\n".join(linha['plano'][:3])
+        embed.add_field(
+            name=f"#{posicao} • {linha['chamadas']} chamada(s) • {linha['tempo_total_ms']:.0f} ms",
+            value=f"```sql\n{sql}\n```"
+                  f"**Média:** `{linha['tempo_medio_ms']:.2f} ms` • "
+                  f"**Máx:** `{linha['tempo_max_ms']:.1f} ms` • "
+                  f"**Linhas:** `{linha['linhas']}` • **Passos VM:** `~{linha['passos_vm']}`"
+                  + (f"\n```\n{plano[:300]}\n```" if plano else ""),
+            inline=False)
+    if not relatorio:
+        await ctx.send(embed=embed)
+        return
+    arquivo = discord.File(
+        io.BytesIO(formatar_relatorio_sql(relatorio).encode('utf-8')),
+        filename="perfil_sql.txt")
+    await ctx.send(embed=embed, file=arquivo)
+
+@perfsql_command.error
+async def perfsql_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ Você não tem permissão para usar este comando.")
+    else:
+        logger.error(f"Erro inesperado no comando !perfsql: {error}")
+        await ctx.send("❌ Ocorreu um erro inesperado.")
+
+
+@bot.command(name='views')
+@commands.has_permissions(administrator=True)
+async def views_command(ctx):
+    """Mostra as views interativas abertas e a memória aproximada do estado delas."""
+    stats = registro_views.estatisticas()
+    embed = discord.Embed(title="🪟 Views Interativas",
+                          color=COR_PRINCIPAL,
+                          timestamp=datetime.now(TZ_SAO_PAULO))
+    embed.add_field(
+        name="📂 Abertas",
+        value=f"**Total:** `{stats['abertas']}` de `{stats['maximo']}`\n" + "\n".join(
+            f"**{nome}:** `{qtd}`" for nome, qtd in sorted(stats['por_tipo'].items())),
+        inline=True)
+    embed.add_field(
+        name="💾 Memória aproximada",
+        value=f"`{stats['memoria_bytes'] / 1024:.1f} KiB`",
+        inline=True)
+    embed.add_field(
+        name="🧹 Encerradas pelo limite",
+        value=f"**Por usuário** (máx. {stats['por_usuario']}): `{stats['despejadas']['usuario']}`\n"
+              f"**Limite global:** `{stats['despejadas']['global']}`",
+        inline=True)
+    await ctx.send(embed=embed)
+
+@views_command.error
+async def views_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ Você não tem permissão para usar este comando.")
+    else:
+        logger.error(f"Erro inesperado no comando !views: {error}")
+        await ctx.send("❌ Ocorreu um erro inesperado.")
+
+
 # ==================== EXECUÇÃO ====================
 
 import os
@@ -1942,6 +5231,13 @@ async def main():
             )
             return
 
+        # SIGTERM (enviado pelo lançador) desliga o bot como um Ctrl+C
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+
+        if METRICAS_PORTA:
+            await servidor_metricas.iniciar()
+
         await bot.start(TOKEN)
 
     except discord.LoginFailure:
@@ -1952,11 +5248,103 @@ async def main():
         logger.error(f"❌ Erro HTTP: {e}")
     except Exception as e:
         logger.error(f"❌ Erro inesperado: {e}")
+    finally:
+        if not bot.is_closed():
+            await bot.close()
+        await servidor_metricas.parar()
+        # Grava os eventos de voz pendentes e fecha as conexões do rastreamento
+        await call_tracker_async.descarregar()
+        await call_tracker_async.fechar()
+
+
+def executar_armazem():
+    """Processo armazém: serve o CallTracker aos clusters até receber SIGTERM."""
+    # O Ctrl+C é tratado pelo lançador, que encerra os clusters antes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    servidor = ServidorArmazem(call_tracker, ENDERECO_ARMAZEM, chave_armazem())
+    try:
+        servidor.servir()
+    finally:
+        servidor.parar()
+        call_tracker.descarregar()
+        call_tracker.fechar()
+
+
+# Intervalo entre as conexões de shards ao gateway (limite de identify)
+INTERVALO_IDENTIFY_S = 5.0
+
+
+def executar_lancador():
+    """Inicia o armazém e os clusters de shards e os reinicia se caírem."""
+    TOKEN = os.getenv("DISCORD_TOKEN")
+    if not TOKEN or TOKEN == "seu_token_aqui":
+        logger.error(
+            "❌ Token do bot não configurado! Crie um arquivo .env e adicione seu DISCORD_TOKEN."
+        )
+        return
+
+    clusters = max(1, min(TOTAL_CLUSTERS, TOTAL_SHARDS))
+    ambiente = dict(os.environ,
+                    MEDBOT_CLUSTERS=str(clusters),
+                    MEDBOT_TOTAL_SHARDS=str(TOTAL_SHARDS),
+                    MEDBOT_ARMAZEM_ENDERECO=os.path.abspath(ENDERECO_ARMAZEM),
+                    MEDBOT_ARMAZEM_CHAVE=os.getenv("MEDBOT_ARMAZEM_CHAVE")
+                    or secrets.token_hex(16))
+
+    def iniciar(nome):
+        papel = "armazem" if nome == "armazem" else "cluster"
+        processo = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            env=dict(ambiente, MEDBOT_PAPEL=papel,
+                     MEDBOT_CLUSTER_ID=str(nome if papel == "cluster" else 0)),
+            # Os filhos não recebem o Ctrl+C; o lançador decide a ordem de parada
+            start_new_session=True)
+        logger.info(f"Processo {nome} iniciado (pid {processo.pid})")
+        return processo
+
+    def encerrar(processo, nome, timeout=30):
+        if processo.poll() is None:
+            processo.terminate()
+            try:
+                processo.wait(timeout)
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Processo {nome} não terminou a tempo; forçando")
+                processo.kill()
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    processos = {'armazem': iniciar('armazem')}
+    try:
+        for cluster_id in range(clusters):
+            processos[cluster_id] = iniciar(cluster_id)
+            time.sleep(INTERVALO_IDENTIFY_S *
+                       len(shards_do_cluster(cluster_id, clusters)))
+        logger.info(f"{clusters} cluster(s) com {TOTAL_SHARDS} shard(s) em execução")
+        while True:
+            time.sleep(5)
+            for nome, processo in list(processos.items()):
+                codigo = processo.poll()
+                if codigo is not None:
+                    logger.warning(
+                        f"Processo {nome} terminou com código {codigo}; reiniciando")
+                    processos[nome] = iniciar(nome)
+    finally:
+        # Clusters primeiro, para que as últimas escritas cheguem ao armazém
+        for nome, processo in processos.items():
+            if nome != 'armazem':
+                encerrar(processo, nome)
+        encerrar(processos['armazem'], 'armazem')
+        logger.info("Todos os processos foram encerrados")
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if PAPEL_PROCESSO == "lancador":
+            executar_lancador()
+        elif PAPEL_PROCESSO == "armazem":
+            executar_armazem()
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("🛑 Bot interrompido pelo usuário")
     except Exception as e:
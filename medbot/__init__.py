@@ -0,0 +1,6 @@
+"""Subsistemas do MedBot que não dependem do bot em execução.
+
+O main.py importa daqui os componentes de logs, métricas, perfil SQL, views
+e do armazém multiprocesso; cada módulo recebe do main.py o que precisa do
+bot (loop, rastreador, agendador de envios) em vez de importá-lo.
+"""
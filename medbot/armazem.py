@@ -0,0 +1,297 @@
+"""Armazém de chamadas do modo multiprocesso (clusters de shards).
+
+O ServidorArmazem roda no processo armazém, único dono do CallTracker, e
+atende os clusters por um socket Unix autenticado. O ClienteArmazem é o
+lado dos clusters; o ProxyArmazem do main.py o estende com a configuração
+e as partições locais de cada servidor.
+"""
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+logger = logging.getLogger(__name__)
+
+# Métodos do CallTracker que os clusters podem chamar no armazém
+METODOS_REMOTOS = frozenset({
+    'registrar_entrada', 'registrar_saida', 'aplicar_transicoes',
+    'obter_estatisticas_usuario', 'obter_ranking', 'obter_ranking_periodo',
+    'obter_pagina_historico', 'obter_ultima_pagina_historico',
+    'contar_sessoes_historico',
+    'get_user_rank', 'sessao_ativa', 'reset_user_calls', 'reset_all_calls',
+    'reconciliar_presenca', 'descarregar', 'estatisticas_rastreamento',
+    'relatorio_sql', 'limpar_perfil_sql'
+})
+
+
+# Retorno de cada método remoto quando o armazém não responde: o mesmo do
+# CallTracker quando o banco falha (registra o erro e segue). Os métodos de
+# diagnóstico (saúde, métricas) e de configuração ficam de fora e propagam o
+# erro, para quem os chama mostrar a falha.
+RESPOSTAS_FALHA_REMOTA = {
+    'registrar_entrada': None, 'registrar_saida': 0, 'aplicar_transicoes': None,
+    'obter_estatisticas_usuario': None, 'obter_ranking': [],
+    'obter_ranking_periodo': [], 'obter_pagina_historico': [],
+    'obter_ultima_pagina_historico': [], 'contar_sessoes_historico': 0,
+    'get_user_rank': None, 'sessao_ativa': None, 'reset_user_calls': False,
+    'reset_all_calls': False,
+    'reconciliar_presenca': {'abertas': 0, 'fechadas': 0, 'mantidas': 0},
+    'descarregar': False, 'relatorio_sql': None, 'limpar_perfil_sql': None,
+    'adotar_servidor_legado': False
+}
+
+
+def chave_armazem():
+    """Chave compartilhada que autentica os clusters no armazém (None se não definida)."""
+    return os.getenv("MEDBOT_ARMAZEM_CHAVE", "").encode() or None
+
+
+def _exigir_chave(chave):
+    # As mensagens são pickle: sem autenticação, qualquer processo local que
+    # alcance o socket executaria código no armazém
+    if not chave:
+        raise ValueError("O armazém de chamadas exige uma chave (MEDBOT_ARMAZEM_CHAVE)")
+
+
+class ClienteArmazem:
+    """Conexão de um cluster com o processo armazém.
+
+    Cada chamada vai para o armazém por um socket Unix e bloqueia até a
+    resposta; o AsyncCallTracker a executa na sua thread, então a ordem das
+    operações de um cluster é preservada. Os métodos de METODOS_REMOTOS
+    viram atributos; se o armazém não responder, os do rastreamento
+    registram o erro e retornam o mesmo padrão do CallTracker
+    (RESPOSTAS_FALHA_REMOTA).
+
+    Com `cluster_id`, cada conexão se identifica ao armazém. Na primeira,
+    `contato_anterior` recebe o último contato (epoch, monotônico) do
+    processo anterior deste cluster, ou None se ele não existiu: as sessões
+    desse cluster ficaram abertas no armazém enquanto ele estava fora.
+    """
+
+    def __init__(self, endereco, chave, espera_conexao=60.0, cluster_id=None):
+        _exigir_chave(chave)
+        self.endereco = endereco
+        self.chave = chave
+        self.espera_conexao = espera_conexao
+        self.cluster_id = cluster_id
+        self.contato_anterior = None
+        self.chamadas = 0
+        self._conn = None
+        self._identificado = False
+        self._lock = threading.Lock()
+
+    def _conectar(self):
+        limite = time.monotonic() + self.espera_conexao
+        while True:
+            try:
+                self._conn = Client(self.endereco, family='AF_UNIX',
+                                    authkey=self.chave)
+                if self.cluster_id is not None:
+                    self._identificar()
+                logger.info(f"Conectado ao armazém de chamadas em {self.endereco}")
+                return
+            except (OSError, EOFError) as e:
+                if time.monotonic() >= limite:
+                    raise ConnectionError(
+                        f"Armazém de chamadas indisponível em {self.endereco}: {e}")
+                time.sleep(0.5)
+
+    def _identificar(self):
+        self._conn.send(('identificar', (self.cluster_id, )))
+        _, contato = self._conn.recv()
+        if not self._identificado:
+            # Reconexões do mesmo processo não contam como queda do cluster
+            self.contato_anterior = contato
+            self._identificado = True
+
+    def _chamar(self, metodo, *args):
+        with self._lock:
+            if self._conn is None:
+                self._conectar()
+            try:
+                self._conn.send((metodo, args))
+            except OSError:
+                # O armazém foi reiniciado: o pedido não chegou, então é reenviado
+                self._conn.close()
+                self._conectar()
+                self._conn.send((metodo, args))
+            try:
+                situacao, resultado = self._conn.recv()
+            except (OSError, EOFError):
+                self._conn.close()
+                self._conn = None
+                raise ConnectionError(
+                    f"Conexão com o armazém perdida durante {metodo}")
+            self.chamadas += 1
+        if situacao != 'ok':
+            raise RuntimeError(f"Erro no armazém ao executar {metodo}: {resultado}")
+        return resultado
+
+    def _chamar_ou_padrao(self, metodo, *args):
+        """Chama `metodo` no armazém; se ele falhar, registra e retorna o padrão do CallTracker."""
+        try:
+            return self._chamar(metodo, *args)
+        except (ConnectionError, RuntimeError) as e:
+            logger.error(f"Erro ao chamar {metodo} no armazém: {e}")
+            padrao = RESPOSTAS_FALHA_REMOTA[metodo]
+            return padrao.copy() if isinstance(padrao, (list, dict)) else padrao
+
+    def __getattr__(self, nome):
+        if nome in RESPOSTAS_FALHA_REMOTA:
+            return functools.partial(self._chamar_ou_padrao, nome)
+        if nome in METODOS_REMOTOS:
+            return functools.partial(self._chamar, nome)
+        raise AttributeError(nome)
+
+    def registrar_saude(self, cluster_id, dados):
+        return self._chamar('registrar_saude', cluster_id, dados)
+
+    def saude_clusters(self):
+        return self._chamar('saude_clusters')
+
+    def fechar(self):
+        """Fecha a conexão deste cluster; o armazém continua atendendo os outros."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        logger.info(f"Conexão com o armazém encerrada após {self.chamadas} chamadas")
+
+
+class ServidorArmazem:
+    """Processo armazém: único dono do CallTracker no modo multiprocesso.
+
+    Atende cada cluster em uma thread própria, mas todas as operações no
+    tracker passam por uma única thread de execução, então o banco continua
+    com um só escritor. Também guarda o último relato de saúde de cada
+    cluster para a visão agregada e o último contato de cada cluster
+    identificado, que o processo que o substitui recebe ao se conectar.
+    """
+
+    def __init__(self, tracker, endereco, chave):
+        _exigir_chave(chave)
+        self.tracker = tracker
+        self.endereco = endereco
+        self.chave = chave
+        self.requisicoes = 0
+        self.erros = 0
+        self._conexoes = set()
+        self._saude = {}  # {cluster_id: dados do último relato}
+        self._contatos = {}  # {cluster_id: (epoch, monotônico) da última requisição}
+        self._lock = threading.Lock()
+        self._listener = None
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="armazem")
+
+    def servir(self):
+        """Aceita conexões de clusters até o processo ser encerrado."""
+        if os.path.exists(self.endereco):
+            os.unlink(self.endereco)  # Socket que sobrou de uma queda
+        self._listener = Listener(self.endereco, family='AF_UNIX',
+                                  authkey=self.chave)
+        os.chmod(self.endereco, 0o600)  # Só o usuário do bot acessa o socket
+        logger.info(f"Armazém de chamadas atendendo em {self.endereco}")
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                if self._listener is None:
+                    return
+                raise
+            except Exception as e:
+                # Falha de autenticação de um cliente não derruba o armazém
+                logger.error(f"Erro ao aceitar conexão no armazém: {e}")
+                continue
+            threading.Thread(target=self._atender, args=(conn, ),
+                             name="armazem_conexao", daemon=True).start()
+
+    def _atender(self, conn):
+        cluster_id = None
+        with self._lock:
+            self._conexoes.add(conn)
+        try:
+            while True:
+                try:
+                    metodo, args = conn.recv()
+                except (EOFError, OSError, TypeError):
+                    # TypeError: a conexão foi fechada pelo parar() durante o recv
+                    return
+                try:
+                    if metodo == 'identificar':
+                        cluster_id = args[0]
+                        with self._lock:
+                            resultado = self._contatos.get(cluster_id)
+                    elif metodo in ('registrar_saude', 'saude_clusters',
+                                  'listar_configs', 'atualizar_config_servidor'):
+                        resultado = getattr(self, metodo)(*args)
+                    elif metodo in METODOS_REMOTOS or metodo == 'adotar_servidor_legado':
+                        resultado = self._executar(
+                            getattr(self.tracker, metodo), *args)
+                    else:
+                        raise ValueError(f"Método não permitido: {metodo}")
+                    resposta = ('ok', resultado)
+                except Exception as e:
+                    self.erros += 1
+                    logger.error(f"Erro no armazém ao executar {metodo}: {e}")
+                    resposta = ('erro', str(e))
+                self.requisicoes += 1
+                if cluster_id is not None:
+                    with self._lock:
+                        self._contatos[cluster_id] = (int(time.time()),
+                                                      time.monotonic())
+                try:
+                    conn.send(resposta)
+                except OSError:
+                    return
+        finally:
+            with self._lock:
+                self._conexoes.discard(conn)
+            conn.close()
+
+    def _executar(self, funcao, *args):
+        """Executa uma função do tracker na thread única do armazém."""
+        return self._executor.submit(funcao, *args).result()
+
+    def listar_configs(self):
+        return [tuple(config)
+                for config in self._executar(self.tracker.listar_configs)]
+
+    def atualizar_config_servidor(self, guild_id, campo, valor):
+        return tuple(self._executar(self.tracker.atualizar_config_servidor,
+                                    guild_id, campo, valor))
+
+    def registrar_saude(self, cluster_id, dados):
+        with self._lock:
+            self._saude[cluster_id] = dict(dados, recebido=time.time())
+
+    def saude_clusters(self):
+        with self._lock:
+            clusters = {cluster_id: dict(dados)
+                        for cluster_id, dados in self._saude.items()}
+            conexoes = len(self._conexoes)
+        return {
+            'armazem': {
+                'pid': os.getpid(),
+                'conexoes': conexoes,
+                'requisicoes': self.requisicoes,
+                'erros': self.erros
+            },
+            'clusters': clusters
+        }
+
+    def parar(self):
+        """Para de aceitar conexões e conclui as operações em andamento."""
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+        with self._lock:
+            conexoes = list(self._conexoes)
+        for conn in conexoes:
+            conn.close()
+        self._executor.shutdown(wait=True)
+        logger.info(
+            f"Armazém encerrado após {self.requisicoes} requisições ({self.erros} com erro)")
@@ -0,0 +1,146 @@
+"""Logs do MedBot: fila em segundo plano, rotação e saída JSON.
+
+O arquivo e o console são escritos por uma thread em segundo plano: o loop
+de eventos só coloca o registro em uma fila. O arquivo roda por tamanho e
+por horário, e os arquivos antigos podem ser comprimidos com gzip.
+"""
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import math
+import os
+import queue
+import re
+import shutil
+import time
+from datetime import datetime
+
+LOG_ARQUIVO = os.getenv("MEDBOT_LOG_ARQUIVO", "bot.log")
+LOG_FORMATO = os.getenv("MEDBOT_LOG_FORMATO", "texto")  # "texto" ou "json"
+LOG_MAX_MB = float(os.getenv("MEDBOT_LOG_MAX_MB", "20"))  # 0 = sem limite
+LOG_ROTACAO_HORAS = float(os.getenv("MEDBOT_LOG_ROTACAO_HORAS", "24"))  # 0 = nunca
+LOG_BACKUPS = int(os.getenv("MEDBOT_LOG_BACKUPS", "14"))
+LOG_COMPRIMIR = os.getenv("MEDBOT_LOG_COMPRIMIR", "1") == "1"
+FORMATO_LOG_TEXTO = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class FormatadorJSON(logging.Formatter):
+    """Uma linha JSON por registro.
+
+    Além de horário, nível, logger e mensagem, inclui os campos passados em
+    `extra=` (evento, guild_id, user_id, canal, duracao_s...).
+    """
+
+    CAMPOS_PADRAO = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+        'message', 'asctime', 'taskName'}
+
+    def format(self, record):
+        dados = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for chave, valor in vars(record).items():
+            if chave not in self.CAMPOS_PADRAO:
+                dados[chave] = valor
+        if record.exc_info:
+            dados['exc'] = self.formatException(record.exc_info)
+        return json.dumps(dados, ensure_ascii=False, default=str)
+
+
+class ArquivoLogRotativo(logging.handlers.BaseRotatingHandler):
+    """Arquivo de log que roda por tamanho e por horário.
+
+    A rotação por horário acontece nos múltiplos de `intervalo_s` contados a
+    partir da meia-noite (com 24 horas, à meia-noite). Um arquivo que ficou
+    de um período anterior, de antes de um reinício, roda no primeiro registro.
+    O arquivo rodado ganha o horário da rotação no nome (bot.log.20260101-000000)
+    e, com `comprimir`, vira .gz. Só os `backups` mais recentes são mantidos.
+    """
+
+    PADRAO_ROTACIONADO = r'\.\d{8}-\d{6}(\.\d+)?(\.gz)?$'
+
+    def __init__(self, caminho, max_bytes=0, intervalo_s=0, backups=7,
+                 comprimir=False):
+        super().__init__(caminho, 'a', encoding='utf-8', delay=True)
+        self.max_bytes = max_bytes
+        self.intervalo_s = intervalo_s
+        self.backups = backups
+        self.comprimir = comprimir
+        referencia = (os.path.getmtime(self.baseFilename)
+                      if os.path.exists(self.baseFilename) else time.time())
+        self.proxima_rotacao = self._calcular_proxima(referencia)
+
+    def _calcular_proxima(self, referencia):
+        if not self.intervalo_s:
+            return math.inf
+        meia_noite = datetime.fromtimestamp(referencia).replace(
+            hour=0, minute=0, second=0, microsecond=0).timestamp()
+        passos = int((referencia - meia_noite) // self.intervalo_s) + 1
+        return meia_noite + passos * self.intervalo_s
+
+    def shouldRollover(self, record):
+        if time.time() >= self.proxima_rotacao:
+            return True
+        if not self.max_bytes:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.max_bytes
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+            carimbo = datetime.now().strftime('%Y%m%d-%H%M%S')
+            destino = f"{self.baseFilename}.{carimbo}"
+            sequencia = 1
+            while os.path.exists(destino) or os.path.exists(destino + '.gz'):
+                destino = f"{self.baseFilename}.{carimbo}.{sequencia}"
+                sequencia += 1
+            os.replace(self.baseFilename, destino)
+            if self.comprimir:
+                with open(destino, 'rb') as origem, gzip.open(destino + '.gz', 'wb') as saida:
+                    shutil.copyfileobj(origem, saida)
+                os.remove(destino)
+            self._apagar_antigos()
+        self.proxima_rotacao = self._calcular_proxima(time.time())
+
+    def _apagar_antigos(self):
+        diretorio, nome = os.path.split(self.baseFilename)
+        padrao = re.compile(re.escape(nome) + self.PADRAO_ROTACIONADO)
+        antigos = sorted((os.path.join(diretorio, arquivo)
+                          for arquivo in os.listdir(diretorio)
+                          if padrao.match(arquivo)),
+                         key=os.path.getmtime, reverse=True)
+        for arquivo in antigos[self.backups:]:
+            os.remove(arquivo)
+
+
+def configurar_logs():
+    """Liga a raiz do logging a uma fila e inicia a thread que escreve os logs."""
+    arquivo = ArquivoLogRotativo(LOG_ARQUIVO,
+                                 max_bytes=int(LOG_MAX_MB * 1024 * 1024),
+                                 intervalo_s=LOG_ROTACAO_HORAS * 3600,
+                                 backups=LOG_BACKUPS,
+                                 comprimir=LOG_COMPRIMIR)
+    arquivo.setFormatter(FormatadorJSON() if LOG_FORMATO == "json"
+                         else logging.Formatter(FORMATO_LOG_TEXTO))
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(FORMATO_LOG_TEXTO))
+
+    fila = queue.SimpleQueue()
+    ouvinte = logging.handlers.QueueListener(fila, arquivo, console,
+                                             respect_handler_level=True)
+    raiz = logging.getLogger()
+    raiz.setLevel(logging.INFO)
+    raiz.addHandler(logging.handlers.QueueHandler(fila))
+    ouvinte.start()
+    # Esvazia a fila no encerramento, antes do logging.shutdown (os handlers
+    # do atexit rodam na ordem inversa do registro)
+    atexit.register(ouvinte.stop)
+    return ouvinte
@@ -0,0 +1,316 @@
+"""Medição de desempenho e métricas do MedBot.
+
+Histogramas de latência por comando e callback, a medição da invocação em
+andamento (que soma o tempo gasto no banco e no HTTP do Discord), o
+cronômetro das requisições HTTP e o endpoint local no formato do Prometheus.
+"""
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import math
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Limites superiores (ms) dos baldes dos histogramas de latência
+BALDES_LATENCIA_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                      10000, 30000)
+
+
+class Histograma:
+    """Histograma de latências (ms) com baldes fixos.
+
+    Cada balde conta as observações até o seu limite; os percentis são
+    estimados por interpolação dentro do balde.
+    """
+
+    def __init__(self, limites=BALDES_LATENCIA_MS):
+        self.limites = limites
+        self.contagens = [0] * (len(limites) + 1)  # O último é o +Inf
+        self.total = 0
+        self.soma = 0.0
+        self.maximo = 0.0
+
+    def observar(self, ms):
+        self.contagens[bisect.bisect_left(self.limites, ms)] += 1
+        self.total += 1
+        self.soma += ms
+        self.maximo = max(self.maximo, ms)
+
+    def percentil(self, p):
+        if not self.total:
+            return 0.0
+        alvo = p * self.total
+        acumulado = 0
+        for i, contagem in enumerate(self.contagens):
+            if contagem and acumulado + contagem >= alvo:
+                inferior = self.limites[i - 1] if i else 0.0
+                superior = min(self.limites[i] if i < len(self.limites)
+                               else self.maximo, self.maximo)
+                return inferior + (superior - inferior) * (alvo - acumulado) / contagem
+            acumulado += contagem
+        return self.maximo
+
+    def instantaneo(self):
+        """Cópia dos contadores, para exportar (inclusive entre processos)."""
+        return {'limites': self.limites, 'contagens': list(self.contagens),
+                'soma': self.soma, 'total': self.total}
+
+
+class Medicao:
+    """Tempos (segundos) de uma invocação de comando ou callback em andamento."""
+
+    __slots__ = ('nome', 'inicio', 'db', 'http', 'erro')
+
+    def __init__(self, nome):
+        self.nome = nome
+        self.inicio = time.perf_counter()
+        self.db = 0.0
+        self.http = 0.0
+        self.erro = False
+
+
+# Medição da invocação que está rodando na tarefa atual (ou None)
+medicao_atual = contextvars.ContextVar('medicao_atual', default=None)
+
+
+class RegistroDesempenho:
+    """Histogramas de latência por comando e por callback de interface.
+
+    Cada invocação registra o tempo total, o tempo esperando o banco (a
+    thread do CallTracker) e o tempo em requisições HTTP ao Discord. As
+    últimas invocações ficam guardadas para listar as mais lentas.
+    """
+
+    RECENTES = 200
+
+    def __init__(self, fuso=None):
+        self.fuso = fuso  # Fuso dos horários das invocações recentes
+        self._metricas = {}  # {nome: {'total', 'db', 'http': Histograma, 'erros': int}}
+        self._recentes = deque(maxlen=self.RECENTES)
+
+    @contextmanager
+    def medir(self, nome):
+        """Mede o bloco como uma invocação de `nome`."""
+        medicao = Medicao(nome)
+        token = medicao_atual.set(medicao)
+        try:
+            yield medicao
+        except BaseException:
+            medicao.erro = True
+            raise
+        finally:
+            medicao_atual.reset(token)
+            self.registrar(medicao)
+
+    def registrar(self, medicao):
+        total = (time.perf_counter() - medicao.inicio) * 1000
+        metricas = self._metricas.get(medicao.nome)
+        if metricas is None:
+            metricas = self._metricas[medicao.nome] = {
+                'total': Histograma(), 'db': Histograma(),
+                'http': Histograma(), 'erros': 0}
+        metricas['total'].observar(total)
+        metricas['db'].observar(medicao.db * 1000)
+        metricas['http'].observar(medicao.http * 1000)
+        if medicao.erro:
+            metricas['erros'] += 1
+        self._recentes.append((total, medicao.nome, medicao.db * 1000,
+                               medicao.http * 1000,
+                               datetime.now(self.fuso)))
+
+    def metricas(self):
+        return self._metricas
+
+    def relatorio(self):
+        """Resumo por nome (p50/p95/p99 em ms), do maior p95 para o menor."""
+        linhas = [{
+            'nome': nome,
+            'chamadas': metricas['total'].total,
+            'erros': metricas['erros'],
+            'p50': metricas['total'].percentil(0.50),
+            'p95': metricas['total'].percentil(0.95),
+            'p99': metricas['total'].percentil(0.99),
+            'db_p95': metricas['db'].percentil(0.95),
+            'http_p95': metricas['http'].percentil(0.95)
+        } for nome, metricas in self._metricas.items()]
+        return sorted(linhas, key=lambda linha: linha['p95'], reverse=True)
+
+    def mais_lentas(self, quantidade=5):
+        """As invocações mais lentas entre as últimas RECENTES."""
+        return sorted(self._recentes, key=lambda recente: recente[0],
+                      reverse=True)[:quantidade]
+
+
+def cronometrar_http(cliente):
+    """Soma o tempo das requisições de `cliente` à medição em andamento."""
+    original = cliente.request
+    if getattr(original, 'cronometrado', False):
+        return
+
+    @functools.wraps(original)
+    async def request(*args, **kwargs):
+        medicao = medicao_atual.get()
+        if medicao is None:
+            return await original(*args, **kwargs)
+        inicio = time.perf_counter()
+        try:
+            return await original(*args, **kwargs)
+        finally:
+            medicao.http += time.perf_counter() - inicio
+
+    request.cronometrado = True
+    cliente.request = request
+
+
+class MonitorLoop:
+    """Mede o atraso do loop de eventos: quanto um sleep curto demora além do pedido."""
+
+    def __init__(self, intervalo=0.5):
+        self.intervalo = intervalo
+        self.atraso = 0.0  # Última medição, em segundos
+        self.histograma = Histograma()
+        self._tarefa = None
+
+    def iniciar(self):
+        if self._tarefa is None:
+            self._tarefa = asyncio.create_task(self._laco())
+
+    async def _laco(self):
+        while True:
+            inicio = time.perf_counter()
+            await asyncio.sleep(self.intervalo)
+            self.atraso = max(0.0, time.perf_counter() - inicio - self.intervalo)
+            self.histograma.observar(self.atraso * 1000)
+
+    def parar(self):
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            self._tarefa = None
+
+
+class TextoPrometheus:
+    """Monta a resposta no formato de texto do Prometheus (versão 0.0.4)."""
+
+    def __init__(self):
+        self.linhas = []
+
+    @staticmethod
+    def _rotulos(rotulos):
+        if not rotulos:
+            return ""
+        pares = []
+        for nome, valor in rotulos.items():
+            valor = (str(valor).replace('\\', '\\\\').replace('"', '\\"')
+                     .replace('\n', '\\n'))
+            pares.append(f'{nome}="{valor}"')
+        return "{" + ",".join(pares) + "}"
+
+    @staticmethod
+    def _valor(valor):
+        if isinstance(valor, float):
+            if math.isnan(valor):
+                return "NaN"
+            if math.isinf(valor):
+                return "+Inf" if valor > 0 else "-Inf"
+            return repr(valor)
+        return str(int(valor))
+
+    def _cabecalho(self, nome, tipo, ajuda):
+        self.linhas.append(f"# HELP {nome} {ajuda}")
+        self.linhas.append(f"# TYPE {nome} {tipo}")
+
+    def metrica(self, nome, tipo, ajuda, amostras):
+        """`amostras`: lista de (rótulos, valor)."""
+        self._cabecalho(nome, tipo, ajuda)
+        for rotulos, valor in amostras:
+            self.linhas.append(f"{nome}{self._rotulos(rotulos)} {self._valor(valor)}")
+
+    def histograma(self, nome, ajuda, series):
+        """`series`: lista de (rótulos, Histograma.instantaneo()), em ms.
+
+        Exportado em segundos, com os baldes acumulados que o Prometheus espera.
+        """
+        self._cabecalho(nome, "histogram", ajuda)
+        for rotulos, dados in series:
+            acumulado = 0
+            limites = list(dados['limites']) + [math.inf]
+            for limite, contagem in zip(limites, dados['contagens']):
+                acumulado += contagem
+                le = "+Inf" if math.isinf(limite) else f"{limite / 1000:g}"
+                self.linhas.append(
+                    f"{nome}_bucket{self._rotulos({**rotulos, 'le': le})} {acumulado}")
+            self.linhas.append(
+                f"{nome}_sum{self._rotulos(rotulos)} {self._valor(dados['soma'] / 1000)}")
+            self.linhas.append(
+                f"{nome}_count{self._rotulos(rotulos)} {dados['total']}")
+
+    def texto(self):
+        return "\n".join(self.linhas) + "\n"
+
+
+class ServidorMetricas:
+    """Endpoint HTTP local (GET /metrics) no formato de texto do Prometheus.
+
+    Só escuta em `host` (localhost por padrão): as métricas não saem da
+    máquina a não ser que um Prometheus local as colete. `coletor` é uma
+    função assíncrona que escreve as métricas da aplicação em um
+    TextoPrometheus; o atraso do loop de eventos é acrescentado aqui.
+    """
+
+    TIPO_CONTEUDO = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, host, porta, coletor):
+        self.host = host
+        self.porta = porta
+        self.coletor = coletor
+        self.monitor_loop = MonitorLoop()
+        self._runner = None
+
+    async def iniciar(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._responder)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.porta).start()
+        except OSError as e:
+            logger.error(f"Erro ao abrir o endpoint de métricas em {self.host}:{self.porta}: {e}")
+            await self._runner.cleanup()
+            self._runner = None
+            return
+        self.monitor_loop.iniciar()
+        logger.info(f"📈 Métricas em http://{self.host}:{self.porta}/metrics")
+
+    async def _responder(self, request):
+        try:
+            texto = await self.coletar()
+        except Exception as e:
+            logger.error(f"Erro ao coletar métricas: {e}")
+            return web.Response(status=500, text="erro ao coletar métricas\n")
+        return web.Response(body=texto.encode('utf-8'),
+                            headers={'Content-Type': self.TIPO_CONTEUDO})
+
+    async def coletar(self):
+        saida = TextoPrometheus()
+        await self.coletor(saida)
+        saida.metrica("medbot_loop_atraso_atual_segundos", "gauge",
+                      "Último atraso medido do loop de eventos.",
+                      [({}, self.monitor_loop.atraso)])
+        saida.histograma("medbot_loop_atraso_segundos",
+                         "Atraso do loop de eventos.",
+                         [({}, self.monitor_loop.histograma.instantaneo())])
+        return saida.texto()
+
+    async def parar(self):
+        self.monitor_loop.parar()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,256 @@
+"""Modo de perfil do SQLite: tempo, linhas e plano por statement.
+
+Com o perfil ativo, as conexões do GerenciadorConexoes são ConexaoPerfilada:
+todo execute passa pelo CursorPerfilado, que soma as medições no PerfilSQL.
+O relatório sai pelo comando !perfsql e pelo benchmark de consultas.
+"""
+import sqlite3
+import threading
+import time
+
+
+class PerfilSQL:
+    """Estatísticas por statement SQL distinto, para o modo de perfil.
+
+    Cada statement é identificado pelo texto com espaços normalizados (os
+    valores vão como parâmetros, então o texto não muda entre chamadas). Na
+    primeira execução o plano (EXPLAIN QUERY PLAN) é capturado com os mesmos
+    parâmetros. O progress handler do SQLite conta as instruções da VM gastas
+    em cada statement, o que mostra o custo crescendo com o volume de dados
+    mesmo quando o tempo é dominado por cache.
+    """
+
+    PASSOS_PROGRESSO = 1000  # Instruções da VM entre chamadas do progress handler
+    COMANDOS_COM_PLANO = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+    ORDENS = ('tempo_total', 'tempo_max', 'chamadas', 'linhas', 'passos_vm')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statements = {}  # {sql normalizado: estatísticas}
+        self.inicio = time.time()
+
+    @staticmethod
+    def normalizar(sql):
+        return " ".join(sql.split())
+
+    def entrada(self, sql):
+        """(estatísticas do statement, se é a primeira vez que ele aparece)."""
+        with self._lock:
+            registro = self._statements.get(sql)
+            if registro is not None:
+                registro['chamadas'] += 1
+                return registro, False
+            registro = self._statements[sql] = {
+                'chamadas': 1, 'execucoes': 0, 'tempo_total': 0.0,
+                'tempo_max': 0.0, 'linhas': 0, 'passos_vm': 0, 'plano': None,
+                'abre_transacao': sql.upper().startswith('BEGIN')
+            }
+            return registro, True
+
+    def somar(self, registro, duracao, acumulado, linhas=0):
+        """Soma um trecho de `duracao` segundos; `acumulado` é o total da chamada até agora."""
+        with self._lock:
+            registro['tempo_total'] += duracao
+            registro['tempo_max'] = max(registro['tempo_max'], acumulado)
+            registro['linhas'] += linhas
+
+    def contar(self, registro, campo, quantidade=1):
+        with self._lock:
+            registro[campo] += quantidade
+
+    def capturar_plano(self, conn, registro, sql, parametros):
+        """Guarda o EXPLAIN QUERY PLAN do statement, indentado pela árvore do plano."""
+        partes = sql.split(None, 1)
+        if not partes or partes[0].upper() not in self.COMANDOS_COM_PLANO:
+            return
+        conn.capturando_plano = True
+        try:
+            linhas = sqlite3.Connection.execute(
+                conn, "EXPLAIN QUERY PLAN " + sql, parametros).fetchall()
+            profundidade = {0: -1}
+            plano = []
+            for id_no, pai, _, detalhe in linhas:
+                profundidade[id_no] = profundidade.get(pai, -1) + 1
+                plano.append("  " * profundidade[id_no] + detalhe)
+            registro['plano'] = plano
+        except sqlite3.Error as e:
+            registro['plano'] = [f"(plano indisponível: {e})"]
+        finally:
+            conn.capturando_plano = False
+
+    def relatorio(self, quantidade=10, ordem='tempo_total'):
+        """Os `quantidade` statements mais caros por `ordem` (tempos em ms)."""
+        with self._lock:
+            linhas = [{
+                'sql': sql,
+                'chamadas': registro['chamadas'],
+                'execucoes': registro['execucoes'],
+                'tempo_total_ms': registro['tempo_total'] * 1000,
+                'tempo_medio_ms': registro['tempo_total'] * 1000 / registro['chamadas'],
+                'tempo_max_ms': registro['tempo_max'] * 1000,
+                'linhas': registro['linhas'],
+                'passos_vm': registro['passos_vm'],
+                'plano': list(registro['plano'] or ())
+            } for sql, registro in self._statements.items()]
+        chave = {'tempo_total': 'tempo_total_ms',
+                 'tempo_max': 'tempo_max_ms'}.get(ordem, ordem)
+        linhas.sort(key=lambda linha: linha[chave], reverse=True)
+        return linhas[:quantidade]
+
+    def limpar(self):
+        with self._lock:
+            self._statements.clear()
+            self.inicio = time.time()
+
+
+def formatar_relatorio_sql(relatorio):
+    """Texto do relatório do PerfilSQL, com o SQL completo e o plano."""
+    blocos = []
+    for posicao, linha in enumerate(relatorio, start=1):
+        bloco = [
+            f"#{posicao}  {linha['chamadas']} chamada(s), {linha['execucoes']} execução(ões)  "
+            f"total {linha['tempo_total_ms']:.1f} ms  média {linha['tempo_medio_ms']:.3f} ms  "
+            f"máx {linha['tempo_max_ms']:.1f} ms  linhas {linha['linhas']}  "
+            f"passos VM ~{linha['passos_vm']}",
+            f"    {linha['sql']}"
+        ]
+        if linha['plano']:
+            bloco.append("    Plano:")
+            bloco.extend(f"      {passo}" for passo in linha['plano'])
+        blocos.append("\n".join(bloco))
+    return "\n\n".join(blocos) + "\n"
+
+
+class CursorPerfilado(sqlite3.Cursor):
+    """Cursor que mede execute/executemany e os fetches no PerfilSQL da conexão.
+
+    O tempo de uma chamada inclui os fetches, já que o SQLite só produz as
+    linhas conforme elas são lidas.
+    """
+
+    _registro = None
+    _acumulado = 0.0
+
+    def _medir(self, funcao, *args):
+        conn = self.connection
+        anterior = conn.registro_atual
+        conn.registro_atual = self._registro
+        inicio = time.perf_counter()
+        try:
+            return funcao(*args)
+        finally:
+            duracao = time.perf_counter() - inicio
+            conn.registro_atual = anterior
+            self._acumulado += duracao
+            conn.perfil.somar(self._registro, duracao, self._acumulado)
+
+    def _iniciar(self, sql, parametros):
+        perfil = self.connection.perfil
+        self._registro, novo = perfil.entrada(PerfilSQL.normalizar(sql))
+        self._acumulado = 0.0
+        if novo:
+            perfil.capturar_plano(self.connection, self._registro, sql, parametros)
+
+    def _contar_alteradas(self):
+        # Escritas não retornam linhas: conta as linhas alteradas
+        if self.description is None and self.rowcount > 0:
+            self.connection.perfil.contar(self._registro, 'linhas', self.rowcount)
+
+    def execute(self, sql, parametros=()):
+        self._iniciar(sql, parametros)
+        self._medir(super().execute, sql, parametros)
+        self._contar_alteradas()
+        return self
+
+    def executemany(self, sql, parametros):
+        parametros = list(parametros)  # O primeiro item é usado no plano
+        self._iniciar(sql, parametros[0] if parametros else ())
+        self._medir(super().executemany, sql, parametros)
+        self._contar_alteradas()
+        return self
+
+    def _contar_lidas(self, linhas):
+        if linhas:
+            self.connection.perfil.contar(self._registro, 'linhas', linhas)
+
+    def fetchone(self):
+        if self._registro is None:
+            return super().fetchone()
+        linha = self._medir(super().fetchone)
+        self._contar_lidas(linha is not None)
+        return linha
+
+    def fetchmany(self, size=None):
+        if self._registro is None:
+            return super().fetchmany(size or self.arraysize)
+        linhas = self._medir(super().fetchmany, size or self.arraysize)
+        self._contar_lidas(len(linhas))
+        return linhas
+
+    def fetchall(self):
+        if self._registro is None:
+            return super().fetchall()
+        linhas = self._medir(super().fetchall)
+        self._contar_lidas(len(linhas))
+        return linhas
+
+    def __next__(self):
+        if self._registro is None:
+            return super().__next__()
+        linha = self._medir(super().__next__)
+        self._contar_lidas(1)
+        return linha
+
+
+class ConexaoPerfilada(sqlite3.Connection):
+    """Conexão do modo de perfil: todo execute passa pelo CursorPerfilado.
+
+    O trace callback do SQLite conta as execuções reais de cada statement
+    (uma por linha no executemany) e registra os BEGIN/COMMIT que o módulo
+    sqlite3 emite por conta própria.
+    """
+
+    perfil = None
+
+    def ativar_perfil(self, perfil):
+        self.perfil = perfil
+        self.registro_atual = None
+        self.capturando_plano = False
+        self.set_trace_callback(self._rastrear)
+        self.set_progress_handler(self._progresso, PerfilSQL.PASSOS_PROGRESSO)
+
+    def _rastrear(self, sql):
+        if self.capturando_plano:
+            return
+        atual = self.registro_atual
+        if atual is not None and (atual['abre_transacao'] or
+                                  not sql.lstrip().upper().startswith('BEGIN')):
+            self.perfil.contar(atual, 'execucoes')
+        else:
+            # BEGIN implícito do módulo sqlite3, antes da primeira escrita
+            registro, _ = self.perfil.entrada(PerfilSQL.normalizar(sql))
+            self.perfil.contar(registro, 'execucoes')
+
+    def _progresso(self):
+        if self.registro_atual is not None and not self.capturando_plano:
+            self.perfil.contar(self.registro_atual, 'passos_vm',
+                               PerfilSQL.PASSOS_PROGRESSO)
+        return 0  # Nunca interrompe a consulta
+
+    def execute(self, sql, parametros=()):
+        return self.cursor(CursorPerfilado).execute(sql, parametros)
+
+    def executemany(self, sql, parametros):
+        return self.cursor(CursorPerfilado).executemany(sql, parametros)
+
+    def commit(self):
+        registro, _ = self.perfil.entrada("COMMIT")
+        anterior = self.registro_atual
+        self.registro_atual = registro
+        inicio = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            duracao = time.perf_counter() - inicio
+            self.registro_atual = anterior
+            self.perfil.somar(registro, duracao, duracao)
@@ -0,0 +1,129 @@
+"""Estado das mensagens interativas do MedBot (páginas e views).
+
+O RegistroViews limita as views abertas e estima a memória delas; o
+CachePaginas guarda as páginas já renderizadas do !consultar e da
+!hierarquia. Limites, capacidade e a edição da mensagem de uma view
+despejada vêm do main.py.
+"""
+import sys
+from collections import OrderedDict, deque
+
+
+def tamanho_aproximado(objeto, vistos=None, modulos=None):
+    """Bytes aproximados de `objeto` e do que ele referencia.
+
+    Percorre contêineres e objetos de classes definidas nos `modulos` (por
+    padrão, o módulo de `objeto`). Os ids em `vistos` são de objetos
+    compartilhados (rastreador, bot, caches) e não entram na conta.
+    """
+    if vistos is None:
+        vistos = set()
+    if modulos is None:
+        modulos = {type(objeto).__module__}
+    if id(objeto) in vistos:
+        return 0
+    vistos.add(id(objeto))
+    tamanho = sys.getsizeof(objeto)
+    if isinstance(objeto, dict):
+        for chave, valor in objeto.items():
+            tamanho += tamanho_aproximado(chave, vistos, modulos)
+            tamanho += tamanho_aproximado(valor, vistos, modulos)
+    elif isinstance(objeto, (list, tuple, set, frozenset, deque)):
+        for item in objeto:
+            tamanho += tamanho_aproximado(item, vistos, modulos)
+    elif type(objeto).__module__ in modulos and hasattr(objeto, '__dict__'):
+        tamanho += tamanho_aproximado(vars(objeto), vistos, modulos)
+    return tamanho
+
+
+class RegistroViews:
+    """Views interativas abertas, com limite por usuário e global.
+
+    Ao passar do limite, a view mais antiga (do usuário ou de todas) é
+    encerrada com os botões desativados e `ao_despejar(view, mensagem)` edita
+    a mensagem. `compartilhados()` devolve os objetos globais do bot, que
+    ficam fora da memória estimada das views. Views que expiraram ou foram
+    encerradas saem do registro no próximo uso.
+    """
+
+    def __init__(self, por_usuario, maximo, ao_despejar=None,
+                 compartilhados=None):
+        self.por_usuario = max(1, por_usuario)
+        self.maximo = max(1, maximo)
+        self.ao_despejar = ao_despejar
+        self.compartilhados = compartilhados or (lambda: ())
+        self._views = OrderedDict()  # {view: (dono_id, mensagem)}, da mais antiga
+        self.despejadas = {'usuario': 0, 'global': 0}
+
+    def registrar(self, view, dono_id, mensagem):
+        """Registra a view enviada em `mensagem` e aplica os limites."""
+        self._remover_encerradas()
+        self._views[view] = (dono_id, mensagem)
+        do_dono = [outra for outra, (dono, _) in self._views.items()
+                   if dono == dono_id]
+        for antiga in do_dono[:-self.por_usuario]:
+            self._despejar(antiga, 'usuario')
+        while len(self._views) > self.maximo:
+            self._despejar(next(iter(self._views)), 'global')
+
+    def _remover_encerradas(self):
+        for view in [view for view in self._views if view.is_finished()]:
+            del self._views[view]
+
+    def _despejar(self, view, motivo):
+        _, mensagem = self._views.pop(view)
+        self.despejadas[motivo] += 1
+        for item in view.children:
+            item.disabled = True
+        view.stop()
+        if mensagem is not None and self.ao_despejar is not None:
+            self.ao_despejar(view, mensagem)
+
+    def estatisticas(self):
+        """Views abertas por tipo e a memória aproximada do estado delas."""
+        self._remover_encerradas()
+        por_tipo = {}
+        vistos = {id(valor) for valor in self.compartilhados()}
+        memoria = 0
+        for view in self._views:
+            nome = type(view).__name__
+            por_tipo[nome] = por_tipo.get(nome, 0) + 1
+            memoria += tamanho_aproximado(view, vistos)
+        return {
+            'abertas': len(self._views),
+            'por_tipo': por_tipo,
+            'memoria_bytes': memoria,
+            'despejadas': dict(self.despejadas),
+            'por_usuario': self.por_usuario,
+            'maximo': self.maximo
+        }
+
+
+class CachePaginas:
+    """LRU das páginas já renderizadas do !consultar e da !hierarquia.
+
+    Guarda o payload do embed (`Embed.to_dict()`) e, no histórico, as sessões
+    da página, com chaves que incluem a versão dos dados exibidos. Voltar a
+    uma página já vista não consulta o banco nem formata o embed de novo.
+    """
+
+    def __init__(self, capacidade):
+        self.capacidade = capacidade
+        self._paginas = OrderedDict()
+        self.acertos = 0
+        self.falhas = 0
+
+    def obter(self, chave):
+        valor = self._paginas.get(chave)
+        if valor is None:
+            self.falhas += 1
+            return None
+        self._paginas.move_to_end(chave)
+        self.acertos += 1
+        return valor
+
+    def guardar(self, chave, valor):
+        self._paginas[chave] = valor
+        self._paginas.move_to_end(chave)
+        while len(self._paginas) > self.capacidade:
+            self._paginas.popitem(last=False)
@@ -0,0 +1,25 @@
+"""Fixtures compartilhadas pelos testes do MedBot."""
+import os
+import sys
+
+import pytest
+
+# Raiz do repositório (onde fica o main.py)
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    """O main.py importado com o diretório de trabalho em uma pasta temporária.
+
+    Ao ser importado, o main.py abre call_tracker.db e bot.log no diretório
+    atual; assim os testes nunca tocam nos arquivos de produção.
+    """
+    anterior = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("medbot"))
+    import main as modulo
+    yield modulo
+    modulo.call_tracker.fechar()
+    os.chdir(anterior)
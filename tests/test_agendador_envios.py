@@ -0,0 +1,90 @@
+"""Agrupamento de envios do AgendadorEnvios sob pressão."""
+import asyncio
+
+import discord
+
+
+def _item(main, seq, prioridade, *embeds):
+    return main.ItemEnvio(prioridade, seq, 1, None, (),
+                          {'embeds': list(embeds)}, None, True, False)
+
+
+def test_mesclar_respeita_limite_de_caracteres(main):
+    agendador = main.AgendadorEnvios()
+    prioridade = main.PRIORIDADE_PLANTAO
+    itens = [_item(main, seq, prioridade, discord.Embed(description="x" * 2500))
+             for seq in range(3)]
+
+    resultado = agendador._mesclar(itens)
+
+    # 2 x 2500 cabem em 6000 caracteres; o terceiro vai em outra mensagem
+    assert [len(item.kwargs['embeds']) for item in resultado] == [2, 1]
+    assert all(agendador._caracteres(item) <= agendador.MAX_CARACTERES
+               for item in resultado)
+
+
+def test_mesclar_respeita_limite_de_embeds(main):
+    agendador = main.AgendadorEnvios()
+    itens = [_item(main, seq, main.PRIORIDADE_PLANTAO, discord.Embed(title="a"))
+             for seq in range(12)]
+
+    resultado = agendador._mesclar(itens)
+
+    assert [len(item.kwargs['embeds']) for item in resultado] == [10, 2]
+
+
+def test_moderacao_nunca_e_mesclada(main):
+    agendador = main.AgendadorEnvios()
+    itens = [_item(main, seq, main.PRIORIDADE_MODERACAO, discord.Embed(title="a"))
+             for seq in range(3)]
+
+    resultado = agendador._mesclar(itens)
+
+    assert len(resultado) == 3
+    assert agendador.mesclados == 0
+
+
+def test_alivio_em_lotes_sob_pressao(main):
+    async def cenario():
+        agendador = main.AgendadorEnvios(limite_pressao=50)
+        alivios = []
+        original = agendador._aliviar_pressao
+        agendador._aliviar_pressao = lambda: (alivios.append(
+            agendador.profundidade), original())
+
+        async def enviar(**kwargs):
+            return None
+
+        # Moderação não é descartada nem mesclada: a fila só cresce
+        futuros = [agendador.agendar(rota % 5, main.PRIORIDADE_MODERACAO, enviar)
+                   for rota in range(1000)]
+        agendador._laco_tarefa.cancel()
+        return agendador, alivios, futuros
+
+    agendador, alivios, futuros = asyncio.run(cenario())
+    assert agendador.profundidade == 1000
+    # A fila não é reavaliada a cada envio: o nível cresce com a profundidade
+    assert len(alivios) < 15
+
+
+def test_alivio_descarta_baixa_prioridade_vencida(main):
+    async def cenario():
+        agendador = main.AgendadorEnvios(limite_pressao=3,
+                                         validade_baixa_prioridade=60)
+
+        async def enviar(**kwargs):
+            return None
+
+        antigos = [agendador.agendar(1, main.PRIORIDADE_PLANTAO, enviar)
+                   for _ in range(3)]
+        for item in agendador._filas[1]:
+            item.criado_em -= 120
+        novo = agendador.agendar(2, main.PRIORIDADE_PLANTAO, enviar)
+        agendador._laco_tarefa.cancel()
+        return agendador, antigos, novo
+
+    agendador, antigos, novo = asyncio.run(cenario())
+    assert all(futuro.done() and futuro.result() is None for futuro in antigos)
+    assert not novo.done()
+    assert agendador.descartados == 3
+    assert agendador.profundidade == 1
@@ -0,0 +1,12 @@
+"""Campos renderizados do ranking no CacheRanking."""
+
+
+def test_apelido_novo_nao_reaproveita_o_texto(main):
+    cache = main.CacheRanking()
+    ranking = [{'user_id': 10, 'total_segundos': 3600},
+               {'user_id': 11, 'total_segundos': 60}]
+    cache.guardar_renderizado(None, ranking, ["Ana", "Bia"], "texto antigo")
+
+    assert cache.obter_renderizado(None, ranking, ["Ana", "Bia"]) == "texto antigo"
+    assert cache.obter_renderizado(None, ranking, ["Dra. Ana", "Bia"]) is None
+    assert cache.obter_renderizado('dia', ranking, ["Ana", "Bia"]) is None
@@ -0,0 +1,84 @@
+"""Paginação do histórico pelo CursorHistorico."""
+import asyncio
+
+
+class TrackerFalso:
+    """Histórico em memória com a mesma interface do AsyncCallTracker."""
+
+    def __init__(self, total, atraso=0):
+        # (id, user_id, user_name, canal, entrada, saida, duracao)
+        self.sessoes = [(i, 1, "u", "c", f"2024-01-01T00:{i:02d}", None, 60)
+                        for i in range(1, total + 1)]
+        self.atraso = atraso
+        self.consultas = 0
+
+    async def obter_pagina_historico(self, guild_id, user_id, limite,
+                                     antes=None, depois=None):
+        self.consultas += 1
+        await asyncio.sleep(self.atraso)
+        recentes = sorted(self.sessoes, key=lambda s: (s[4], s[0]), reverse=True)
+        if antes is not None:
+            return [s for s in recentes if (s[4], s[0]) < antes][:limite]
+        if depois is not None:
+            return [s for s in recentes if (s[4], s[0]) > depois][-limite:]
+        return recentes[:limite]
+
+    async def obter_ultima_pagina_historico(self, guild_id, user_id, limite):
+        self.consultas += 1
+        await asyncio.sleep(self.atraso)
+        recentes = sorted(self.sessoes, key=lambda s: (s[4], s[0]), reverse=True)
+        return recentes[-limite:]
+
+
+def test_ultima_pagina_alinhada_com_as_vizinhas(main):
+    async def cenario():
+        tracker = TrackerFalso(12)
+        cursor = main.CursorHistorico(tracker, 1, 1, 12, items_per_page=5)
+        paginas = [await cursor.pagina(n) for n in (1, 2, 3)]
+        return [s[0] for pagina in paginas for s in pagina]
+
+    assert asyncio.run(cenario()) == list(range(12, 0, -1))
+
+
+def test_salto_perto_do_fim_anda_a_partir_da_ultima_pagina(main):
+    async def cenario():
+        tracker = TrackerFalso(52)
+        cursor = main.CursorHistorico(tracker, 1, 1, 52, items_per_page=5)
+        penultima = await cursor.pagina(10)
+        return tracker.consultas, [s[0] for s in penultima]
+
+    consultas, ids = asyncio.run(cenario())
+    # Última página (11) e a 10 pela chave dela, em vez de 10 páginas a partir da 1
+    assert consultas == 2
+    assert ids == [7, 6, 5, 4, 3]
+
+
+def test_pre_carregamento_fica_guardado_sem_ser_aguardado(main):
+    async def cenario():
+        cursor = main.CursorHistorico(TrackerFalso(12), 1, 1, 12,
+                                      items_per_page=5)
+        await cursor.pagina(1)
+        cursor.pre_carregar(1)
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return cursor
+
+    cursor = asyncio.run(cenario())
+    assert 2 in cursor._paginas
+    assert not cursor._carregando
+
+
+def test_fechar_cancela_pre_carregamentos(main):
+    async def cenario():
+        cursor = main.CursorHistorico(TrackerFalso(12, atraso=10), 1, 1, 12,
+                                      items_per_page=5)
+        cursor.adotar(1, [])
+        cursor.pre_carregar(1)
+        tarefa = cursor._carregando[2]
+        cursor.fechar()
+        await asyncio.sleep(0)
+        return cursor, tarefa
+
+    cursor, tarefa = asyncio.run(cenario())
+    assert tarefa.cancelled()
+    assert not cursor._carregando and not cursor._paginas
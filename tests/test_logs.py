@@ -0,0 +1,69 @@
+"""Rotação do arquivo de log (medbot.logs.ArquivoLogRotativo)."""
+import gzip
+import logging
+import os
+import time
+from datetime import datetime
+
+from medbot.logs import ArquivoLogRotativo
+
+
+def _registro(mensagem):
+    return logging.LogRecord("teste", logging.INFO, __file__, 0, mensagem,
+                             (), None)
+
+
+def _rotacionados(diretorio):
+    return sorted(arquivo for arquivo in os.listdir(diretorio)
+                  if arquivo != "bot.log")
+
+
+def test_roda_por_tamanho(tmp_path):
+    handler = ArquivoLogRotativo(str(tmp_path / "bot.log"), max_bytes=200)
+    try:
+        for i in range(20):
+            handler.emit(_registro(f"mensagem {i:02d} " + "x" * 20))
+    finally:
+        handler.close()
+
+    rotacionados = _rotacionados(tmp_path)
+    assert rotacionados
+    assert os.path.getsize(tmp_path / "bot.log") < 200 + 40
+    # Nenhuma linha se perde entre os arquivos
+    linhas = []
+    for arquivo in rotacionados + ["bot.log"]:
+        linhas += (tmp_path / arquivo).read_text(encoding="utf-8").splitlines()
+    assert sorted(linhas) == [f"mensagem {i:02d} " + "x" * 20 for i in range(20)]
+
+
+def test_mantem_so_os_backups_mais_recentes_comprimidos(tmp_path):
+    handler = ArquivoLogRotativo(str(tmp_path / "bot.log"), backups=2,
+                                 comprimir=True)
+    try:
+        for i in range(4):
+            handler.emit(_registro(f"lote {i}"))
+            handler.doRollover()
+    finally:
+        handler.close()
+
+    rotacionados = _rotacionados(tmp_path)
+    assert len(rotacionados) == 2
+    assert all(arquivo.endswith(".gz") for arquivo in rotacionados)
+    # Os mais antigos (lotes 0 e 1) foram apagados
+    conteudos = set()
+    for arquivo in rotacionados:
+        with gzip.open(tmp_path / arquivo, "rt", encoding="utf-8") as entrada:
+            conteudos.add(entrada.read().strip())
+    assert conteudos == {"lote 2", "lote 3"}
+
+
+def test_proxima_rotacao_alinhada_a_meia_noite(tmp_path):
+    handler = ArquivoLogRotativo(str(tmp_path / "bot.log"), intervalo_s=6 * 3600)
+    try:
+        referencia = datetime(2026, 1, 1, 13, 30).timestamp()
+        assert handler._calcular_proxima(referencia) == datetime(2026, 1, 1, 18, 0).timestamp()
+        # Arquivo de antes de um reinício: roda no primeiro registro
+        handler.proxima_rotacao = time.time() - 1
+        assert handler.shouldRollover(_registro("atrasado"))
+    finally:
+        handler.close()
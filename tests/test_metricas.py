@@ -0,0 +1,89 @@
+"""Histogramas de latência e exportação no formato do Prometheus (medbot.metricas)."""
+import asyncio
+
+import pytest
+
+from medbot.metricas import (Histograma, RegistroDesempenho, ServidorMetricas,
+                             TextoPrometheus)
+
+
+def test_percentis_interpolados_dentro_do_balde():
+    histograma = Histograma()
+    for ms in range(1, 101):
+        histograma.observar(ms)
+
+    assert histograma.total == 100
+    assert histograma.percentil(0.50) == pytest.approx(50)
+    assert histograma.percentil(0.95) == pytest.approx(95)
+    assert histograma.percentil(0.99) == pytest.approx(99)
+
+
+def test_percentil_nunca_passa_do_maximo():
+    histograma = Histograma()
+    histograma.observar(7)
+
+    assert 5 <= histograma.percentil(0.99) <= 7
+    assert histograma.percentil(1.0) == 7
+
+
+def test_balde_infinito_usa_o_maximo_como_limite():
+    histograma = Histograma()
+    histograma.observar(40000)
+
+    assert histograma.contagens[-1] == 1
+    assert histograma.percentil(1.0) == 40000
+
+
+def test_histograma_vazio():
+    assert Histograma().percentil(0.95) == 0.0
+
+
+def test_instantaneo_e_uma_copia():
+    histograma = Histograma()
+    histograma.observar(3)
+    instantaneo = histograma.instantaneo()
+    histograma.observar(3)
+
+    assert instantaneo['total'] == 1
+    assert sum(instantaneo['contagens']) == 1
+
+
+def test_registro_marca_erro_e_repropaga():
+    registro = RegistroDesempenho()
+    with pytest.raises(ValueError):
+        with registro.medir("!falha"):
+            raise ValueError("erro")
+
+    assert registro.metricas()["!falha"]['erros'] == 1
+    assert registro.relatorio()[0]['chamadas'] == 1
+
+
+def test_texto_prometheus_acumula_baldes_em_segundos():
+    histograma = Histograma(limites=(10, 100))
+    for ms in (5, 50, 50, 500):
+        histograma.observar(ms)
+    saida = TextoPrometheus()
+    saida.histograma("medbot_teste_segundos", "Teste.",
+                     [({'comando': '!a"b'}, histograma.instantaneo())])
+
+    linhas = saida.texto().splitlines()
+    assert linhas[:2] == ["# HELP medbot_teste_segundos Teste.",
+                          "# TYPE medbot_teste_segundos histogram"]
+    assert linhas[2:] == [
+        'medbot_teste_segundos_bucket{comando="!a\\"b",le="0.01"} 1',
+        'medbot_teste_segundos_bucket{comando="!a\\"b",le="0.1"} 3',
+        'medbot_teste_segundos_bucket{comando="!a\\"b",le="+Inf"} 4',
+        'medbot_teste_segundos_sum{comando="!a\\"b"} 0.605',
+        'medbot_teste_segundos_count{comando="!a\\"b"} 4',
+    ]
+
+
+def test_servidor_metricas_usa_o_coletor_da_aplicacao():
+    async def coletor(saida):
+        saida.metrica("medbot_info", "gauge", "Info.", [({'papel': 'unico'}, 1)])
+
+    servidor = ServidorMetricas("127.0.0.1", 0, coletor)
+    texto = asyncio.run(servidor.coletar())
+
+    assert 'medbot_info{papel="unico"} 1' in texto
+    assert "medbot_loop_atraso_atual_segundos 0.0" in texto
@@ -0,0 +1,39 @@
+"""As consultas críticas do rastreamento não podem cair em varredura completa."""
+
+
+def test_consultas_criticas_usam_indices(main, tmp_path):
+    # Banco novo, criado pelas MIGRACOES do CallTracker
+    tracker = main.CallTracker(str(tmp_path / "planos.db"))
+    try:
+        com_varredura = {}
+        with tracker.conexoes.leitura() as conn:
+            for nome, sql, parametros, exigido in main.CONSULTAS_CRITICAS:
+                plano = conn.execute(f"EXPLAIN QUERY PLAN {sql}",
+                                     parametros).fetchall()
+                detalhes = [linha[-1] for linha in plano]
+                if main.plano_inadequado(detalhes, exigido):
+                    com_varredura[nome] = detalhes
+    finally:
+        tracker.fechar()
+    assert not com_varredura, f"Consultas com varredura completa: {com_varredura}"
+
+
+def test_plano_tem_varredura(main):
+    assert main.plano_tem_varredura("SCAN call_sessions")
+    assert main.plano_tem_varredura("USE TEMP B-TREE FOR ORDER BY")
+    assert not main.plano_tem_varredura(
+        "SEARCH call_sessions USING INDEX idx_call_sessions_finalizadas (guild_id=? AND user_id=?)")
+    assert not main.plano_tem_varredura("SCAN call_stats USING INDEX idx_call_stats_total")
+
+
+def test_plano_inadequado_com_acesso_exigido(main):
+    exigido = "idx_call_daily_dia (guild_id=? AND dia>?)"
+    assert not main.plano_inadequado([
+        "SEARCH call_daily USING COVERING INDEX idx_call_daily_dia (guild_id=? AND dia>?)",
+        "USE TEMP B-TREE FOR GROUP BY",
+    ], exigido)
+    # Busca só pelo guild_id na chave primária lê todo o histórico do servidor
+    assert main.plano_inadequado([
+        "SEARCH d USING PRIMARY KEY (guild_id=?)",
+        "USE TEMP B-TREE FOR ORDER BY",
+    ], exigido)
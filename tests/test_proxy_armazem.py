@@ -0,0 +1,46 @@
+"""Contrato de falha do ProxyArmazem (modo multiprocesso)."""
+import os
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def armazem(main, tmp_path):
+    tracker = main.CallTracker(str(tmp_path / "armazem.db"))
+    servidor = main.ServidorArmazem(tracker, str(tmp_path / "armazem.sock"),
+                                    b"chave")
+    thread = threading.Thread(target=servidor.servir, daemon=True)
+    thread.start()
+    yield servidor
+    servidor.parar()
+    tracker.fechar()
+
+
+def test_armazem_fora_retorna_os_padroes_do_call_tracker(main, armazem):
+    proxy = main.ProxyArmazem(armazem.endereco, armazem.chave,
+                              espera_conexao=5)
+    assert proxy.obter_ranking(1, 10) == []
+
+    armazem.parar()
+    proxy.espera_conexao = 0.1
+
+    assert proxy.obter_ranking(1, 10) == []
+    assert proxy.registrar_saida(1, 10, "a", "Plantão") == 0
+    assert proxy.obter_estatisticas_usuario(1, 10) is None
+    assert proxy.reset_user_calls(1, 10) is False
+    assert proxy.reconciliar_presenca([1], []) == {
+        'abertas': 0, 'fechadas': 0, 'mantidas': 0}
+    # Diagnóstico continua mostrando a falha
+    with pytest.raises(ConnectionError):
+        proxy.saude_clusters()
+
+
+def test_armazem_exige_chave_e_restringe_o_socket(main, armazem, tmp_path):
+    # Espera o armazém abrir o socket
+    main.ProxyArmazem(armazem.endereco, armazem.chave, espera_conexao=5).fechar()
+    assert os.stat(armazem.endereco).st_mode & 0o777 == 0o600
+    with pytest.raises(ValueError):
+        main.ServidorArmazem(armazem.tracker, str(tmp_path / "outro.sock"), None)
+    with pytest.raises(ValueError):
+        main.ProxyArmazem(armazem.endereco, b"")
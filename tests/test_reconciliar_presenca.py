@@ -0,0 +1,83 @@
+"""Reconciliação das sessões abertas com quem está em call."""
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def tracker(main, tmp_path):
+    tracker = main.CallTracker(str(tmp_path / "presenca.db"))
+    yield tracker
+    tracker.fechar()
+
+
+def test_sessao_migrada_sem_canal_id_e_mantida(tracker):
+    # Sessões anteriores ao canal_id: só o nome do canal é conhecido
+    tracker.ativos(1)[10] = {'entrada': 1_000, 'entrada_mono': None,
+                             'canal': 'Plantão', 'canal_id': None,
+                             'user_name': 'a'}
+
+    resultado = tracker.reconciliar_presenca(
+        [1], [(1, 10, 'a', 'Plantão', 555)])
+
+    assert resultado == {'abertas': 0, 'fechadas': 0, 'mantidas': 1}
+    assert tracker.ativos(1)[10]['canal_id'] == 555
+
+
+def test_sessao_migrada_em_outro_canal_e_reaberta(tracker):
+    tracker.ativos(1)[10] = {'entrada': 1_000, 'entrada_mono': None,
+                             'canal': 'Plantão', 'canal_id': None,
+                             'user_name': 'a'}
+
+    resultado = tracker.reconciliar_presenca(
+        [1], [(1, 10, 'a', 'Estudos', 556)])
+
+    assert resultado == {'abertas': 1, 'fechadas': 1, 'mantidas': 0}
+
+
+def test_reconexao_nao_credita_o_tempo_fora(main, tracker):
+    agora, agora_mono = main.relogio.marcar()
+    # Entrou há 1 h; o gateway caiu há 50 min
+    tracker.ativos(1)[10] = {'entrada': agora - 3600,
+                             'entrada_mono': agora_mono - 3600,
+                             'canal': 'Plantão', 'canal_id': 555,
+                             'user_name': 'a'}
+    desconexao = (agora - 3000, agora_mono - 3000)
+
+    resultado = tracker.reconciliar_presenca(
+        [1], [(1, 10, 'a', 'Plantão', 555)], desconexao)
+
+    assert resultado == {'abertas': 1, 'fechadas': 1, 'mantidas': 0}
+    stats = tracker.obter_estatisticas_usuario(1, 10)
+    assert stats['total_segundos'] == 600
+    assert tracker.ativos(1)[10]['entrada'] >= agora
+
+
+def test_cluster_reiniciado_nao_credita_o_tempo_fora(main, tracker, tmp_path):
+    servidor = main.ServidorArmazem(tracker, str(tmp_path / "armazem.sock"),
+                                    b"chave")
+    threading.Thread(target=servidor.servir, daemon=True).start()
+    try:
+        anterior = main.ProxyArmazem(servidor.endereco, servidor.chave,
+                                     espera_conexao=5, cluster_id=3)
+        assert anterior.contato_anterior is None
+        agora, agora_mono = main.relogio.marcar()
+        tracker.ativos(1)[10] = {'entrada': agora - 3600,
+                                 'entrada_mono': agora_mono - 3600,
+                                 'canal': 'Plantão', 'canal_id': 555,
+                                 'user_name': 'a'}
+        anterior.registrar_saude(3, {})
+        anterior.fechar()  # O processo do cluster caiu
+        # O último contato foi há 50 min; o armazém seguiu com a sessão aberta
+        servidor._contatos[3] = (agora - 3000, agora_mono - 3000)
+
+        novo = main.ProxyArmazem(servidor.endereco, servidor.chave,
+                                 espera_conexao=5, cluster_id=3)
+        resultado = novo.reconciliar_presenca(
+            [1], [(1, 10, 'a', 'Plantão', 555)], novo.contato_anterior)
+        novo.fechar()
+    finally:
+        servidor.parar()
+
+    assert resultado == {'abertas': 1, 'fechadas': 1, 'mantidas': 0}
+    assert tracker.obter_estatisticas_usuario(1, 10)['total_segundos'] == 600
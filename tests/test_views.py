@@ -0,0 +1,121 @@
+"""Registro de views abertas e cache das páginas renderizadas (medbot.views)."""
+from medbot.views import CachePaginas, RegistroViews, tamanho_aproximado
+
+
+class Botao:
+    disabled = False
+
+
+class ViewFalsa:
+    """O necessário de discord.ui.View para o RegistroViews."""
+
+    def __init__(self, nome, estado=None):
+        self.nome = nome
+        self.estado = estado
+        self.children = [Botao(), Botao()]
+        self.parada = False
+
+    def is_finished(self):
+        return self.parada
+
+    def stop(self):
+        self.parada = True
+
+
+def _registro(por_usuario, maximo):
+    editadas = []
+    registro = RegistroViews(por_usuario, maximo,
+                             ao_despejar=lambda view, mensagem:
+                             editadas.append((view.nome, mensagem)))
+    return registro, editadas
+
+
+def test_despeja_a_view_mais_antiga_do_usuario():
+    registro, editadas = _registro(por_usuario=2, maximo=10)
+    views = [ViewFalsa(f"v{i}") for i in range(3)]
+    for i, view in enumerate(views):
+        registro.registrar(view, 1, f"mensagem {i}")
+
+    assert views[0].parada
+    assert all(botao.disabled for botao in views[0].children)
+    assert editadas == [("v0", "mensagem 0")]
+    assert not views[1].parada and not views[2].parada
+    assert registro.estatisticas()['despejadas'] == {'usuario': 1, 'global': 0}
+
+
+def test_limite_global_despeja_a_mais_antiga_de_todas():
+    registro, editadas = _registro(por_usuario=5, maximo=2)
+    views = [ViewFalsa(f"v{dono}") for dono in range(3)]
+    for dono, view in enumerate(views):
+        registro.registrar(view, dono, None)
+
+    assert [view.parada for view in views] == [True, False, False]
+    # Sem mensagem (resposta efêmera), não há o que editar
+    assert editadas == []
+    estatisticas = registro.estatisticas()
+    assert estatisticas['abertas'] == 2
+    assert estatisticas['despejadas'] == {'usuario': 0, 'global': 1}
+
+
+def test_views_encerradas_saem_sem_contar_como_despejo():
+    registro, editadas = _registro(por_usuario=1, maximo=10)
+    antiga = ViewFalsa("antiga")
+    registro.registrar(antiga, 1, "mensagem")
+    antiga.stop()  # Expirou ou o usuário fechou
+    registro.registrar(ViewFalsa("nova"), 1, "mensagem")
+
+    assert editadas == []
+    assert registro.estatisticas()['despejadas'] == {'usuario': 0, 'global': 0}
+
+
+def test_memoria_ignora_os_objetos_compartilhados():
+    compartilhado = list(range(1000))
+    view = ViewFalsa("v", estado={'paginas': [1, 2, 3]})
+    sozinha = tamanho_aproximado(view)
+
+    registro = RegistroViews(3, 10, compartilhados=lambda: [compartilhado])
+    registro.registrar(view, 1, None)
+    assert registro.estatisticas()['memoria_bytes'] == sozinha
+
+    # Referenciar o rastreador não soma o tamanho dele à view
+    view.estado['tracker'] = compartilhado
+    assert registro.estatisticas()['memoria_bytes'] == \
+        tamanho_aproximado(view, {id(compartilhado)})
+    assert tamanho_aproximado(view) > \
+        tamanho_aproximado(view, {id(compartilhado)}) + 8000
+
+
+def test_nova_versao_dos_dados_nao_reaproveita_a_pagina():
+    cache = CachePaginas(capacidade=8)
+    cache.guardar(('historico', 1, 10, 1, 1), "página v1")
+
+    assert cache.obter(('historico', 1, 10, 1, 1)) == "página v1"
+    # Sessão nova: a versão do histórico muda e a página é refeita
+    assert cache.obter(('historico', 1, 10, 2, 1)) is None
+    assert (cache.acertos, cache.falhas) == (1, 1)
+
+
+def test_descarta_a_pagina_menos_usada():
+    cache = CachePaginas(capacidade=2)
+    cache.guardar('a', 1)
+    cache.guardar('b', 2)
+    cache.obter('a')
+    cache.guardar('c', 3)
+
+    assert cache.obter('b') is None
+    assert cache.obter('a') == 1
+    assert cache.obter('c') == 3
+
+
+def test_invalidar_hierarquia_muda_a_chave_da_pagina(main):
+    def chave(guild_id):
+        return ('hierarquia', guild_id,
+                main.versoes_hierarquia.get(guild_id, 0), 0)
+
+    cache = CachePaginas(capacidade=8)
+    cache.guardar(chave(1), {'title': 'antes'})
+    cache.guardar(chave(2), {'title': 'outro servidor'})
+    main.invalidar_hierarquia(1)
+
+    assert cache.obter(chave(1)) is None
+    assert cache.obter(chave(2)) == {'title': 'outro servidor'}